@@ -0,0 +1,190 @@
+import os
+import io
+import json
+import random
+import struct
+import shutil
+import piexif
+import PIL.Image
+
+from datetime import datetime, timedelta
+
+# Share of each kind of file in a generated corpus.
+DEFAULT_MIX = {
+    'jpeg': 0.6,
+    'heic': 0.15,
+    'mp4': 0.1,
+    'mov': 0.05,
+    'bare': 0.1,
+}
+
+# Share of files which are exact copies of an earlier file, and of files
+# which reuse an earlier name (with different content and the same date).
+DUPLICATES = 0.1
+COLLISIONS = 0.1
+
+MANIFEST = 'manifest.json'
+
+EPOCH_1904 = datetime(1904, 1, 1)
+FIRST_DATE = datetime(2005, 1, 1)
+DATE_RANGE = 20 * 365 * 24 * 3600
+
+
+def box(kind, payload=b''):
+    """ Returns an ISO-BMFF box of type `kind` holding `payload`. """
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def _noise(rng, n):
+    return rng.getrandbits(n * 8).to_bytes(n, 'little') if n else b''
+
+
+def _exif(created):
+    """ Returns an EXIF block with `created` as the original date. """
+    stamp = created.strftime("%Y:%m:%d %H:%M:%S")
+
+    return piexif.dump({
+        '0th': {piexif.ImageIFD.Make: u"sortmedia",
+                piexif.ImageIFD.DateTime: stamp},
+        'Exif': {piexif.ExifIFD.DateTimeOriginal: stamp},
+    })
+
+
+def make_jpeg(rng, created, width, height):
+    """ Returns a JPEG of random pixels with `created` in its EXIF data, or
+        without any EXIF data if `created` is `None`. Random pixels keep the
+        file close to the size of a real photo of the same dimensions. """
+    pixels = _noise(rng, width * height * 3)
+    img = PIL.Image.frombytes('RGB', (width, height), pixels)
+    out = io.BytesIO()
+
+    if created is None:
+        img.save(out, 'jpeg', quality=90)
+    else:
+        img.save(out, 'jpeg', quality=90, exif=_exif(created))
+
+    return out.getvalue()
+
+
+def make_heic(rng, created, payload):
+    """ Returns a HEIC container with an Exif item dated `created`, followed
+        by `payload` random bytes standing in for the coded image. Only the
+        boxes sortmedia reads are present, so the image cannot be decoded. """
+    exif = struct.pack('>I', 6) + _exif(created)
+
+    def meta(offset):
+        hdlr = box(b'hdlr', bytes(8) + b'pict' + bytes(13))
+        infe = box(b'infe', b'\x02\x00\x00\x00' +
+                   struct.pack('>HH4s', 1, 0, b'Exif') + b'\x00')
+        iinf = box(b'iinf', bytes(4) + struct.pack('>H', 1) + infe)
+        iloc = box(b'iloc', bytes(4) + b'\x44\x00' +
+                   struct.pack('>HHHHII', 1, 1, 0, 1, offset, len(exif)))
+        return box(b'meta', bytes(4) + hdlr + iinf + iloc)
+
+    ftyp = box(b'ftyp', b'heic' + bytes(4) + b'mif1heic')
+    header = len(ftyp) + len(meta(0)) + 8
+
+    return ftyp + meta(header) + box(b'mdat', exif + _noise(rng, payload))
+
+
+def make_video(rng, created, payload, brand=b'isom'):
+    """ Returns an MP4 (or, with `brand` `qt  `, a MOV) whose `mvhd` box
+        holds `created`, followed by `payload` bytes of random media data. """
+    seconds = int((created - EPOCH_1904).total_seconds()) if created else 0
+    mvhd = box(b'mvhd', bytes(4) + struct.pack('>II', seconds, seconds) +
+               bytes(88))
+
+    return box(b'ftyp', brand + bytes(4) + brand) + \
+        box(b'moov', mvhd) + box(b'mdat', _noise(rng, payload))
+
+
+def generate(root, count, seed=0, mix=None, duplicates=DUPLICATES,
+             collisions=COLLISIONS, width=1024, height=768,
+             video_size=4 * 1024 * 1024, dirs=20):
+    """ Generate a corpus of `count` media files in `root` and write a
+        manifest describing it. The same arguments always produce the same
+        corpus.
+
+        @param  root        The directory to create. It must not exist.
+        @param  count       Number of files to create.
+        @param  seed        Seed for the random number generator.
+        @param  mix         Dictionary of file kind to share of the corpus:
+                            `jpeg`, `heic`, `mp4`, `mov` and `bare` (a JPEG
+                            without EXIF data). Defaults to `DEFAULT_MIX`.
+        @param  duplicates  Share of files which are copies of earlier files
+                            under another name.
+        @param  collisions  Share of files which reuse the name and date of
+                            an earlier file, with different content.
+        @param  width       Width of the generated photos, in pixels.
+        @param  height      Height of the generated photos, in pixels.
+        @param  video_size  Size of the media data of generated videos, and
+                            of the image data of HEIC files divided by four.
+        @param  dirs        Number of directories the files are spread over.
+
+        @returns    The manifest, a dictionary of counts and sizes. """
+    if os.path.exists(root):
+        raise RuntimeError(f"The corpus directory `{root}` already exists.")
+
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    made = []
+    manifest = {
+        'seed': seed,
+        'files': 0,
+        'bytes': 0,
+        'kinds': {k: 0 for k in kinds + ['duplicate', 'collision']},
+    }
+
+    for i in range(count):
+        directory = os.path.join(root, f'dir{rng.randrange(dirs):03d}')
+        os.makedirs(directory, exist_ok=True)
+        roll = rng.random()
+
+        if made and roll < duplicates:
+            src, name, _ = rng.choice(made)
+            path = os.path.join(directory, f'copy{i:06d}_{name}')
+            shutil.copyfile(src, path)
+            kind = 'duplicate'
+        else:
+            kind = rng.choices(kinds, weights)[0]
+            created = None
+            if kind != 'bare':
+                created = FIRST_DATE + \
+                    timedelta(seconds=rng.randrange(DATE_RANGE))
+            ext = 'jpg' if kind in ('jpeg', 'bare') else kind
+            name = f'IMG_{i:06d}.{ext}'
+
+            if made and roll < duplicates + collisions:
+                # Reuse the name and date of an earlier file, so both are
+                # sorted into the same directory.
+                _, name, created = rng.choice(made)
+                ext = os.path.splitext(name)[1][1:]
+                kind = 'collision'
+
+            if ext == 'jpg':
+                data = make_jpeg(rng, created, width, height)
+            elif ext == 'heic':
+                data = make_heic(rng, created, video_size // 4)
+            else:
+                brand = b'qt  ' if ext == 'mov' else b'isom'
+                data = make_video(rng, created, video_size, brand)
+
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                path = os.path.join(directory, f'{i:06d}_{name}')
+
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            made.append((path, name, created))
+
+        manifest['files'] = manifest['files'] + 1
+        manifest['bytes'] = manifest['bytes'] + os.path.getsize(path)
+        manifest['kinds'][kind] = manifest['kinds'][kind] + 1
+
+    with open(os.path.join(root, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.corpus import generate, MANIFEST
+
+STAGES = ['walk', 'mime', 'metadata', 'hash', 'sort']
+
+
+def _files(corpus, workdir):
+    """ Returns the `(path, size)` of every file in the corpus. """
+    from sortmedia.walk import scan
+
+    return [(path, os.path.getsize(path)) for path, _ in scan(corpus)]
+
+
+def _media(corpus, workdir):
+    """ Returns the `(path, size, mime, cls)` of every media file. """
+    from sortmedia.util import get_mimetype, is_photo, is_video, HEAD_SIZE
+    from sortmedia.photo import Photo
+    from sortmedia.video import Video
+
+    media = []
+
+    for path, size in _files(corpus, workdir):
+        with open(path, 'rb') as f:
+            mime = get_mimetype(path, head=f.read(HEAD_SIZE))
+
+        if mime and is_video(mime):
+            media.append((path, size, mime, Video))
+        elif mime and is_photo(mime):
+            media.append((path, size, mime, Photo))
+
+    return media
+
+
+def _destination(corpus, workdir):
+    dst = os.path.join(workdir, 'sorted')
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    return _files(corpus, workdir), dst
+
+
+def stage_walk(corpus, files, options):
+    """ Walk the corpus without opening any file. """
+    from sortmedia.walk import scan
+
+    return sum(1 for _ in scan(corpus)), 0
+
+
+def stage_mime(corpus, files, options):
+    """ Read the header of every file and sniff its MIME type. """
+    from sortmedia.util import get_mimetype, HEAD_SIZE
+
+    read = 0
+
+    for path, _ in files:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_SIZE)
+        get_mimetype(path, head=head)
+        read = read + len(head)
+
+    return len(files), read
+
+
+def stage_metadata(corpus, media, options):
+    """ Parse the creation date of every media file. """
+    for path, _, mime, cls in media:
+        with cls(path, mime) as obj:
+            obj.created()
+
+    return len(media), sum(m[1] for m in media)
+
+
+def stage_hash(corpus, files, options):
+    """ Compute the digest of every file. """
+    from sortmedia.hashing import hash_file
+
+    for path, _ in files:
+        hash_file(path, options['algorithm'])
+
+    return len(files), sum(f[1] for f in files)
+
+
+def stage_sort(corpus, prepared, options):
+    """ Run `SortMedia.process_files`, copying the corpus into a fresh
+        destination so it can be reused. """
+    from sortmedia.sort import SortMedia
+
+    files, dst = prepared
+    ms = SortMedia(copy=True,
+                   algorithm=options['algorithm'],
+                   dedupe=options['dedupe'],
+                   jobs=options['jobs'],
+                   copy_strategy=options['copy_strategy'])
+    ms.process_files(corpus, dst)
+
+    return len(files), sum(f[1] for f in files)
+
+
+# Each stage and the untimed preparation whose result it is given.
+_STAGES = {
+    'walk': (stage_walk, lambda corpus, workdir: None),
+    'mime': (stage_mime, _files),
+    'metadata': (stage_metadata, _media),
+    'hash': (stage_hash, _files),
+    'sort': (stage_sort, _destination),
+}
+
+
+def _run_stage(name, corpus, workdir, options):
+    """ Runs in a fresh process so the peak RSS is that of the stage. """
+    logging.disable(logging.INFO)
+
+    stage, prepare = _STAGES[name]
+    prepared = prepare(corpus, workdir)
+
+    start = time.perf_counter()
+    files, read = stage(corpus, prepared, options)
+    seconds = time.perf_counter() - start
+
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        rss = rss * 1024
+
+    return {'seconds': seconds, 'files': files, 'bytes': read,
+            'peak_rss': rss}
+
+
+def run_stage(name, corpus, workdir, options, repeat=1):
+    """ Run the stage `name` `repeat` times, each in a new process, and
+        return the fastest run with its throughput.
+
+        @param  name        One of `STAGES`.
+        @param  corpus      The corpus directory.
+        @param  workdir     A scratch directory for the stage.
+        @param  options     Dictionary of `algorithm`, `dedupe`, `jobs` and
+                            `copy_strategy`.
+        @param  repeat      Number of runs.
+
+        @returns    A dictionary of `seconds`, `files`, `bytes`,
+                    `peak_rss` (bytes), `files_per_s` and `mb_per_s`. """
+    if name not in _STAGES:
+        raise ValueError(f"Unknown stage `{name}`.")
+
+    context = multiprocessing.get_context('spawn')
+    runs = []
+
+    for _ in range(max(1, repeat)):
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            runs.append(pool.submit(_run_stage, name, corpus, workdir,
+                                    options).result())
+
+    best = min(runs, key=lambda r: r['seconds'])
+    seconds = best['seconds'] or 1e-9
+
+    return dict(best,
+                runs=[r['seconds'] for r in runs],
+                peak_rss=max(r['peak_rss'] for r in runs),
+                files_per_s=best['files'] / seconds,
+                mb_per_s=best['bytes'] / seconds / (1024 * 1024))
+
+
+def _revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always',
+                                       '--dirty'], cwd=here,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return out.decode().strip()
+
+
+def benchmark(corpus, stages=None, repeat=1, algorithm='sha256',
+              dedupe='full', jobs=1, copy_strategy='copy'):
+    """ Benchmark each of `stages` on `corpus`.
+
+        @returns    A dictionary of the environment, the corpus manifest and
+                    the results of each stage, ready to be dumped as JSON. """
+    options = {'algorithm': algorithm, 'dedupe': dedupe, 'jobs': jobs,
+               'copy_strategy': copy_strategy}
+    manifest = None
+
+    if os.path.exists(os.path.join(corpus, MANIFEST)):
+        with open(os.path.join(corpus, MANIFEST)) as f:
+            manifest = json.load(f)
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='sortmedia-bench-')
+
+    try:
+        for name in stages or STAGES:
+            results[name] = run_stage(name, corpus, workdir, options, repeat)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'options': options,
+        'corpus': manifest,
+        'stages': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of sortmedia on a synthetic ' +
+                    'media corpus')
+    parser.add_argument('--corpus',
+                        help='Corpus directory. Generated if it does not ' +
+                             'exist, and in a temporary directory if not ' +
+                             'given')
+    parser.add_argument('--files',
+                        help='Number of files to generate',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--width',
+                        help='Width of generated photos',
+                        type=int,
+                        default=1024)
+    parser.add_argument('--height',
+                        help='Height of generated photos',
+                        type=int,
+                        default=768)
+    parser.add_argument('--video-size',
+                        help='Bytes of media data in generated videos',
+                        type=int,
+                        default=4 * 1024 * 1024)
+    parser.add_argument('--stages',
+                        help='Comma separated stages to run, of ' +
+                             ', '.join(STAGES),
+                        default=','.join(STAGES))
+    parser.add_argument('--repeat',
+                        help='Runs per stage. The fastest is reported',
+                        type=int,
+                        default=1)
+    parser.add_argument('--hash', default='sha256')
+    parser.add_argument('--dedupe', default='full')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--copy-strategy', default='copy')
+    parser.add_argument('-o',
+                        '--output',
+                        help='Write the JSON results to this file instead ' +
+                             'of standard output')
+
+    args = parser.parse_args()
+    corpus = args.corpus
+    temporary = corpus is None
+
+    if temporary:
+        corpus = os.path.join(tempfile.mkdtemp(prefix='sortmedia-corpus-'),
+                              'corpus')
+
+    try:
+        if not os.path.exists(corpus):
+            generate(corpus, args.files, seed=args.seed, width=args.width,
+                     height=args.height, video_size=args.video_size)
+
+        results = benchmark(corpus,
+                            stages=args.stages.split(','),
+                            repeat=args.repeat,
+                            algorithm=args.hash,
+                            dedupe=args.dedupe,
+                            jobs=args.jobs,
+                            copy_strategy=args.copy_strategy)
+    finally:
+        if temporary:
+            shutil.rmtree(os.path.dirname(corpus))
+
+    out = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
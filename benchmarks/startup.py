@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which are slow to load and must only be imported once a file needs
+# them. Importing `sortmedia.sort` or `sortmedia.cli` loads none of them.
+HEAVY_MODULES = ['PIL', 'piexif', 'pyheif', 'magic', 'filetype', 'numpy',
+                 'sqlite3', 'multiprocessing', 'ctypes', 'subprocess']
+
+# What is timed, as Python code run in a new interpreter. `{src}` and `{dst}`
+# are empty directories.
+COMMANDS = {
+    'bare': 'pass',
+    'import': 'import sortmedia.sort',
+    'help': "import sys; sys.argv = ['sortmedia', '--help']; "
+            "from sortmedia.cli import main; main()",
+    'empty': "import sys; sys.argv = ['sortmedia', {src!r}, {dst!r}]; "
+             "from sortmedia.cli import main; main()",
+}
+
+
+def _python(code, *options):
+    """ Runs `code` in a new interpreter with sortmedia importable and
+        returns the completed process. """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable] + list(options) + ['-c', code],
+                          env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+
+def time_command(code, repeat=5):
+    """ Returns the fastest wall time in seconds of `repeat` runs of `code`
+        in a new interpreter. """
+    best = None
+
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        _python(code)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+
+def loaded_modules(module, candidates=HEAVY_MODULES):
+    """ Returns the `candidates` loaded by importing `module` in a new
+        interpreter. """
+    code = f"import sys, json, {module}; " \
+           f"print(json.dumps([m for m in {candidates!r} " \
+           f"if m in sys.modules]))"
+    out = _python(code)
+
+    if out.returncode:
+        raise RuntimeError(f"Importing `{module}` failed: " +
+                           out.stderr.decode(errors='replace'))
+
+    return json.loads(out.stdout)
+
+
+def import_times(module, top=10):
+    """ Returns the import time of `module` and its `top` slowest imports
+        by cumulative time, in microseconds, from `python -X importtime`. """
+    out = _python(f'import {module}', '-X', 'importtime')
+    times = []
+
+    for line in out.stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), int(own), name.strip()))
+
+    total = next((t[0] for t in times if t[2] == module), None)
+    slowest = sorted(times, reverse=True)[:top]
+
+    return {
+        'total_us': total,
+        'slowest': [{'module': name, 'cumulative_us': c, 'self_us': s}
+                    for c, s, name in slowest],
+    }
+
+
+def benchmark(repeat=5):
+    """ Time each of `COMMANDS` and profile the imports.
+
+        @returns    A dictionary ready to be dumped as JSON. Each command has
+                    its fastest time and its overhead over `bare`. """
+    workdir = tempfile.mkdtemp(prefix='sortmedia-startup-')
+    src = os.path.join(workdir, 'src')
+    dst = os.path.join(workdir, 'dst')
+    os.makedirs(src)
+    os.makedirs(dst)
+
+    try:
+        seconds = {name: time_command(code.format(src=src, dst=dst), repeat)
+                   for name, code in COMMANDS.items()}
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'python': sys.version.split()[0],
+        'commands': {name: {'seconds': s,
+                            'overhead': s - seconds['bare']}
+                     for name, s in seconds.items()},
+        'imports': {module: dict(import_times(module),
+                                 heavy=loaded_modules(module))
+                    for module in ('sortmedia.cli', 'sortmedia.sort')},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how long sortmedia takes to start')
+    parser.add_argument('--repeat',
+                        help='Runs per command. The fastest is reported',
+                        type=int,
+                        default=5)
+    parser.add_argument('--max-overhead',
+                        help='Fail if `--help` or a run with nothing to do ' +
+                             'takes this many milliseconds longer than a ' +
+                             'bare interpreter, or if a heavy module is ' +
+                             'imported at startup',
+                        type=float,
+                        default=None)
+
+    args = parser.parse_args()
+    results = benchmark(args.repeat)
+    print(json.dumps(results, indent=2))
+
+    if args.max_overhead is None:
+        return
+
+    failed = []
+
+    for name in ('help', 'empty'):
+        overhead = results['commands'][name]['overhead'] * 1000
+        if overhead > args.max_overhead:
+            failed.append(f"{name} is {overhead:.0f}ms slower than bare")
+
+    for module, profile in results['imports'].items():
+        if profile['heavy']:
+            failed.append(f"{module} imports {', '.join(profile['heavy'])}")
+
+    if failed:
+        sys.exit('\n'.join(failed))
+
+
+if __name__ == '__main__':
+    main()
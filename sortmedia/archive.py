@@ -0,0 +1,110 @@
+import os
+import shutil
+import logging
+
+from sortmedia.transfer import copy_file
+
+logger = logging.getLogger(__name__)
+
+# Directory of the content store inside the destination. Its prefix keeps it
+# out of the `ContentIndex`.
+STORE_DIR = '.sortmedia-store'
+
+# Suffix of an object while it is being written.
+PARTIAL_SUFFIX = '.partial'
+
+
+def store_root(dst):
+    """ Returns the content store of the destination `dst`. """
+    return os.path.join(dst, STORE_DIR)
+
+
+class Store:
+    """ A content-addressable store: every unique file is kept once, under
+        its digest alone, as `<root>/ab/cd/<digest>`, so the same bytes
+        under different names or extensions are one object. The date tree
+        of an archive is made of hard links into it, which carry the
+        extensions.
+
+        Whether content is already archived is a single `stat` of its store
+        path, without reading any stored file. An object with no other link
+        than its store path is stored but missing from the date tree, for
+        example after an interrupted run, and is linked again by the next
+        file with the same content. """
+
+    def __init__(self, root):
+        """ @param  root    The directory holding the store. """
+        self.root = root
+        self.planned = set()
+
+    def path(self, digest):
+        """ Returns the store path of the content `digest`. """
+        name = digest.hex()
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def find(self, digest):
+        """ Returns `True` if the content `digest` is already archived, or
+            reserved by `reserve` for a file planned earlier. """
+        path = self.path(digest)
+
+        if path in self.planned:
+            return True
+
+        try:
+            return os.stat(path).st_nlink > 1
+        except FileNotFoundError:
+            return False
+
+    def reserve(self, digest):
+        """ Mark the content `digest` as archived by a planned file, so later
+            files with the same content are duplicates. Returns its store
+            path. """
+        path = self.path(digest)
+        self.planned.add(path)
+        return path
+
+    def put(self, src, digest, move=False, strategy='copy', mover=None):
+        """ Store the file `src` with the content `digest`, unless the store
+            already holds it. The object is written under a temporary name
+            and renamed, so a store path always holds complete content.
+
+            @param  src         The file to store.
+            @param  digest      Its digest.
+            @param  move        Move `src` into the store. If the content is
+                                already stored, `src` is removed.
+            @param  strategy    How the data is copied when not moving, one
+                                of `transfer.COPY_STRATEGIES`.
+            @param  mover       The `transfer.Mover` moving `src`, which
+                                verifies and syncs moves across
+                                filesystems.
+
+            @returns    The store path. """
+        path = self.path(digest)
+
+        if os.path.exists(path):
+            if move:
+                os.remove(src)
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + PARTIAL_SUFFIX
+
+        # Left by an interrupted run.
+        if os.path.lexists(partial):
+            os.remove(partial)
+
+        if move and mover is not None:
+            mover.move(src, partial, digest)
+        elif move:
+            shutil.move(src, partial)
+        else:
+            copy_file(src, partial, strategy)
+
+        os.replace(partial, path)
+        return path
+
+    def link(self, stored, target):
+        """ Create `target` in the date tree as a hard link to the store path
+            `stored`. """
+        os.link(stored, target)
+        logger.debug(f"{target} -> {stored}")
@@ -0,0 +1,306 @@
+import os
+import struct
+
+from datetime import datetime, timedelta, timezone
+from sortmedia.exif import parse_tiff, ExifError
+
+# ISO-BMFF and QuickTime timestamps count seconds from this date.
+EPOCH_1904 = datetime(1904, 1, 1)
+
+# `Video.parse_date` expects the format `ffprobe` prints.
+CREATION_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000000Z"
+
+QUICKTIME_CREATIONDATE = b'com.apple.quicktime.creationdate'
+
+# Box types which may start an ISO-BMFF or QuickTime file.
+TOP_LEVEL = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+
+
+class BoxError(Exception):
+    """ Raised when a file is not a well formed ISO-BMFF file. Callers fall
+        back to `ffprobe` or `pyheif`. """
+
+
+def _file_size(fp):
+    return fp.seek(0, os.SEEK_END)
+
+
+def _read(fp, offset, n):
+    fp.seek(offset)
+    data = fp.read(n)
+    if len(data) != n:
+        raise BoxError("Unexpected end of file.")
+    return data
+
+
+def iter_boxes(fp, start, end):
+    """ Yields a `(type, data_start, data_end)` tuple for each box between
+        the offsets `start` and `end` of `fp`. Only box headers are read. """
+    offset = start
+
+    while offset + 8 <= end:
+        size, kind = struct.unpack('>I4s', _read(fp, offset, 8))
+        header = 8
+
+        if size == 1:
+            size, = struct.unpack('>Q', _read(fp, offset + 8, 8))
+            header = 16
+        elif size == 0:
+            size = end - offset
+
+        if size < header or offset + size > end:
+            raise BoxError(f"Invalid size for box `{kind}`.")
+
+        yield kind, offset + header, offset + size
+        offset = offset + size
+
+
+def find_box(fp, start, end, kind):
+    """ Returns `(data_start, data_end)` of the first box of type `kind`
+        between `start` and `end`, or `None`. """
+    for k, data_start, data_end in iter_boxes(fp, start, end):
+        if k == kind:
+            return data_start, data_end
+    return None
+
+
+def _check_signature(fp, size):
+    if size < 8:
+        raise BoxError("File too small.")
+
+    if _read(fp, 4, 4) not in TOP_LEVEL | {b'meta'}:
+        raise BoxError("Not an ISO-BMFF file.")
+
+
+def _mvhd_time(fp, start):
+    """ Returns the creation time stored in the `mvhd` box at `start`, or
+        `None` if it is unset. """
+    version = _read(fp, start, 1)[0]
+
+    if version == 1:
+        seconds, = struct.unpack('>Q', _read(fp, start + 4, 8))
+    else:
+        seconds, = struct.unpack('>I', _read(fp, start + 4, 4))
+
+    if not seconds:
+        return None
+
+    return EPOCH_1904 + timedelta(seconds=seconds)
+
+
+def _meta_children(fp, start):
+    """ Returns the offset of the first child of a `meta` box. ISO `meta` is
+        a full box, QuickTime `meta` is not. """
+    if _read(fp, start + 4, 4) == b'hdlr':
+        return start
+    return start + 4
+
+
+def _quicktime_time(fp, start, end):
+    """ Returns the `com.apple.quicktime.creationdate` of the `moov/meta` box
+        between `start` and `end` as a naive UTC `datetime`, or `None`. """
+    children = _meta_children(fp, start)
+    keys = find_box(fp, children, end, b'keys')
+    ilst = find_box(fp, children, end, b'ilst')
+
+    if not keys or not ilst:
+        return None
+
+    count, = struct.unpack('>I', _read(fp, keys[0] + 4, 4))
+    offset = keys[0] + 8
+    index = None
+
+    for i in range(count):
+        size, = struct.unpack('>I', _read(fp, offset, 4))
+        if size < 8:
+            raise BoxError("Invalid key.")
+        if _read(fp, offset + 8, size - 8) == QUICKTIME_CREATIONDATE:
+            index = i + 1
+            break
+        offset = offset + size
+
+    if index is None:
+        return None
+
+    for kind, item_start, item_end in iter_boxes(fp, ilst[0], ilst[1]):
+        if struct.unpack('>I', kind)[0] != index:
+            continue
+
+        data = find_box(fp, item_start, item_end, b'data')
+        if not data or data[1] - data[0] <= 8:
+            return None
+
+        value = _read(fp, data[0] + 8, data[1] - data[0] - 8)
+        value = value.decode('utf-8', 'replace').strip()
+
+        try:
+            parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+        except ValueError:
+            return None
+
+        return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return None
+
+
+def read_video_dates(fp):
+    """ Returns the creation time of the MP4/MOV file `fp` in the format of
+        the `ffprobe` tags, `{'creation_time': ...}`. The `mvhd` time is
+        used, or the QuickTime creation date key if `mvhd` has none. Returns
+        an empty dictionary if the file has no creation time and `None` if
+        it is not an ISO-BMFF file or cannot be parsed.
+
+        @param  fp  A seekable binary file object. """
+    try:
+        size = _file_size(fp)
+        _check_signature(fp, size)
+
+        moov = find_box(fp, 0, size, b'moov')
+        if not moov:
+            raise BoxError("No `moov` box.")
+
+        created = None
+        mvhd = find_box(fp, moov[0], moov[1], b'mvhd')
+
+        if mvhd:
+            created = _mvhd_time(fp, mvhd[0])
+
+        if not created:
+            meta = find_box(fp, moov[0], moov[1], b'meta')
+            if meta:
+                created = _quicktime_time(fp, meta[0], meta[1])
+
+        if not created:
+            return {}
+
+        return {'creation_time': created.strftime(CREATION_TIME_FORMAT)}
+    except (BoxError, struct.error, OverflowError):
+        return None
+    finally:
+        fp.seek(0)
+
+
+def _exif_item_id(fp, start, end):
+    """ Returns the item ID of the Exif item listed in the `iinf` box. """
+    version = _read(fp, start, 1)[0]
+    offset = start + (6 if version == 0 else 8)
+
+    for kind, infe_start, infe_end in iter_boxes(fp, offset, end):
+        if kind != b'infe':
+            continue
+
+        infe_version = _read(fp, infe_start, 1)[0]
+
+        if infe_version == 2:
+            item_id, _, item_type = struct.unpack(
+                '>HH4s', _read(fp, infe_start + 4, 8))
+        elif infe_version == 3:
+            item_id, _, item_type = struct.unpack(
+                '>IH4s', _read(fp, infe_start + 4, 10))
+        else:
+            continue
+
+        if item_type == b'Exif':
+            return item_id
+
+    return None
+
+
+def _sized(data, offset, n):
+    """ Unpack an unsigned big endian integer of `n` bytes. """
+    if n == 0:
+        return 0, offset
+    return int.from_bytes(data[offset:offset + n], 'big'), offset + n
+
+
+def _item_extents(fp, start, end, item_id):
+    """ Returns a list of `(offset, length)` file extents for `item_id` from
+        the `iloc` box between `start` and `end`. """
+    data = _read(fp, start, end - start)
+    version = data[0]
+
+    offset_size = data[4] >> 4
+    length_size = data[4] & 0x0f
+    base_offset_size = data[5] >> 4
+    index_size = data[5] & 0x0f if version in (1, 2) else 0
+
+    if version < 2:
+        count, = struct.unpack('>H', data[6:8])
+        pos = 8
+    else:
+        count, = struct.unpack('>I', data[6:10])
+        pos = 10
+
+    for _ in range(count):
+        if version < 2:
+            current, = struct.unpack('>H', data[pos:pos + 2])
+            pos = pos + 2
+        else:
+            current, = struct.unpack('>I', data[pos:pos + 4])
+            pos = pos + 4
+
+        method = 0
+        if version in (1, 2):
+            method = struct.unpack('>H', data[pos:pos + 2])[0] & 0x0f
+            pos = pos + 2
+
+        # Skip the data reference index.
+        pos = pos + 2
+        base, pos = _sized(data, pos, base_offset_size)
+        extent_count, = struct.unpack('>H', data[pos:pos + 2])
+        pos = pos + 2
+
+        extents = []
+        for _ in range(extent_count):
+            _, pos = _sized(data, pos, index_size)
+            extent_offset, pos = _sized(data, pos, offset_size)
+            extent_length, pos = _sized(data, pos, length_size)
+            extents.append((base + extent_offset, extent_length))
+
+        if current == item_id:
+            if method != 0:
+                raise BoxError("Unsupported item construction method.")
+            return extents
+
+    return None
+
+
+def read_heic_exif(fp):
+    """ Returns the EXIF date tags of the HEIC/HEIF file `fp`, reading only
+        the `meta` box and the Exif item. Returns an empty dictionary if the
+        file has no Exif item and `None` if it cannot be parsed.
+
+        @param  fp  A seekable binary file object. """
+    try:
+        size = _file_size(fp)
+        _check_signature(fp, size)
+
+        meta = find_box(fp, 0, size, b'meta')
+        if not meta:
+            raise BoxError("No `meta` box.")
+
+        children = meta[0] + 4
+        iinf = find_box(fp, children, meta[1], b'iinf')
+        iloc = find_box(fp, children, meta[1], b'iloc')
+
+        if not iinf or not iloc:
+            raise BoxError("No `iinf` or `iloc` box.")
+
+        item_id = _exif_item_id(fp, iinf[0], iinf[1])
+        if item_id is None:
+            return {}
+
+        extents = _item_extents(fp, iloc[0], iloc[1], item_id)
+        if not extents:
+            raise BoxError("No location for the Exif item.")
+
+        data = b''.join(_read(fp, o, n) for o, n in extents)
+
+        # The item starts with the offset to the TIFF header, which usually
+        # follows an `Exif\0\0` marker.
+        tiff_offset, = struct.unpack('>I', data[:4])
+        return parse_tiff(data[4 + tiff_offset:])
+    except (BoxError, ExifError, struct.error):
+        return None
+    finally:
+        fp.seek(0)
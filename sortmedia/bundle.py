@@ -0,0 +1,176 @@
+import os
+import shutil
+import logging
+import itertools
+
+from sortmedia.hashing import DEFAULT_ALGORITHM, CHUNK_SIZE, new_hasher
+
+logger = logging.getLogger(__name__)
+
+# Extensions of the archives, such as Google Takeout or iCloud exports, read
+# as sources.
+BUNDLE_EXTENSIONS = ('.zip', '.tar', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2',
+                     '.txz', '.tar.xz')
+
+# Directory in the destination members are written to before being renamed
+# to their targets. Its prefix keeps it out of the `ContentIndex`.
+SPOOL_DIR = '.sortmedia-spool'
+
+
+def is_bundle(path):
+    """ Returns `True` if `path` is a zip or tar archive read as a source. """
+    return path.lower().endswith(BUNDLE_EXTENSIONS) and os.path.isfile(path)
+
+
+def _is_zip(path):
+    return path.lower().endswith('.zip')
+
+
+def safe_name(name):
+    """ Returns the member `name` as a relative path, or `None` if it would
+        be written outside the directory it is extracted into. """
+    parts = [p for p in name.replace('\\', '/').split('/')
+             if p not in ('', '.')]
+
+    if not parts or '..' in parts:
+        return None
+
+    return os.path.join(*parts)
+
+
+def members(path):
+    """ Yields `(name, size, fp)` for every regular file in the bundle at
+        `path`, in the order they are stored. Tar bundles, compressed or
+        not, are read as a single stream, so each `fp` must be read before
+        the next member is asked for. """
+    if _is_zip(path):
+        import zipfile
+
+        with zipfile.ZipFile(path) as z:
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                with z.open(info) as fp:
+                    yield info.filename, info.file_size, fp
+        return
+
+    import tarfile
+
+    with tarfile.open(path, 'r|*') as t:
+        for info in t:
+            if info.isfile():
+                yield info.name, info.size, t.extractfile(info)
+
+
+def select(path, extensions=None):
+    """ Yields `(relative, size, fp)` for the members of the bundle at
+        `path` which can be sorted, see `members`. `relative` is the member
+        name as a safe relative path.
+
+        @param  path        The bundle.
+        @param  extensions  Optional set of lower case extensions, including
+                            the dot. Other members are skipped without being
+                            read. """
+    for name, size, fp in members(path):
+        relative = safe_name(name)
+
+        if relative is None:
+            logger.warning(f"{path}: skipping unsafe member `{name}`")
+            continue
+
+        if extensions is not None and \
+                os.path.splitext(relative)[1].lower() not in extensions:
+            continue
+
+        yield relative, size, fp
+
+
+def heads(path, size, extensions=None):
+    """ Yields `(relative, member_size, head)` for the members of the bundle
+        at `path`, as `select` does, with only the first `size` bytes of
+        each member read. Nothing is written to disk. """
+    for relative, member_size, fp in select(path, extensions):
+        yield relative, member_size, fp.read(size)
+
+
+def count(path):
+    """ Returns the number of files in the bundle at `path`, or `None` if
+        it cannot be told without reading the whole bundle (tar). """
+    if not _is_zip(path):
+        return None
+
+    import zipfile
+
+    with zipfile.ZipFile(path) as z:
+        return sum(1 for info in z.infolist() if not info.is_dir())
+
+
+class Spool:
+    """ Writes the members of bundles to a directory, one at a time and
+        hashing them on the way, so they can be sorted like any other file.
+        The spool is on the destination's filesystem: a member is written
+        once and then renamed to its target, without extracting the bundle
+        first. """
+
+    def __init__(self, root, algorithm=DEFAULT_ALGORITHM):
+        """ @param  root        The spool directory. Removed by `close`.
+            @param  algorithm   The digest algorithm members are hashed
+                                with. """
+        self.root = root
+        self.algorithm = algorithm
+        self.digests = {}
+        self._ids = itertools.count()
+
+    def owns(self, path):
+        """ Returns `True` if `path` is a spooled member. """
+        return path in self.digests
+
+    def digest(self, path):
+        """ Returns the digest of the spooled member `path`, or `None`. """
+        return self.digests.get(path)
+
+    def extract(self, path, extensions=None):
+        """ Yields `(spooled, size)` for every member of the bundle at
+            `path` as it is written to the spool. Members keep their path
+            within the bundle, below a directory of their own for each
+            bundle.
+
+            @param  path        The bundle.
+            @param  extensions  Optional set of lower case extensions,
+                                including the dot. Other members are
+                                skipped without being read. """
+        directory = os.path.join(self.root, str(next(self._ids)))
+
+        for relative, _, fp in select(path, extensions):
+            spooled = os.path.join(directory, relative)
+            os.makedirs(os.path.dirname(spooled), exist_ok=True)
+
+            hasher = new_hasher(self.algorithm)
+            size = 0
+
+            with open(spooled, 'wb') as out:
+                while True:
+                    chunk = fp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size = size + len(chunk)
+
+            self.digests[spooled] = hasher.digest()
+            yield spooled, size
+
+    def discard(self, path):
+        """ Remove the spooled member `path`, if it is still there. """
+        self.digests.pop(path, None)
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """ Remove the spool and the members left in it, such as
+            duplicates. """
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.digests.clear()
@@ -0,0 +1,237 @@
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the `entries` table or the meaning of a stored
+# value changes. A cache written with another version is discarded.
+SCHEMA_VERSION = 1
+
+DEFAULT_NAME = '.sortmedia-cache.db'
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Number of pending writes held in memory before they are flushed to disk.
+FLUSH_EVERY = 500
+
+# Number of entries remembered so that the MIME lookup, the hash and the
+# metadata of one file share a single database query.
+RECENT_SIZE = 64
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class MetadataCache:
+    """ A persistent cache of per-file digests, MIME types and creation
+        dates backed by SQLite.
+
+        Entries are keyed on `(st_dev, st_ino, st_size, st_mtime_ns)` so any
+        change to a file's contents, or replacing it with another file,
+        results in a cache miss. Rows left behind by an older version of a
+        path are dropped when the new version is stored, and the least
+        recently used rows are evicted once the cache grows past
+        `max_entries`. A cache may be shared between threads. """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        """ Open (or create) the cache stored at `path`.
+
+            @param  path        Path to the SQLite database.
+            @param  max_entries The maximum number of files to remember. """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._recent = OrderedDict()
+        self._pending = {}
+        self._touched = set()
+        self._lock = threading.RLock()
+
+        dirs = os.path.dirname(path)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+
+        import sqlite3
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._init_schema()
+
+    def _init_schema(self):
+        """ Create the tables, discarding the contents of an incompatible
+            cache. """
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta " +
+                        "(key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'")
+        row = row.fetchone()
+
+        if row and int(row[0]) != SCHEMA_VERSION:
+            logger.info(f"Discarding cache `{self.path}` written by an " +
+                        "incompatible version.")
+            self.db.execute("DROP TABLE IF EXISTS entries")
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (" +
+                        "dev INTEGER, ino INTEGER, size INTEGER, " +
+                        "mtime INTEGER, path TEXT, algorithm TEXT, " +
+                        "digest BLOB, mime TEXT, created TEXT, " +
+                        "accessed REAL, " +
+                        "PRIMARY KEY (dev, ino, size, mtime))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_path " +
+                        "ON entries (path)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed " +
+                        "ON entries (accessed)")
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                        (str(SCHEMA_VERSION),))
+        self.db.commit()
+
+    @staticmethod
+    def key(st):
+        """ Returns the cache key for the `os.stat_result` `st`. """
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _lookup(self, path):
+        """ Returns a `(key, entry)` tuple for `path`, where `entry` is a
+            dictionary of cached fields. The file is stat'ed every time, so
+            a different file appearing at the same path is a miss, but
+            repeated lookups of an unchanged file are answered from
+            memory. """
+        path = os.path.abspath(path)
+
+        with self._lock:
+            return self._lookup_locked(path)
+
+    def _lookup_locked(self, path):
+        key = self.key(os.stat(path))
+        recent = self._recent.get(path)
+
+        if recent is not None and recent[0] == key:
+            self._recent.move_to_end(path)
+            return recent
+
+        entry = self._pending.get(key)
+
+        if entry is None:
+            row = self.db.execute("SELECT algorithm, digest, mime, created " +
+                                  "FROM entries WHERE dev = ? AND ino = ? " +
+                                  "AND size = ? AND mtime = ?", key)
+            row = row.fetchone()
+
+            if row:
+                self.hits = self.hits + 1
+                self._touched.add(key)
+                entry = {'path': path,
+                         'algorithm': row[0],
+                         'digest': row[1],
+                         'mime': row[2],
+                         'created': row[3]}
+            else:
+                self.misses = self.misses + 1
+                entry = {'path': path}
+
+        self._recent[path] = (key, entry)
+        if len(self._recent) > RECENT_SIZE:
+            self._recent.popitem(last=False)
+
+        return key, entry
+
+    def _store(self, path, **fields):
+        """ Update the cached fields for `path`. """
+        with self._lock:
+            key, entry = self._lookup(path)
+            entry.update(fields)
+            self._pending[key] = entry
+
+            if len(self._pending) >= FLUSH_EVERY:
+                self.flush()
+
+    def get_digest(self, path, algorithm):
+        """ Returns the cached digest of `path` produced by `algorithm`, or
+            `None`. """
+        _, entry = self._lookup(path)
+
+        if entry.get('algorithm') != algorithm:
+            return None
+
+        return entry.get('digest')
+
+    def set_digest(self, path, algorithm, digest):
+        """ Remember the `algorithm` digest of `path`. """
+        self._store(path, algorithm=algorithm, digest=digest)
+
+    def get_mime(self, path):
+        """ Returns the cached MIME type of `path`, or `None`. """
+        return self._lookup(path)[1].get('mime')
+
+    def set_mime(self, path, mime):
+        """ Remember the MIME type of `path`. """
+        self._store(path, mime=mime)
+
+    def get_date(self, path):
+        """ Returns a `(found, date)` tuple. `found` is `False` if nothing is
+            cached for `path`. Otherwise `date` is the cached creation
+            `datetime`, which may be `None` if the file has no date. """
+        created = self._lookup(path)[1].get('created')
+
+        if created is None:
+            return False, None
+
+        if not created:
+            return True, None
+
+        return True, datetime.strptime(created, DATE_FORMAT)
+
+    def set_date(self, path, created):
+        """ Remember the creation `datetime` of `path`. `None` records that
+            the file has no creation date. """
+        value = created.strftime(DATE_FORMAT) if created else ''
+        self._store(path, created=value)
+
+    def flush(self):
+        """ Write pending entries and access times to disk and evict the
+            least recently used entries if the cache is over capacity. """
+        with self._lock:
+            now = time.time()
+
+            for key, entry in self._pending.items():
+                # A path only ever has one valid entry.
+                self.db.execute("DELETE FROM entries WHERE path = ?",
+                                (entry['path'],))
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES " +
+                                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                key + (entry['path'],
+                                       entry.get('algorithm'),
+                                       entry.get('digest'),
+                                       entry.get('mime'),
+                                       entry.get('created'),
+                                       now))
+
+            self.db.executemany("UPDATE entries SET accessed = ? " +
+                                "WHERE dev = ? AND ino = ? AND size = ? " +
+                                "AND mtime = ?",
+                                [(now,) + k for k in self._touched
+                                 if k not in self._pending])
+
+            self._pending.clear()
+            self._touched.clear()
+            self._recent.clear()
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        """ Remove the least recently used entries above `max_entries`. """
+        count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        excess = count - self.max_entries
+
+        if excess > 0:
+            self.db.execute("DELETE FROM entries WHERE rowid IN (SELECT " +
+                            "rowid FROM entries ORDER BY accessed LIMIT ?)",
+                            (excess,))
+
+    def close(self):
+        """ Flush pending writes and close the database. """
+        with self._lock:
+            self.flush()
+            self.db.close()
+        logger.info(f"Cache: {self.hits} hits, {self.misses} misses")
@@ -1,5 +1,13 @@
+import logging
 import argparse
-from sortmedia.sort import SortMedia
+from sortmedia.hashing import DEFAULT_ALGORITHM, DEDUPE_MODES, \
+    available_algorithms
+from sortmedia.devices import READ_ORDERS
+from sortmedia.cache import DEFAULT_MAX_ENTRIES
+from sortmedia.watch import DEBOUNCE
+from sortmedia.similar import METHODS, DEFAULT_DISTANCE
+from sortmedia.probe import DEFAULT_PROBES, PROBE_TIMEOUT
+from sortmedia.transfer import SYNC_BATCH
 
 def main():
     parser = argparse.ArgumentParser()
@@ -15,12 +23,12 @@ def main():
                         help='Dry run - do not actually process files',
                         required=False,
                         default=False)
-    parser.add_argument('src',
-                        nargs='+',
-                        help='The media source directory to process')
-    parser.add_argument('dst',
-                        nargs='+',
-                        help='The destination directory to move or copy files')
+    parser.add_argument('paths',
+                        nargs='*',
+                        metavar='src',
+                        help='The media source directories, or zip and ' +
+                             'tar archives, to process, followed by the ' +
+                             'destination directory to move or copy files')
     parser.add_argument('-n',
                         '--noprocess',
                         help='List of directories to move but not recurse into ' +
@@ -30,11 +38,200 @@ def main():
                         '--excludes',
                         help='List of directories to skip completely',
                         type=str)
+    parser.add_argument('--hash',
+                        help='The digest algorithm used to detect duplicates',
+                        choices=available_algorithms(),
+                        required=False,
+                        default=DEFAULT_ALGORITHM)
+    parser.add_argument('--cache',
+                        nargs='?',
+                        const=True,
+                        metavar='PATH',
+                        help='Cache digests and metadata between runs, in ' +
+                             'PATH or in the destination directory',
+                        required=False,
+                        default=None)
+    parser.add_argument('--no-cache',
+                        action='store_const',
+                        const=False,
+                        dest='cache',
+                        help='Do not use a metadata cache')
+    parser.add_argument('--cache-size',
+                        help='Maximum number of files kept in the cache',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_MAX_ENTRIES)
+    parser.add_argument('--index',
+                        action='store_true',
+                        help='Index the destination contents to detect ' +
+                             'duplicates stored under any name or date',
+                        required=False,
+                        default=False)
+    parser.add_argument('--index-file',
+                        help='Persist the destination index to this file ' +
+                             'between runs (implies --index)',
+                        required=False,
+                        default=None)
+    parser.add_argument('--dedupe',
+                        help='How files are compared: hash everything ' +
+                             '(full) or compare by size and partial ' +
+                             'fingerprint before hashing (tiered)',
+                        choices=DEDUPE_MODES,
+                        required=False,
+                        default='full')
+    parser.add_argument('-j',
+                        '--jobs',
+                        help='Number of files to hash and parse in parallel ' +
+                             'on each source device',
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument('--filter-extensions',
+                        action='store_true',
+                        help='Only look at files with a known photo or ' +
+                             'video extension',
+                        required=False,
+                        default=False)
+    parser.add_argument('--follow-symlinks',
+                        action='store_true',
+                        help='Descend into symlinked directories of the ' +
+                             'sources',
+                        required=False,
+                        default=False)
+    parser.add_argument('--reflink',
+                        action='store_const',
+                        const='reflink',
+                        dest='copy_strategy',
+                        help='Copy files as copy-on-write clones where the ' +
+                             'filesystem supports it (implies --copy)')
+    parser.add_argument('--link',
+                        action='store_const',
+                        const='link',
+                        dest='copy_strategy',
+                        help='Hard link files instead of copying them where ' +
+                             'possible (implies --copy)')
+    parser.add_argument('--kernel-copy',
+                        action='store_const',
+                        const='kernel',
+                        dest='copy_strategy',
+                        help='Copy files inside the kernel with ' +
+                             'copy_file_range (implies --copy)')
+    parser.add_argument('--archive',
+                        action='store_true',
+                        help='Store each unique file once, named by its ' +
+                             'digest, in a content store in the destination ' +
+                             'and build the date tree from hard links to it',
+                        required=False,
+                        default=False)
+    parser.add_argument('--sync',
+                        help='Number of files moved to another filesystem ' +
+                             'per fsync batch. Their sources are removed ' +
+                             'once the batch is synced (0 does not sync)',
+                        type=int,
+                        required=False,
+                        default=SYNC_BATCH)
+    parser.add_argument('--journal',
+                        nargs='?',
+                        const=True,
+                        metavar='PATH',
+                        help='Record every move and copy in a journal, in ' +
+                             'PATH or in the destination directory',
+                        required=False,
+                        default=None)
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Finish an interrupted run from its journal, ' +
+                             'skipping files already handled (implies ' +
+                             '--journal)',
+                        required=False,
+                        default=False)
+    parser.add_argument('-w',
+                        '--watch',
+                        action='store_true',
+                        help='Keep running and sort new files as they ' +
+                             'arrive in the source directory (Linux only)',
+                        required=False,
+                        default=False)
+    parser.add_argument('--debounce',
+                        help='Seconds a new file must be left unchanged ' +
+                             'before it is sorted in watch mode',
+                        type=float,
+                        required=False,
+                        default=DEBOUNCE)
+    parser.add_argument('--stats',
+                        help='How run statistics are reported: logged ' +
+                             '(log) or printed to standard output as JSON ' +
+                             '(json)',
+                        choices=['log', 'json'],
+                        required=False,
+                        default='log')
+    parser.add_argument('--progress',
+                        action='store_true',
+                        help='Show progress and an ETA while sorting',
+                        required=False,
+                        default=False)
+    parser.add_argument('--plan',
+                        metavar='PATH',
+                        help='Write the plan of the run to PATH as JSON, or ' +
+                             'as CSV if PATH ends in .csv. With --dry the ' +
+                             'complete plan is computed but not applied',
+                        required=False,
+                        default=None)
+    parser.add_argument('--read-order',
+                        help='The order files on each source device are ' +
+                             'read in: as walked (walk), by position on ' +
+                             'disk (disk) or by position on spinning disks ' +
+                             'only (auto)',
+                        choices=READ_ORDERS,
+                        required=False,
+                        default='auto')
+    parser.add_argument('--probes',
+                        help='Number of ffprobe processes run at once for ' +
+                             'videos whose date cannot be read natively ' +
+                             '(0 runs them one at a time)',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_PROBES)
+    parser.add_argument('--probe-timeout',
+                        help='Seconds after which a hung ffprobe started ' +
+                             'by --probes is killed',
+                        type=float,
+                        required=False,
+                        default=PROBE_TIMEOUT)
+    parser.add_argument('--similar',
+                        nargs='?',
+                        const='dhash',
+                        help='Report near-duplicate photos, such as resized ' +
+                             'or re-encoded copies, using this perceptual ' +
+                             'hash (dhash by default)',
+                        choices=METHODS,
+                        required=False,
+                        default=None)
+    parser.add_argument('--similar-distance',
+                        help='Number of differing perceptual hash bits up ' +
+                             'to which two photos are similar',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_DISTANCE)
+    parser.add_argument('--apply',
+                        metavar='PATH',
+                        help='Apply a plan written by --plan, without ' +
+                             'recomputing it',
+                        required=False,
+                        default=None)
 
     args = parser.parse_args()
 
-    src = args.src[0]
-    dst = args.dst[0]
+    src = args.paths[:-1]
+    dst = args.paths[-1] if args.paths else None
+
+    if args.apply:
+        # A plan knows its sources. A destination is only needed for CSV
+        # plans, and may be given as the only positional argument.
+        if src:
+            parser.error('--apply takes at most a destination directory')
+    elif not src:
+        parser.error('the src and dst directories are required')
 
     if args.noprocess:
         args.noprocess = [x for x in args.noprocess.split(',')]
@@ -42,8 +239,48 @@ def main():
     if args.excludes:
         args.excludes = [x for x in args.excludes.split(',')]
 
+    if args.copy_strategy:
+        args.copy = True
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Imported once the arguments are known to be valid, so `--help` and
+    # usage errors do not wait for it.
+    from sortmedia.sort import SortMedia
+
     ms = SortMedia(dry=args.dry, 
                    copy=args.copy,
                    noprocess=args.noprocess,
-                   excludes=args.excludes)
-    ms.process_files(src, dst)
+                   excludes=args.excludes,
+                   algorithm=args.hash,
+                   cache=args.cache,
+                   cache_size=args.cache_size,
+                   index=args.index,
+                   index_file=args.index_file,
+                   dedupe=args.dedupe,
+                   jobs=args.jobs,
+                   filter_extensions=args.filter_extensions,
+                   copy_strategy=args.copy_strategy or 'copy',
+                   journal=args.journal,
+                   resume=args.resume,
+                   progress=args.progress,
+                   plan_file=args.plan,
+                   read_order=args.read_order,
+                   similar=args.similar,
+                   similar_distance=args.similar_distance,
+                   probes=args.probes,
+                   probe_timeout=args.probe_timeout,
+                   archive=args.archive,
+                   sync=args.sync,
+                   follow_symlinks=args.follow_symlinks)
+
+    try:
+        if args.apply:
+            ms.process_plan(args.apply, dst)
+        elif args.watch:
+            ms.watch(src, dst, debounce=args.debounce)
+        else:
+            ms.process_files(src, dst)
+    finally:
+        if args.stats == 'json':
+            print(ms.stats.to_json())
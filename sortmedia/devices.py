@@ -0,0 +1,183 @@
+import os
+import queue
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# The order in which files on one device are read: as walked, by their
+# position on disk, or by position on spinning disks only.
+READ_ORDERS = ['auto', 'walk', 'disk']
+
+# `ioctl` request returning the extents of a file (Linux).
+FS_IOC_FIEMAP = 0xC020660B
+
+# Size of `struct fiemap` and of one `struct fiemap_extent`.
+_FIEMAP = struct.Struct('=QQIIII')
+_EXTENT = struct.Struct('=QQQ16xI12x')
+
+# Entries sorted together when reading in disk order. Bounds the memory held
+# while still turning most of the seeks into a sweep.
+ORDER_BATCH = 4096
+
+# Items buffered between the device threads and the consumer of `merge`.
+MERGE_BUFFER = 64
+
+# Seconds between checks for a stopped `merge` while its buffer is full.
+_POLL = 0.1
+
+
+def device_of(path):
+    """ Returns the device number of the filesystem holding `path`. """
+    return os.stat(path).st_dev
+
+
+def group_by_device(paths):
+    """ Returns a dictionary of device number to the `paths` on it, in the
+        order given. """
+    groups = {}
+
+    for path in paths:
+        groups.setdefault(device_of(path), []).append(path)
+
+    return groups
+
+
+def is_rotational(dev):
+    """ Returns `True` if the block device `dev` is a spinning disk, `False`
+        if it is not and `None` if it cannot be told, such as on network or
+        virtual filesystems or outside Linux. """
+    base = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+
+    # A partition has no queue of its own; its disk is the parent entry.
+    for queue_dir in (os.path.join(base, 'queue'),
+                      os.path.join(base, '..', 'queue')):
+        try:
+            with open(os.path.join(queue_dir, 'rotational')) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+
+    return None
+
+
+def first_extent(path):
+    """ Returns the physical offset of the first extent of the file at
+        `path`, or `None` if the filesystem does not report it. """
+    import fcntl
+
+    request = bytearray(_FIEMAP.size + _EXTENT.size)
+    _FIEMAP.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+
+    if not _FIEMAP.unpack_from(request)[3]:
+        return None
+
+    return _EXTENT.unpack_from(request, _FIEMAP.size)[1]
+
+
+def _disk_key(path):
+    """ Sort key placing `path` by the position of its data, or by inode
+        where the filesystem does not report extents. """
+    physical = first_extent(path)
+
+    if physical is not None:
+        return 0, physical
+
+    try:
+        return 1, os.lstat(path).st_ino
+    except OSError:
+        return 2, 0
+
+
+def disk_order(entries, batch=ORDER_BATCH):
+    """ Yields the walked `(path, excluded)` `entries` reordered, `batch` at
+        a time, by where their data lies on disk. Excluded directories are
+        yielded first in each batch. Reading a spinning disk in this order
+        replaces most seeks with a sweep across the platter. """
+    pending = []
+
+    def flush():
+        pending.sort(key=lambda e: (-1, 0) if e[0][1] else e[1])
+        for entry, _ in pending:
+            yield entry
+        pending.clear()
+
+    for entry in entries:
+        key = None if entry[1] else _disk_key(entry[0])
+        pending.append((entry, key))
+
+        if len(pending) >= batch:
+            yield from flush()
+
+    yield from flush()
+
+
+def merge(iterables, size=MERGE_BUFFER):
+    """ Yields the items of all `iterables` as they are produced, consuming
+        each in its own thread. Items of one iterable keep their order. An
+        exception raised by an iterable is raised here, and the other
+        threads are stopped once the caller stops iterating.
+
+        @param  iterables   The iterables, typically one per device.
+        @param  size        Maximum number of items produced ahead of the
+                            caller. """
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                items.put(value, timeout=_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(iterable):
+        error = None
+        it = iter(iterable)
+
+        try:
+            for item in it:
+                if not put((item, None)):
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+        put((done, error))
+
+    threads = [threading.Thread(target=drain, args=(iterable,), daemon=True)
+               for iterable in iterables]
+
+    for thread in threads:
+        thread.start()
+
+    remaining = len(threads)
+
+    try:
+        while remaining:
+            item, error = items.get()
+
+            if item is done:
+                remaining = remaining - 1
+                if error is not None:
+                    raise error
+                continue
+
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,178 @@
+import struct
+
+# The date tags `Photo.parse_date` looks for, by TIFF tag number.
+DATE_TAGS = {
+    0x0132: 'DateTime',
+    0x9003: 'DateTimeOriginal',
+    0x9004: 'DateTimeDigitized',
+}
+
+EXIF_IFD_POINTER = 0x8769
+ASCII = 2
+
+EXIF_HEADER = b'Exif\x00\x00'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Upper bound on the number of IFD entries read, to stop on corrupt data.
+MAX_ENTRIES = 1024
+
+
+class ExifError(Exception):
+    """ Raised when metadata cannot be parsed. Callers fall back to a full
+        decoder. """
+
+
+class _Tiff:
+    """ A minimal reader for the IFDs of a TIFF structure. Only the date tags
+        are decoded. """
+
+    def __init__(self, read):
+        """ @param  read    A callable `read(offset, n)` returning `n` bytes
+                            at `offset` from the start of the TIFF header. """
+        self.read = read
+        order = read(0, 4)
+
+        if order == b'II*\x00':
+            self.endian = '<'
+        elif order == b'MM\x00*':
+            self.endian = '>'
+        else:
+            raise ExifError("Not a TIFF header.")
+
+    def unpack(self, fmt, data):
+        return struct.unpack(self.endian + fmt, data)
+
+    def ifd(self, offset, tags):
+        """ Returns a dictionary of the `tags` found in the IFD at `offset`,
+            and the offset of the Exif sub-IFD if there is one. """
+        count, = self.unpack('H', self.read(offset, 2))
+
+        if count > MAX_ENTRIES:
+            raise ExifError("Too many IFD entries.")
+
+        data = self.read(offset + 2, count * 12)
+        found = {}
+        exif_ifd = None
+
+        for i in range(count):
+            tag, kind, n, value = self.unpack('HHI4s', data[i*12:i*12 + 12])
+
+            if tag == EXIF_IFD_POINTER:
+                exif_ifd, = self.unpack('I', value)
+            elif tag in tags and kind == ASCII:
+                if n > 4:
+                    value = self.read(self.unpack('I', value)[0], n)
+                found[tags[tag]] = value[:n].rstrip(b'\x00 ').decode(
+                    'ascii', 'replace')
+
+        return found, exif_ifd
+
+    def dates(self):
+        """ Returns the date tags of IFD0 and the Exif IFD. Values in the
+            Exif IFD take precedence, as they do with PIL. """
+        offset, = self.unpack('I', self.read(4, 4))
+        found, exif_ifd = self.ifd(offset, DATE_TAGS)
+
+        if exif_ifd:
+            found.update(self.ifd(exif_ifd, DATE_TAGS)[0])
+
+        return found
+
+
+def _exact(fp, n):
+    data = fp.read(n)
+    if len(data) != n:
+        raise ExifError("Unexpected end of file.")
+    return data
+
+
+def parse_tiff(data):
+    """ Returns the date tags of the TIFF structure held in `data`, which
+        starts with the TIFF byte order mark. """
+    def read(offset, n):
+        if offset + n > len(data):
+            raise ExifError("Offset outside of the EXIF block.")
+        return data[offset:offset + n]
+
+    return _Tiff(read).dates()
+
+
+def read_tiff(fp):
+    """ Returns the date tags of the TIFF file `fp`, reading only the IFDs. """
+    def read(offset, n):
+        fp.seek(offset)
+        return _exact(fp, n)
+
+    return _Tiff(read).dates()
+
+
+def read_jpeg(fp):
+    """ Returns the date tags of the JPEG file `fp`. Only the marker headers
+        and the APP1 Exif segment are read. """
+    if _exact(fp, 2) != b'\xff\xd8':
+        raise ExifError("Not a JPEG file.")
+
+    while True:
+        marker, length = struct.unpack('>2sH', _exact(fp, 4))
+
+        if marker[0] != 0xff:
+            raise ExifError("Invalid JPEG marker.")
+
+        # Start of scan: no metadata follows.
+        if marker[1] == 0xda:
+            return {}
+
+        if marker[1] == 0xe1:
+            segment = _exact(fp, length - 2)
+            if segment.startswith(EXIF_HEADER):
+                return parse_tiff(segment[len(EXIF_HEADER):])
+        else:
+            fp.seek(length - 2, 1)
+
+
+def read_png(fp):
+    """ Returns the date tags of the PNG file `fp`. Only chunk headers and the
+        eXIf chunk are read. """
+    if _exact(fp, 8) != PNG_SIGNATURE:
+        raise ExifError("Not a PNG file.")
+
+    while True:
+        length, kind = struct.unpack('>I4s', _exact(fp, 8))
+
+        if kind == b'IEND':
+            return {}
+
+        if kind == b'eXIf':
+            return parse_tiff(_exact(fp, length))
+
+        # Skip the chunk data and its CRC.
+        fp.seek(length + 4, 1)
+
+
+_READERS = {
+    'image/jpeg': read_jpeg,
+    'image/png': read_png,
+    'image/tiff': read_tiff,
+}
+
+
+def read_dates(fp, mime):
+    """ Returns the EXIF date tags of the image `fp` as a dictionary keyed by
+        tag name, without decoding the image. Returns `None` if `mime` is not
+        supported or the metadata could not be parsed.
+
+        @param  fp      A seekable binary file object, positioned anywhere.
+        @param  mime    The MIME type of the image. """
+    reader = _READERS.get(mime)
+
+    if not reader:
+        return None
+
+    fp.seek(0)
+
+    try:
+        return reader(fp)
+    except (ExifError, struct.error, UnicodeDecodeError):
+        return None
+    finally:
+        fp.seek(0)
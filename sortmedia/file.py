@@ -1,57 +1,204 @@
 import os
-import shutil
-import hashlib
 import logging
 
-from sortmedia.util import Safety
+from sortmedia.util import Safety, HeadReader
+from sortmedia.transfer import copy_file, move_file
+from sortmedia.hashing import DEFAULT_ALGORITHM, PARTIAL_SIZE, hash_fp, \
+    hash_file, hash_bytes, partial_hash_fp, partial_hash_file
 from abc import ABC
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+# Marks a value which has not been computed yet, as `None` is meaningful.
+_UNSET = object()
 
 
 class File(ABC):
     """ Represents a media file on disk. Tracks the MIME type, EXIF data and
-        an open file handle. Provides several functions for interacting with
-        the EXIF data and moving/copying the files. """
-
-    def __init__(self, path, mime, exif=None):
-        """ Create a new `File` object for the file data located at `path` and
-            which is represented by the open file pointer `fp`.
-
-            @param  path    The path to the target file.
-            @param  mime    The string MIME type of the file.
-            @param  exif    A dictionary of EXIF value. """
-
-        if not os.path.exists(path):
+        a file handle. Provides several functions for interacting with the
+        EXIF data and moving/copying the files.
+
+        Nothing is read from disk until it is needed: the handle is opened on
+        first use and the digest is computed on first access. A `File` can be
+        used as a context manager to close the handle as soon as it is no
+        longer needed. """
+
+    def __init__(self, path, mime, exif=None, algorithm=DEFAULT_ALGORITHM,
+                 cache=None, tiered=False, fp=None, head=None, digest=None):
+        """ Create a new `File` object for the file data located at `path`.
+
+            @param  path        The path to the target file.
+            @param  mime        The string MIME type of the file.
+            @param  exif        A dictionary of EXIF value, if already
+                                read. Only its date is kept.
+            @param  algorithm   The digest algorithm used to hash the file. The
+                                name is kept alongside the digest in
+                                `self.algorithm`.
+            @param  cache       An optional `MetadataCache` consulted before
+                                hashing or reading metadata.
+            @param  tiered      Compare the file with existing files by size,
+                                then by a partial fingerprint and only then
+                                by digest.
+            @param  fp          An already open binary handle for `path`.
+            @param  head        The first bytes of the file, if already read.
+                                Metadata within them is parsed without
+                                reading the file again, and the digest
+                                continues from where they end.
+            @param  digest      The digest of the file, if it was computed
+                                while the file was written. """
+        self._fp = fp
+        self.head = head
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
             raise RuntimeError(f"The path `{path}` does not exist.")
 
         self.path = path
-        self.fp = open(path, 'rb')
-        self.hash = self.get_hash()
-        self.exif = None
+        self.algorithm = algorithm
+        self.cache = cache
+        self.size = st.st_size
+        self.tiered = tiered
+        self._hash = digest
+        self._partial = None
         self.mime = mime
+        self._created = _UNSET
+
+        if exif:
+            self._created = self.parse_date(exif)
+
+        # Set when the metadata had to be read by an external tool.
+        self.probed = False
+
+        # The perceptual hash of an image, when near-duplicates are looked
+        # for. See `similar.perceptual_hash`.
+        self.perceptual = None
 
         super().__init__()
 
     def __del__(self):
         """ Closes the open file pointer on object destruct. """
-        self.fp.close()
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def fp(self):
+        """ A binary file handle for the file, opened on first use. """
+        if self._fp is None:
+            self._fp = open(self.path, 'rb')
+        return self._fp
+
+    def close(self):
+        """ Close the file handle, if open, and drop the header buffer. The
+            file is reopened if needed again. """
+        if getattr(self, '_fp', None) is not None:
+            self._fp.close()
+            self._fp = None
+        self.head = None
+
+    def reader(self):
+        """ Returns a seekable file object for reading metadata. Reads are
+            served from the header buffer where possible. """
+        if self.head is None:
+            return self.fp
+        return HeadReader(self.head, self.size, lambda: self.fp)
+
+    @property
+    def hash(self):
+        """ The digest of the file, computed on first use. """
+        if self._hash is None:
+            self._hash = self.get_hash()
+        return self._hash
+
+    def partial_hash(self):
+        """ Returns the partial fingerprint of the file. See
+            `hashing.partial_hash_fp`. """
+        if self._partial is None:
+            self._partial = partial_hash_fp(self.fp, self.size,
+                                            self.algorithm)
+        return self._partial
 
     def get_hash(self):
-        """ Returns the hash of the file pointer. """
-        m = hashlib.sha256()
-        m.update(self.fp.read())
-        h = m.digest()
-        self.fp.seek(0)
+        """ Returns the hash of the file pointer. The file is read in fixed
+            size blocks so memory use does not grow with the file size. """
+        if self.cache:
+            h = self.cache.get_digest(self.path, self.algorithm)
+            if h:
+                return h
+
+        if self.head is not None and len(self.head) >= self.size:
+            h = hash_bytes(self.head, self.algorithm)
+        elif self.head is not None:
+            self.fp.seek(len(self.head))
+            h = hash_fp(self.fp, self.algorithm, prefix=self.head)
+        else:
+            self.fp.seek(0)
+            h = hash_fp(self.fp, self.algorithm)
+
+        if self._fp is not None:
+            self._fp.seek(0)
+
+        if self.cache:
+            self.cache.set_digest(self.path, self.algorithm, h)
+
         return h
 
+    def date_known(self):
+        """ Returns `True` if the creation date is known without reading the
+            file's metadata, loading it from the cache if possible. """
+        if self._created is not _UNSET:
+            return True
+
+        if self.cache:
+            found, created = self.cache.get_date(self.path)
+            if found:
+                self._created = created
+                return True
+
+        return False
+
+    def set_created(self, created):
+        """ Set the creation `datetime` of the file, for example after it was
+            read by another process, and store it in the cache. """
+        self._created = created
+
+        if self.cache:
+            self.cache.set_date(self.path, created)
+
+    def created(self):
+        """ Returns the creation `datetime` of the file, or `None` if it
+            cannot be determined. The EXIF data is only read if the date is
+            not already cached, and only the date is kept. """
+        if self.date_known():
+            return self._created
+
+        exif = self.get_exif()
+        self.set_created(self.parse_date(exif) if exif else None)
+        return self._created
+
     def creation_date(self):
-        """ This method should be implemented by the inheriting class. The
-            child class should call this function to ensure that the EXIF data
-            is populated. """
-        if not self.exif:
-            self.exif = self.get_exif()
+        """ Returns the creation date as a dictionary of `year`, `month` and
+            `day` strings, or `None` if the file has no creation date. """
+        parsed = self.created()
+
+        if not parsed:
+            return None
+
+        return {
+            'year': str(parsed.year),
+            'month': str(parsed.strftime("%B")),
+            'day': str(parsed.day)
+        }
+
+    def parse_date(self, exif):
+        """ Returns the creation `datetime` found in `exif`, or `None`. This
+            should be implemented in the inheriting class. """
+        raise NotImplementedError()
 
     def __path_from_date(self, root, name):
         """ Returns a path based on the given creation date, in the format of:
@@ -80,12 +227,20 @@ class File(ABC):
 
             @returns    `True` if the path's hash matches the objects hash,
                         `False` otherwise. """
-        with open(path, "rb") as f:
-            m = hashlib.sha256()
-            m.update(f.read())
-            return self.hash == m.digest()
+        if self.tiered:
+            if os.path.getsize(path) != self.size:
+                return False
+
+            # Below this size the partial fingerprint reads the whole file
+            # anyway.
+            if self.size > 2 * PARTIAL_SIZE and \
+               self.partial_hash() != partial_hash_file(path,
+                                                        self.algorithm):
+                return False
+
+        return self.hash == hash_file(path, self.algorithm)
 
-    def write_check(self, path):
+    def write_check(self, path, index=None):
         """ Runs some preliminary checks to ensure that we do not accidentally
             overwrite an existing file. If a file exists at `path` we check
             its hash. If the hashes match, we return `IDENTICAL`. If they do
@@ -93,8 +248,16 @@ class File(ABC):
             to this path. If no file exists at `path` we return `SAFE`.
 
             @param  path    The path to check.
+            @param  index   An optional `ContentIndex` of the destination. The
+                            digest of an indexed file is taken from the index
+                            instead of reading the file.
 
             @returns    `Safety` """
+        known = index.digest_of(path) if index is not None else None
+
+        if known is not None:
+            return Safety.IDENTICAL if known == self.hash else Safety.UNSAFE
+
         if os.path.exists(path):
             if not self.hashes_match(path):
                 return Safety.UNSAFE
@@ -102,27 +265,42 @@ class File(ABC):
                 return Safety.IDENTICAL
         return Safety.SAFE
 
-    def target_path(self, root):
+    def target_path(self, root, index=None, names=None):
         """ Creates a "safe" target path by performing some basic checks. If
             a file exists at the target path with a non-identical hash we
             create a new file with a `_N` prefix (where `N` is an integer
             value).
 
             @param  root    The root path to set the target path in.
+            @param  index   An optional `ContentIndex` of `root`. If the file's
+                            content is already stored anywhere under `root`
+                            the file is treated as a duplicate.
+            @param  names   An optional `NameIndex` of the destination. A
+                            free name is then found without probing each
+                            `_N` suffix, and the target is reserved in it
+                            for files planned later.
 
             @returns    An absolute path to write a file to. """
-        name, ext = os.path.splitext(os.path.basename(self.fp.name))
+        if index is not None and index.find(self):
+            return None
+
+        name, ext = os.path.splitext(os.path.basename(self.path))
+
+        if names is not None:
+            directory = os.path.dirname(self.__path_from_date(root, name))
+            return names.allocate(self, directory, name, ext)
+
         mod = ''
         i = 1
         path = self.__path_from_date(root, f"{name}{mod}{ext}")
 
-        check = self.write_check(path)
+        check = self.write_check(path, index)
 
         while check == Safety.UNSAFE:
             mod = f'_{i}'
 
             path = self.__path_from_date(root, f"{name}{mod}{ext}")
-            check = self.write_check(path)
+            check = self.write_check(path, index)
             i = i + 1
 
         if check == Safety.SAFE:
@@ -142,24 +320,60 @@ class File(ABC):
         if not os.path.exists(dirs):
             os.makedirs(dirs)
 
-    def move(self, root):
-        """ Safely move this file to the target path. """
-        target = self.target_path(root)
+    def move_to(self, target, index=None):
+        """ Move this file to `target`, which should come from `target_path`.
+            Across filesystems the copy is checked against the digest and
+            synced before the file is removed.
+
+            @param  target  The path to move the file to.
+            @param  index   An optional `ContentIndex` updated with the new
+                            file. """
+        self.make_nested_dirs(target)
+        self.close()
+        move_file(self.path, target, self._hash, self.algorithm)
+        if index is not None:
+            index.add(target, self.size, self._hash)
+
+    def copy_to(self, target, index=None, strategy='copy'):
+        """ Copy this file to `target`, which should come from `target_path`.
+
+            @param  target      The path to copy the file to.
+            @param  index       An optional `ContentIndex` updated with the
+                                new file.
+            @param  strategy    How the data is copied, one of
+                                `transfer.COPY_STRATEGIES`. Falls back to a
+                                plain copy if the filesystem cannot do it. """
+        self.make_nested_dirs(target)
+        copy_file(self.path, target, strategy)
+        if index is not None:
+            index.add(target, self.size, self._hash)
+
+    def move(self, root, index=None):
+        """ Safely move this file to the target path.
+
+            @param  root    The root path to move the file into.
+            @param  index   An optional `ContentIndex` of `root`, used to find
+                            duplicates and updated with the new file. """
+        target = self.target_path(root, index)
 
         if target:
-            self.make_nested_dirs(target)
-            shutil.move(self.fp.name, target)
+            self.move_to(target, index)
             return True
 
         return False
 
-    def copy(self, root):
-        """ Safely copy this file to the target path. """
-        target = self.target_path(root)
+    def copy(self, root, index=None, strategy='copy'):
+        """ Safely copy this file to the target path.
+
+            @param  root        The root path to copy the file into.
+            @param  index       An optional `ContentIndex` of `root`, used to
+                                find duplicates and updated with the new file.
+            @param  strategy    How the data is copied, one of
+                                `transfer.COPY_STRATEGIES`. """
+        target = self.target_path(root, index)
 
         if target:
-            self.make_nested_dirs(target)
-            shutil.copyfile(self.fp.name, target)
+            self.copy_to(target, index, strategy)
             return True
 
         return False
@@ -0,0 +1,187 @@
+import os
+import mmap
+import hashlib
+
+DEFAULT_ALGORITHM = 'sha256'
+
+# Size of each block fed to the digest. Memory used while hashing is bounded
+# by this value regardless of the size of the file.
+CHUNK_SIZE = 1024 * 1024
+
+# Files at least this large are hashed through `mmap` which avoids copying
+# every block into a Python `bytes` object before it reaches the digest.
+MMAP_THRESHOLD = 8 * CHUNK_SIZE
+
+# Number of bytes read from each end of a file for its partial fingerprint.
+PARTIAL_SIZE = 64 * 1024
+
+# How files are compared for duplicates: `full` hashes every file, `tiered`
+# compares sizes and partial fingerprints before hashing.
+DEDUPE_MODES = ['full', 'tiered']
+
+
+def _xxh3():
+    import xxhash
+    return xxhash.xxh3_128()
+
+
+def _blake3():
+    import blake3
+    return blake3.blake3()
+
+
+# Maps an algorithm name to a factory returning a new hash object. Optional
+# algorithms are only listed by `available_algorithms` if their module can be
+# imported.
+_ALGORITHMS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'xxh3': _xxh3,
+    'blake3': _blake3,
+}
+
+
+def available_algorithms():
+    """ Returns a list of the digest algorithms usable on this system. """
+    available = []
+
+    for name, factory in _ALGORITHMS.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        available.append(name)
+
+    return available
+
+
+def new_hasher(algorithm=DEFAULT_ALGORITHM):
+    """ Returns a new hash object for `algorithm`.
+
+        @param  algorithm   The name of the digest algorithm.
+
+        @returns    An object providing `update` and `digest`. """
+    if algorithm not in _ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm `{algorithm}`.")
+
+    try:
+        return _ALGORITHMS[algorithm]()
+    except ImportError:
+        raise ValueError(f"The hash algorithm `{algorithm}` is not " +
+                         "installed.")
+
+
+def _update_mmap(m, fp, start, size):
+    """ Feed the contents of `fp` from `start` to `size` to the hash object
+        `m` through a read only memory map. """
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+
+        view = memoryview(mm)
+        try:
+            for offset in range(start, size, CHUNK_SIZE):
+                m.update(view[offset:offset + CHUNK_SIZE])
+        finally:
+            view.release()
+
+
+def _update_chunked(m, fp):
+    """ Feed the contents of `fp` to the hash object `m` one block at a time,
+        reusing a single buffer. """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+
+    while True:
+        n = fp.readinto(buf)
+        if not n:
+            break
+        m.update(view[:n])
+
+
+def hash_fp(fp, algorithm=DEFAULT_ALGORITHM, prefix=b''):
+    """ Returns the digest of the data read from the binary file pointer `fp`,
+        starting at its current position. Memory usage stays constant no
+        matter how large the file is.
+
+        @param  fp          An open binary file object.
+        @param  algorithm   The name of the digest algorithm.
+        @param  prefix      Bytes preceding the current position which were
+                            already read, for example the header used for MIME
+                            detection. They are hashed first and not read
+                            again.
+
+        @returns    The digest as `bytes`. """
+    m = new_hasher(algorithm)
+    m.update(prefix)
+
+    try:
+        fileno = fp.fileno()
+        start = fp.tell()
+        size = os.fstat(fileno).st_size
+    except (AttributeError, OSError):
+        start = size = 0
+
+    if size - start >= MMAP_THRESHOLD:
+        try:
+            _update_mmap(m, fp, start, size)
+            return m.digest()
+        except (OSError, ValueError):
+            # Not every file can be mapped (pipes, some network mounts). Fall
+            # back to plain reads from a fresh hasher.
+            m = new_hasher(algorithm)
+            m.update(prefix)
+            fp.seek(start)
+
+    _update_chunked(m, fp)
+    return m.digest()
+
+
+def hash_bytes(data, algorithm=DEFAULT_ALGORITHM):
+    """ Returns the digest of `data`. """
+    m = new_hasher(algorithm)
+    m.update(data)
+    return m.digest()
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM):
+    """ Returns the digest of the file located at `path`.
+
+        @param  path        The path to the file to hash.
+        @param  algorithm   The name of the digest algorithm.
+
+        @returns    The digest as `bytes`. """
+    with open(path, 'rb') as fp:
+        return hash_fp(fp, algorithm)
+
+
+def partial_hash_fp(fp, size, algorithm=DEFAULT_ALGORITHM):
+    """ Returns a fingerprint of the first and last `PARTIAL_SIZE` bytes of
+        `fp` and its `size`. Files with different fingerprints are never
+        identical, files with equal fingerprints might be.
+
+        @param  fp          An open, seekable binary file object.
+        @param  size        The size of the file in bytes.
+        @param  algorithm   The name of the digest algorithm.
+
+        @returns    The fingerprint as `bytes`. """
+    m = new_hasher(algorithm)
+    m.update(size.to_bytes(8, 'little'))
+
+    fp.seek(0)
+    m.update(fp.read(PARTIAL_SIZE))
+
+    if size > PARTIAL_SIZE:
+        fp.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+        m.update(fp.read(PARTIAL_SIZE))
+
+    fp.seek(0)
+    return m.digest()
+
+
+def partial_hash_file(path, algorithm=DEFAULT_ALGORITHM):
+    """ Returns the partial fingerprint of the file located at `path`. See
+        `partial_hash_fp`. """
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        return partial_hash_fp(fp, size, algorithm)
@@ -0,0 +1,257 @@
+import os
+import json
+import logging
+
+from sortmedia.hashing import DEFAULT_ALGORITHM, PARTIAL_SIZE, hash_file, \
+    partial_hash_file
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the persisted index changes.
+INDEX_VERSION = 2
+
+# Files sortmedia keeps in the destination for itself are never indexed.
+RESERVED_PREFIX = '.sortmedia'
+
+
+class ContentIndex:
+    """ An index of the file contents stored under a destination directory.
+
+        Maps each digest to the path holding those bytes (and each path back
+        to its digest) so asking whether a file is already archived, or
+        whether an existing file is identical to a new one, is a dictionary
+        lookup rather than a read of the destination file.
+
+        In tiered mode files are only indexed by size up front. A digest is
+        computed for a stored file once a new file of the same size, and the
+        same partial fingerprint, needs to be compared with it. """
+
+    def __init__(self, root, algorithm=DEFAULT_ALGORITHM, path=None,
+                 cache=None, tiered=False):
+        """ Create an empty index of `root`. Call `build` to populate it.
+
+            @param  root        The destination directory to index.
+            @param  algorithm   The digest algorithm of the indexed digests.
+            @param  path        Optional file the index is loaded from and
+                                saved to between runs.
+            @param  cache       An optional `MetadataCache` used when hashing
+                                files not yet in the index.
+            @param  tiered      Defer hashing stored files until a file with
+                                the same size is looked up. """
+        self.root = root
+        self.algorithm = algorithm
+        self.path = path
+        self.cache = cache
+        self.tiered = tiered
+        self.by_digest = {}
+        self.by_path = {}
+        self.by_size = {}
+        self.sizes = {}
+        self._partials = {}
+
+        # The modification times, in nanoseconds, of the entries loaded from
+        # `path`. An entry whose file has changed since is indexed again.
+        self._mtimes = {}
+
+    def __len__(self):
+        return len(self.by_path)
+
+    def add(self, path, size, digest=None, partial=None):
+        """ Record that `path` holds `size` bytes with the content identified
+            by `digest`. In tiered mode `digest` may be `None`. `partial` is
+            its partial fingerprint, if known, for a file which will only be
+            written to `path` later. """
+        path = os.path.normpath(path)
+
+        if path in self.by_path:
+            self.remove(path)
+
+        self.by_path[path] = digest
+        self.sizes[path] = size
+        self.by_size.setdefault(size, []).append(path)
+
+        if partial is not None:
+            self._partials[path] = partial
+
+        if digest is not None:
+            self.by_digest.setdefault(digest, path)
+
+    def remove(self, path):
+        """ Forget `path`, for example after it was deleted. """
+        path = os.path.normpath(path)
+
+        if path not in self.by_path:
+            return
+
+        digest = self.by_path.pop(path)
+        size = self.sizes.pop(path)
+        self._partials.pop(path, None)
+
+        paths = self.by_size[size]
+        paths.remove(path)
+        if not paths:
+            del self.by_size[size]
+
+        if digest is not None and self.by_digest.get(digest) == path:
+            del self.by_digest[digest]
+
+            # Another copy of the same content may still be stored.
+            for other in paths:
+                if self.by_path[other] == digest:
+                    self.by_digest[digest] = other
+                    break
+
+    def lookup(self, digest):
+        """ Returns a path under the root holding the content `digest`, or
+            `None` if no hashed entry holds it. """
+        return self.by_digest.get(digest)
+
+    def find(self, file):
+        """ Returns a path under the root holding the same content as the
+            `File` `file`, or `None` if it is not archived. In tiered mode
+            only stored files of the same size are compared, and only those
+            with the same partial fingerprint are hashed. """
+        if not self.tiered:
+            return self.lookup(file.hash)
+
+        for path in list(self.by_size.get(file.size, ())):
+            if file.size > 2 * PARTIAL_SIZE and \
+               self._partial(path) != file.partial_hash():
+                continue
+
+            if self._digest(path) == file.hash:
+                return path
+
+        return None
+
+    def digest_of(self, path):
+        """ Returns the indexed digest of `path`, or `None` if unknown. """
+        return self.by_path.get(os.path.normpath(path))
+
+    def _partial(self, path):
+        if path not in self._partials:
+            self._partials[path] = partial_hash_file(path, self.algorithm)
+        return self._partials[path]
+
+    def _digest(self, path):
+        """ Returns the digest of the indexed `path`, hashing it if needed. """
+        digest = self.by_path[path]
+
+        if digest is None:
+            digest = self._hash(path)
+            self.by_path[path] = digest
+            self.by_digest.setdefault(digest, path)
+
+        return digest
+
+    def _hash(self, path):
+        if self.cache:
+            digest = self.cache.get_digest(path, self.algorithm)
+            if digest:
+                return digest
+
+        digest = hash_file(path, self.algorithm)
+
+        if self.cache:
+            self.cache.set_digest(path, self.algorithm, digest)
+
+        return digest
+
+    def _walk(self):
+        """ Yields the path of every indexable file under the root. """
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith(RESERVED_PREFIX)]
+
+            for name in filenames:
+                if not name.startswith(RESERVED_PREFIX):
+                    yield os.path.normpath(os.path.join(dirpath, name))
+
+    def build(self):
+        """ Populate the index. A persisted index is loaded first, so only
+            files added to the destination, or changed, since it was saved
+            are hashed, and entries for files which no longer exist are
+            dropped. """
+        self.load()
+
+        seen = set()
+        added = 0
+
+        for path in self._walk():
+            seen.add(path)
+            st = os.stat(path)
+
+            if path not in self.by_path or \
+                    self.sizes[path] != st.st_size or \
+                    self._mtimes.get(path) != st.st_mtime_ns:
+                self.add(path, st.st_size)
+                added = added + 1
+
+        self._mtimes.clear()
+
+        for path in [p for p in self.by_path if p not in seen]:
+            self.remove(path)
+
+        if not self.tiered:
+            for path in list(self.by_path):
+                self._digest(path)
+
+        logger.info(f"Index: {len(self)} files in `{self.root}`, " +
+                    f"{added} new")
+
+    def load(self):
+        """ Load the persisted index, if any. An index written with another
+            algorithm or version is ignored. """
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError:
+            logger.warning(f"Ignoring unreadable index `{self.path}`.")
+            return
+
+        if data.get('version') != INDEX_VERSION or \
+           data.get('algorithm') != self.algorithm:
+            logger.info(f"Ignoring index `{self.path}` built with a " +
+                        "different algorithm or version.")
+            return
+
+        for relpath, (size, digest, mtime) in data.get('entries',
+                                                       {}).items():
+            path = os.path.normpath(os.path.join(self.root, relpath))
+            self.add(path, size, bytes.fromhex(digest) if digest else None)
+            self._mtimes[path] = mtime
+
+    def save(self):
+        """ Persist the index to `self.path`, if set. """
+        if not self.path:
+            return
+
+        entries = {}
+
+        for path, digest in self.by_path.items():
+            # Files written during the run are stat'ed now, once complete.
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            entries[os.path.relpath(path, self.root)] = \
+                [self.sizes[path], digest.hex() if digest else None, mtime]
+
+        data = {
+            'version': INDEX_VERSION,
+            'algorithm': self.algorithm,
+            'entries': entries,
+        }
+
+        dirs = os.path.dirname(self.path)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
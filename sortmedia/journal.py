@@ -0,0 +1,174 @@
+import os
+import json
+import logging
+
+from sortmedia.hashing import hash_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAME = '.sortmedia-journal.jsonl'
+
+PLANNED = 'planned'
+DONE = 'done'
+DUPLICATE = 'duplicate'
+
+
+class Journal:
+    """ An append-only log of the operations of a run, one JSON object per
+        line. An operation is written as `planned` before a file is moved or
+        copied and as `done` (or `duplicate`) afterwards, so an interrupted
+        run can be resumed: finished files are skipped and half-finished
+        moves are verified and completed or rolled back. """
+
+    def __init__(self, path, algorithm):
+        """ Open the journal at `path` for appending.
+
+            @param  path        Path to the journal file.
+            @param  algorithm   The digest algorithm of recorded digests. """
+        self.path = path
+        self.algorithm = algorithm
+        self.finished = {}
+
+        dirs = os.path.dirname(path)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+
+        self.fp = open(path, 'a')
+
+    def _write(self, entry):
+        self.fp.write(json.dumps(entry) + '\n')
+        self.fp.flush()
+
+    def record(self, status, op, src, size, digest=None, target=None,
+               store=None):
+        """ Append an entry for the source file `src`.
+
+            @param  status  `PLANNED`, `DONE` or `DUPLICATE`.
+            @param  op      `move` or `copy`.
+            @param  src     The file being processed.
+            @param  size    Its size in bytes.
+            @param  digest  Its digest, if known.
+            @param  target  The destination path, if any.
+            @param  store   The store path `target` is a hard link to, in
+                            archive mode. """
+        try:
+            mtime = os.stat(src).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        self._write({
+            'status': status,
+            'op': op,
+            'src': os.path.abspath(src),
+            'size': size,
+            'mtime': mtime,
+            'digest': digest.hex() if digest else None,
+            'algorithm': self.algorithm,
+            'target': os.path.abspath(target) if target else None,
+            'store': os.path.abspath(store) if store else None,
+        })
+
+    def load(self):
+        """ Returns the last entry of every source in the journal. """
+        last = {}
+
+        if not os.path.exists(self.path):
+            return last
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by the interruption.
+                    continue
+                last[entry['src']] = entry
+
+        return last
+
+    def _verify(self, entry):
+        """ Returns `True` if the target of a `planned` entry holds the
+            complete file. """
+        target = entry['target']
+        src = entry['src']
+
+        if not target or not os.path.exists(target):
+            return False
+
+        # A move only removes the source once the target is complete.
+        if not os.path.exists(src):
+            return entry['op'] == 'move'
+
+        if os.path.getsize(target) != entry['size']:
+            return False
+
+        digest = entry.get('digest')
+        if digest and entry.get('algorithm') == self.algorithm:
+            expected = bytes.fromhex(digest)
+        else:
+            expected = hash_file(src, self.algorithm)
+
+        return hash_file(target, self.algorithm) == expected
+
+    def _relink(self, entry):
+        """ Link the target of an archive entry which was interrupted after
+            its content was stored but before it was linked. """
+        target = entry['target']
+        stored = entry.get('store')
+
+        if not target or not stored or os.path.lexists(target) or \
+                not os.path.exists(stored):
+            return
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.link(stored, target)
+
+    def recover(self):
+        """ Load the journal and repair operations which were interrupted.
+            A verified move has its source removed and a verified copy is
+            marked finished. A partially written target is removed so the
+            source is processed again.
+
+            @returns    The number of operations recovered. """
+        recovered = 0
+
+        for src, entry in self.load().items():
+            if entry['status'] != PLANNED:
+                self.finished[src] = entry
+                continue
+
+            self._relink(entry)
+
+            if self._verify(entry):
+                if entry['op'] == 'move' and os.path.exists(src):
+                    os.remove(src)
+                logger.info(f"{src} -- RECOVERED")
+                entry = dict(entry, status=DONE)
+                self._write(entry)
+                self.finished[src] = entry
+                recovered = recovered + 1
+            elif entry['target'] and os.path.exists(entry['target']) and \
+                    os.path.exists(src):
+                logger.info(f"{entry['target']} -- INCOMPLETE, REMOVED")
+                os.remove(entry['target'])
+
+        return recovered
+
+    def is_finished(self, path):
+        """ Returns `True` if `path` was already handled by a previous run
+            and has not changed since. Costs a single `stat`. """
+        entry = self.finished.get(os.path.abspath(path))
+
+        if not entry:
+            return False
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+
+        return st.st_size == entry['size'] and \
+            entry['mtime'] == st.st_mtime_ns
+
+    def close(self):
+        self.fp.close()
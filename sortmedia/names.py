@@ -0,0 +1,144 @@
+import os
+
+from sortmedia.hashing import DEFAULT_ALGORITHM, PARTIAL_SIZE, hash_file, \
+    partial_hash_file
+
+
+class _Slot:
+    """ A name in a collision chain: an existing file, or a target planned
+        for the source file `source`. """
+
+    __slots__ = ('path', 'size', 'digest', 'partial', 'source')
+
+    def __init__(self, path, size=None, digest=None, source=None,
+                 partial=None):
+        self.path = path
+        self.size = size
+        self.digest = digest
+        self.partial = partial
+        self.source = source
+
+
+class NameIndex:
+    """ Tracks the occupied names of destination directories so a clashing
+        file is given a free `_N` suffix, or found to be a copy of a file
+        already there, without probing the names one by one.
+
+        Each directory is listed once, on first use. For every name the
+        files `name.ext`, `name_1.ext`, `name_2.ext`, ... form a chain. A
+        file's target is the first free name of its chain unless one of the
+        files in the chain holds the same content, in which case it is a
+        duplicate. This is the outcome of probing the names in turn, but
+        every file in a chain is read at most once per run, and only when
+        its size matches. A tiered `File` is first compared by partial
+        fingerprint, so a file of the same size is only hashed in full when
+        its fingerprint matches too. """
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, index=None, cache=None):
+        """ @param  algorithm   The digest algorithm of compared files.
+            @param  index       An optional `ContentIndex` of the
+                                destination, consulted for digests.
+            @param  cache       An optional `MetadataCache`, consulted for
+                                digests. """
+        self.algorithm = algorithm
+        self.index = index
+        self.cache = cache
+        self.dirs = {}
+        self.chains = {}
+
+    def names(self, directory):
+        """ Returns the set of names in `directory`, listing it on first
+            use. """
+        names = self.dirs.get(directory)
+
+        if names is None:
+            try:
+                with os.scandir(directory) as it:
+                    names = {entry.name for entry in it}
+            except (FileNotFoundError, NotADirectoryError):
+                names = set()
+            self.dirs[directory] = names
+
+        return names
+
+    def _extend(self, chain, directory, name, ext):
+        """ Add the existing files which continue `chain`. """
+        names = self.names(directory)
+
+        while True:
+            mod = f'_{len(chain)}' if chain else ''
+            candidate = f'{name}{mod}{ext}'
+
+            if candidate not in names:
+                return candidate
+
+            chain.append(_Slot(os.path.join(directory, candidate)))
+
+    def _digest(self, slot):
+        if slot.digest is not None:
+            return slot.digest
+
+        digest = None
+        path = slot.source or slot.path
+
+        if self.index is not None and slot.source is None:
+            digest = self.index.digest_of(path)
+        if digest is None and self.cache:
+            digest = self.cache.get_digest(path, self.algorithm)
+        if digest is None:
+            digest = hash_file(path, self.algorithm)
+            if self.cache:
+                self.cache.set_digest(path, self.algorithm, digest)
+
+        slot.digest = digest
+        return digest
+
+    def _partial(self, slot):
+        if slot.partial is None:
+            slot.partial = partial_hash_file(slot.source or slot.path,
+                                             self.algorithm)
+        return slot.partial
+
+    def _same(self, slot, file):
+        """ Returns `True` if `slot` holds the content of `file`. """
+        if slot.size is None:
+            slot.size = os.path.getsize(slot.path)
+
+        if slot.size != file.size:
+            return False
+
+        # Below this size the partial fingerprint reads the whole file
+        # anyway.
+        if file.tiered and file.size > 2 * PARTIAL_SIZE and \
+                self._partial(slot) != file.partial_hash():
+            return False
+
+        return self._digest(slot) == file.hash
+
+    def allocate(self, file, directory, name, ext):
+        """ Returns the path in `directory` to write the `File` `file` to
+            and reserves it, or `None` if a file in the chain of `name` and
+            `ext` already holds the same content.
+
+            @param  file        The `File` to place.
+            @param  directory   The target directory.
+            @param  name        The file name without its extension.
+            @param  ext         The extension, including the dot. """
+        key = (directory, name, ext)
+        chain = self.chains.get(key)
+
+        if chain is None:
+            chain = self.chains[key] = []
+
+        free = self._extend(chain, directory, name, ext)
+
+        for slot in chain:
+            if self._same(slot, file):
+                return None
+
+        target = os.path.join(directory, free)
+        self.names(directory).add(free)
+        chain.append(_Slot(target, file.size, file._hash, file.path,
+                           file._partial))
+
+        return target
@@ -1,66 +1,74 @@
-import PIL
-import piexif
-import pyheif
-import PIL.Image
-import PIL.ExifTags
-
 from sortmedia.file import File
+from sortmedia.exif import read_dates
+from sortmedia.bmff import read_heic_exif
 from datetime import datetime
 
 
-class Photo(File):
-    def creation_date(self):
-        """ Returns the creation date based on the file's EXIF data. """
-        super().creation_date()
-
-        # If we do not have exif data, return `None`.
-        if not self.exif:
-            return None
+# The EXIF tags holding a creation date, by preference.
+DATE_TAGS = ["DateCreated",
+             "DateTimeCreated",
+             "DateTimeOriginal",
+             "DateTime",
+             "DateTimeDigitized",
+             "DigitalCreationDateTime"]
 
-        keys = ["DateCreated",
-                "DateTimeCreated",
-                "DateTimeOriginal",
-                "DateTime",
-                "DateTimeDigitized",
-                "DigitalCreationDateTime"]
 
+class Photo(File):
+    def parse_date(self, exif):
+        """ Returns the creation date found in the photo's EXIF data. """
         created_str = None
 
-        for k in keys:
-            if k in self.exif:
-                created_str = self.exif[k]
+        for k in DATE_TAGS:
+            if k in exif:
+                created_str = exif[k]
                 break
 
+        if not created_str:
+            return None
+
         if isinstance(created_str, bytes):
             created_str = created_str.decode('utf-8')
 
-        parsed = datetime.strptime(created_str, "%Y:%m:%d %H:%M:%S")
-
-        return {
-            'year': str(parsed.year),
-            'month': str(parsed.strftime("%B")),
-            'day': str(parsed.day)
-        }
+        return datetime.strptime(created_str, "%Y:%m:%d %H:%M:%S")
 
     def get_exif(self):
         """ Returns the EXIF data for a photo. Includes support for HEIC file
-            format. """
+            format. Only the date tags are read from the metadata header where
+            the format allows it, with PIL and pyheif as fallbacks. These are
+            only imported when first needed, as they are slow to load. """
         exif = {}
 
         # iOS now stores images in `heic`. PIL doesn't support this format.
-        # This allows us to use the bindings to libheif to grab the EXIF data.
+        # The Exif item is located through the ISO-BMFF boxes, falling back to
+        # the bindings to libheif to grab the EXIF data.
         if self.mime == "image/heic":
+            dates = read_heic_exif(self.reader())
+            if dates is not None:
+                return dates
+
+            import piexif
+            import pyheif
+
             heif = pyheif.read_heif(self.fp)
             for metadata in heif.metadata or []:
                 if metadata['type'] == 'Exif':
                     data = metadata.get('data', {})
                     exif = piexif.load(data).get('Exif').items()
 
-        # Otherwise, use PIL to process the image.
         else:
+            # Try reading just the date tags from the metadata header first.
+            dates = read_dates(self.reader(), self.mime)
+            if dates is not None:
+                return dates
+
+            # Otherwise, use PIL to process the image.
+            import PIL.Image
+
             img = PIL.Image.open(self.fp)
-            exif = img._getexif().items()
+            exif = (img._getexif() or {}).items()
+
+        import PIL.ExifTags
 
         self.fp.seek(0)
-        return {PIL.ExifTags.TAGS[k]: v for k, v in exif if k in
-                PIL.ExifTags.TAGS}
+        return {PIL.ExifTags.TAGS[k]: v for k, v in exif if
+                PIL.ExifTags.TAGS.get(k) in DATE_TAGS}
@@ -0,0 +1,255 @@
+import os
+import csv
+import sys
+import json
+import logging
+
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+# Actions of an `Operation`. `move-tree` and `copy-tree` carry a "no process"
+# directory over as a whole, `duplicate` leaves a file where it is.
+MOVE = 'move'
+COPY = 'copy'
+MOVE_TREE = 'move-tree'
+COPY_TREE = 'copy-tree'
+DUPLICATE = 'duplicate'
+
+ACTIONS = [MOVE, COPY, MOVE_TREE, COPY_TREE, DUPLICATE]
+TREE_ACTIONS = [MOVE_TREE, COPY_TREE]
+
+# The last columns hold settings of the whole plan, repeated on every row so
+# a CSV plan round-trips like a JSON one.
+CSV_FIELDS = ['action', 'src', 'target', 'size', 'mime', 'date', 'digest',
+              'algorithm', 'dst', 'copy_strategy', 'store']
+
+# MIME types are stored in an `Operation` as an index into this table, which
+# grows as new types are seen.
+_MIMES = [None]
+_MIME_CODES = {None: 0}
+
+
+def mime_code(mime):
+    """ Returns the small integer standing for `mime` in `Operation`. """
+    code = _MIME_CODES.get(mime)
+
+    if code is None:
+        code = _MIME_CODES[mime] = len(_MIMES)
+        _MIMES.append(mime)
+
+    return code
+
+
+def pack_date(created):
+    """ Returns `created` packed into an integer `YYYYMMDD`, or `None`. """
+    if created is None:
+        return None
+    return created.year * 10000 + created.month * 100 + created.day
+
+
+def unpack_date(packed):
+    """ Returns the `date` packed by `pack_date`, or `None`. """
+    if not packed:
+        return None
+    return date(packed // 10000, packed // 100 % 100, packed % 100)
+
+
+def _split(path):
+    """ Returns the interned directory and the name of `path`. Files of a
+        plan share a few directories, which are then stored once. """
+    if path is None:
+        return None, None
+
+    directory, name = os.path.split(path)
+    return sys.intern(directory), name
+
+
+class Operation:
+    """ One step of a `Plan`: what happens to a single source file or "no
+        process" directory.
+
+        A plan holds an operation for every file of the run, so they are kept
+        small: directories are shared between operations, the MIME type is
+        a code and the date an integer. """
+
+    __slots__ = ('action', '_src_dir', '_src_name', '_target_dir',
+                 '_target_name', 'size', '_mime', 'digest', 'date', 'seconds')
+
+    def __init__(self, action, src, target=None, size=0, mime=None,
+                 digest=None, date=None):
+        """ @param  action  One of `ACTIONS`.
+            @param  src     The source path.
+            @param  target  The destination path, `None` for duplicates.
+            @param  size    The size of the source in bytes.
+            @param  mime    The MIME type of the source.
+            @param  digest  The digest of the source, if it was computed.
+            @param  date    The creation date of the source packed by
+                            `pack_date`, if known. """
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown plan action `{action}`.")
+
+        self.action = action
+        self._src_dir, self._src_name = _split(src)
+        self._target_dir, self._target_name = _split(target)
+
+        # Most files keep their name, which is then stored once.
+        if self._target_name == self._src_name:
+            self._target_name = self._src_name
+        self.size = size
+        self._mime = mime_code(mime)
+        self.digest = digest
+        self.date = date
+
+        # Seconds spent on the file while planning, for the statistics.
+        self.seconds = 0.0
+
+    @property
+    def src(self):
+        return os.path.join(self._src_dir, self._src_name)
+
+    @property
+    def target(self):
+        if self._target_name is None:
+            return None
+        return os.path.join(self._target_dir, self._target_name)
+
+    @property
+    def target_dir(self):
+        return self._target_dir
+
+    @property
+    def mime(self):
+        return _MIMES[self._mime]
+
+    def to_dict(self):
+        return {
+            'action': self.action,
+            'src': self.src,
+            'target': self.target,
+            'size': self.size,
+            'mime': self.mime,
+            'date': self.date,
+            'digest': self.digest.hex() if self.digest else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        digest = d.get('digest')
+        return cls(d['action'],
+                   d['src'],
+                   d.get('target') or None,
+                   int(d.get('size') or 0),
+                   d.get('mime') or None,
+                   bytes.fromhex(digest) if digest else None,
+                   int(d.get('date') or 0) or None)
+
+
+class Plan:
+    """ Every operation of a run, computed before anything is written. A
+        plan can be saved, reviewed and applied later. """
+
+    def __init__(self, dst, algorithm, copy_strategy='copy', operations=None,
+                 store=None):
+        """ @param  dst             The destination directory.
+            @param  algorithm       The algorithm of the recorded digests.
+            @param  copy_strategy   How `copy` operations copy data.
+            @param  operations      Initial list of `Operation`.
+            @param  store           The directory of the content store of
+                                    an archive, see `archive.Store`. Files
+                                    are then written to the store and their
+                                    targets are hard links to it. """
+        self.dst = dst
+        self.algorithm = algorithm
+        self.copy_strategy = copy_strategy
+        self.operations = list(operations or [])
+        self.store = store
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def add(self, operation):
+        self.operations.append(operation)
+
+    def trees(self):
+        """ Returns the operations on "no process" directories. """
+        return [op for op in self.operations if op.action in TREE_ACTIONS]
+
+    def by_directory(self):
+        """ Returns the file moves and copies grouped by target directory, as
+            a dictionary of directory to operations in plan order. """
+        groups = {}
+
+        for op in self.operations:
+            if op.action in (MOVE, COPY):
+                groups.setdefault(op.target_dir, []).append(op)
+
+        return groups
+
+    def save(self, path):
+        """ Write the plan to `path`, as CSV if its extension is `.csv` and
+            as JSON otherwise. """
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+                writer.writeheader()
+                for op in self.operations:
+                    row = op.to_dict()
+                    row['algorithm'] = self.algorithm
+                    row['dst'] = self.dst
+                    row['copy_strategy'] = self.copy_strategy
+                    row['store'] = self.store
+                    writer.writerow(row)
+            return
+
+        with open(path, 'w') as f:
+            json.dump({
+                'version': PLAN_VERSION,
+                'dst': self.dst,
+                'algorithm': self.algorithm,
+                'copy_strategy': self.copy_strategy,
+                'store': self.store,
+                'operations': [op.to_dict() for op in self.operations],
+            }, f, indent=1)
+
+    @classmethod
+    def load(cls, path, dst=None):
+        """ Read a plan written by `save`.
+
+            @param  path    The plan file.
+            @param  dst     The destination directory, overriding the one
+                            recorded in the plan. Required for CSV plans
+                            written without it. """
+        if path.lower().endswith('.csv'):
+            with open(path, newline='') as f:
+                rows = list(csv.DictReader(f))
+
+            first = rows[0] if rows else {}
+            dst = dst or first.get('dst') or None
+
+            if dst is None:
+                raise RuntimeError(f"The plan `{path}` does not record its " +
+                                   "destination, which must be given.")
+
+            return cls(dst,
+                       first.get('algorithm') or None,
+                       first.get('copy_strategy') or 'copy',
+                       [Operation.from_dict(r) for r in rows],
+                       first.get('store') or None)
+
+        with open(path) as f:
+            data = json.load(f)
+
+        if data.get('version') != PLAN_VERSION:
+            raise RuntimeError(f"Unsupported plan version in `{path}`.")
+
+        return cls(dst or data['dst'],
+                   data['algorithm'],
+                   data.get('copy_strategy', 'copy'),
+                   [Operation.from_dict(d) for d in data['operations']],
+                   data.get('store'))
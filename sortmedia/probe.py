@@ -0,0 +1,103 @@
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds an `ffprobe` call may take before it is killed.
+PROBE_TIMEOUT = 30.0
+
+# Number of `ffprobe` processes kept running at once by a `ProbePool`.
+DEFAULT_PROBES = 4
+
+
+def probe_command(path):
+    """ Returns the `ffprobe` command line reading the creation time tags of
+        the video at `path`. `ffprobe` reads a single input per invocation,
+        so files cannot be batched. """
+    return ['ffprobe', '-v', 'quiet', path, '-print_format', 'json',
+            '-show_entries',
+            'stream=index,codec_type:stream_tags=creation_time:' +
+            'format_tags=creation_time']
+
+
+def parse_probe(out):
+    """ Returns the tags of the first stream in the JSON output `out` of
+        `ffprobe`, or `None`. """
+    streams = json.loads(out or b'{}').get('streams', {})
+
+    if len(streams) == 0:
+        return None
+
+    return streams[0].get('tags', None)
+
+
+def probe(path, timeout=PROBE_TIMEOUT):
+    """ Run `ffprobe` on `path` and return its tags as `parse_probe` does.
+        A call running longer than `timeout` seconds is killed and `None`
+        is returned. """
+    import subprocess
+
+    try:
+        out = subprocess.run(probe_command(path), stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, timeout=timeout,
+                             check=True).stdout
+    except subprocess.TimeoutExpired:
+        logger.warning(f"ffprobe timed out on `{path}` after {timeout}s")
+        return None
+
+    return parse_probe(out)
+
+
+class ProbePool:
+    """ Keeps up to `workers` `ffprobe` processes running at once, so the
+        time spent starting and waiting on each one overlaps with the
+        others. Each process is waited on by a thread of its own, started
+        on the first `submit`. Threads rather than an `asyncio` loop are
+        used, as child processes can only be awaited from the main thread's
+        loop before Python 3.8, and probes are submitted from the device
+        threads. """
+
+    def __init__(self, workers=DEFAULT_PROBES, timeout=PROBE_TIMEOUT):
+        """ @param  workers     The number of processes in flight.
+            @param  timeout     Seconds a call may take before the process
+                                is killed and the file is treated as having
+                                no tags. """
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _probe(self, path):
+        start = time.perf_counter()
+        tags = probe(path, self.timeout)
+        return tags, time.perf_counter() - start
+
+    def submit(self, path):
+        """ Start probing `path`. Returns a `concurrent.futures.Future` of
+            the tags, as `probe` returns them, and the seconds taken. """
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='ffprobe')
+
+            return self.executor.submit(self._probe, path)
+
+    def close(self):
+        """ Stop the threads once the probes submitted are done, each
+            within its timeout. """
+        with self.lock:
+            if self.executor is None:
+                return
+
+            self.executor.shutdown()
+            self.executor = None
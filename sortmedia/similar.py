@@ -0,0 +1,265 @@
+import math
+import logging
+
+from itertools import combinations
+
+logger = logging.getLogger(__name__)
+
+METHODS = ['dhash', 'phash']
+
+# Side of the square of bits of a perceptual hash, giving 64 bit hashes.
+HASH_SIZE = 8
+
+# Side of the image transformed by `phash`, before the lowest frequencies
+# are kept.
+PHASH_SIZE = 32
+
+# Default number of differing bits up to which two images are similar.
+DEFAULT_DISTANCE = 6
+
+
+def _numpy():
+    """ Returns the `numpy` module, or `None` if it is not installed. """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def load_gray(path, width, height):
+    """ Returns the image at `path` as a `width` x `height` grayscale image.
+        JPEGs are decoded at a reduced scale (draft mode), which skips most
+        of the decoding work for large photos. """
+    import PIL.Image
+    import PIL.ImageOps
+
+    with PIL.Image.open(path) as img:
+        img.draft('L', (width * 4, height * 4))
+        img = PIL.ImageOps.exif_transpose(img)
+        return img.convert('L').resize((width, height), PIL.Image.LANCZOS)
+
+
+def _pixels(img):
+    """ Returns the rows of the grayscale `img` as lists of values. """
+    width = img.size[0]
+    data = list(img.tobytes())
+    return [data[i:i + width] for i in range(0, len(data), width)]
+
+
+def _to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return value
+
+
+def dhash(img, size=HASH_SIZE):
+    """ Returns the difference hash of `img`: whether each pixel of a
+        `size` + 1 by `size` grayscale reduction is brighter than its left
+        neighbour. """
+    import PIL.Image
+
+    img = img.convert('L').resize((size + 1, size), PIL.Image.LANCZOS)
+    np = _numpy()
+
+    if np is not None:
+        pixels = np.asarray(img, dtype=np.int16)
+        bits = pixels[:, 1:] > pixels[:, :-1]
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    return _to_int(row[x + 1] > row[x]
+                   for row in _pixels(img) for x in range(size))
+
+
+def _dct_matrix(n, rows):
+    """ Returns the first `rows` rows of the (unscaled) DCT-II matrix of
+        size `n`. """
+    return [[math.cos(math.pi * (2 * x + 1) * k / (2 * n)) for x in range(n)]
+            for k in range(rows)]
+
+
+_DCT = {}
+
+
+def phash(img, size=HASH_SIZE, factor=PHASH_SIZE // HASH_SIZE):
+    """ Returns the perceptual hash of `img`: whether each of the `size` by
+        `size` lowest frequencies of the DCT of a grayscale reduction is
+        above their median. Robust to re-compression, resizing and small
+        changes in brightness. """
+    import PIL.Image
+
+    n = size * factor
+    img = img.convert('L').resize((n, n), PIL.Image.LANCZOS)
+    key = (n, size)
+
+    if key not in _DCT:
+        _DCT[key] = _dct_matrix(n, size)
+    dct = _DCT[key]
+
+    np = _numpy()
+
+    if np is not None:
+        matrix = np.asarray(dct)
+        pixels = np.asarray(img, dtype=np.float64)
+        low = matrix @ pixels @ matrix.T
+        bits = low > np.median(low)
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    pixels = _pixels(img)
+    # `dct` x `pixels`, then x the transpose of `dct`.
+    left = [[sum(c[i] * pixels[i][x] for i in range(n)) for x in range(n)]
+            for c in dct]
+    low = [sum(row[i] * c[i] for i in range(n))
+           for row in left for c in dct]
+
+    ordered = sorted(low)
+    middle = len(ordered) // 2
+    median = (ordered[middle - 1] + ordered[middle]) / 2
+
+    return _to_int(v > median for v in low)
+
+
+_METHODS = {
+    'dhash': dhash,
+    'phash': phash,
+}
+
+
+def perceptual_hash(path, method='dhash'):
+    """ Returns the perceptual hash of the image at `path` as an integer, or
+        `None` if it cannot be decoded.
+
+        @param  path    Path to the image.
+        @param  method  One of `METHODS`. """
+    if method not in _METHODS:
+        raise ValueError(f"Unknown perceptual hash `{method}`.")
+
+    if method == 'phash':
+        width = height = PHASH_SIZE
+    else:
+        width, height = HASH_SIZE + 1, HASH_SIZE
+
+    try:
+        img = load_gray(path, width, height)
+    except (OSError, ValueError, SyntaxError) as e:
+        logger.debug(f"Cannot decode `{path}`: {e}")
+        return None
+
+    return _METHODS[method](img)
+
+
+# `int.bit_count` is only available from Python 3.10.
+_popcount = getattr(int, 'bit_count', None) or (lambda v: bin(v).count('1'))
+
+
+def hamming(a, b):
+    """ Returns the number of bits which differ between `a` and `b`. """
+    return _popcount(a ^ b)
+
+
+class MultiIndex:
+    """ A multi-index hash of `bits` bit hashes for Hamming distance lookups.
+        Each hash is split into `chunks` substrings, each indexed in its own
+        table. Two hashes within `distance` bits agree to within
+        `distance // chunks` bits on at least one substring, so only the
+        hashes filed under those nearby substrings are compared. """
+
+    def __init__(self, distance=DEFAULT_DISTANCE, bits=HASH_SIZE * HASH_SIZE,
+                 chunks=4):
+        """ @param  distance    The largest distance `search` looks for.
+            @param  bits        The number of bits of each hash.
+            @param  chunks      The number of substrings. """
+        self.distance = distance
+        self.width = -(-bits // chunks)
+        self.mask = (1 << self.width) - 1
+        self.tables = [{} for _ in range(chunks)]
+
+        # Every change of up to `distance // chunks` bits of a substring.
+        flips = []
+        for k in range(distance // chunks + 1):
+            for positions in combinations(range(self.width), k):
+                flips.append(sum(1 << p for p in positions))
+        self.flips = flips
+
+    def _chunks(self, value):
+        width, mask = self.width, self.mask
+        return [(value >> (i * width)) & mask
+                for i in range(len(self.tables))]
+
+    def add(self, value, item):
+        """ Add `item` with the hash `value`. """
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table.setdefault(chunk, []).append((value, item))
+
+    def search(self, value, radius=None):
+        """ Returns `(distance, item)` for every item whose hash is at most
+            `radius` bits from `value`, which cannot exceed `distance`. """
+        radius = self.distance if radius is None else radius
+        found = {}
+
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            for flip in self.flips:
+                bucket = table.get(chunk ^ flip)
+                if bucket is None:
+                    continue
+
+                for other, item in bucket:
+                    distance = hamming(value, other)
+                    if distance <= radius:
+                        found[item] = distance
+
+        return [(d, item) for item, d in found.items()]
+
+
+class SimilarityIndex:
+    """ Groups images whose perceptual hashes are within `distance` bits of
+        each other, directly or through other images. Images are grouped as
+        they are added. """
+
+    def __init__(self, distance=DEFAULT_DISTANCE):
+        """ @param  distance    Maximum number of differing bits between two
+                                similar images. """
+        self.distance = distance
+        self.index = MultiIndex(distance)
+        self.paths = []
+        self.parent = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def add(self, path, value):
+        """ Add the image `path` with the perceptual hash `value`.
+
+            @returns    The paths of the images added before which are
+                        similar to it. """
+        i = len(self.paths)
+        matches = self.index.search(value)
+
+        self.paths.append(path)
+        self.parent.append(i)
+        self.index.add(value, i)
+
+        for _, j in matches:
+            a, b = self._find(i), self._find(j)
+            if a != b:
+                self.parent[max(a, b)] = min(a, b)
+
+        return [self.paths[j] for _, j in sorted(matches)]
+
+    def groups(self):
+        """ Returns the lists of paths of similar images, for every group of
+            at least two, in the order they were added. """
+        groups = {}
+
+        for i, path in enumerate(self.paths):
+            groups.setdefault(self._find(i), []).append(path)
+
+        return [g for g in groups.values() if len(g) > 1]
@@ -1,20 +1,50 @@
 import os
+import time
 import shutil
 import logging
 
-from pathlib import Path
+from collections import deque
+from concurrent.futures import Future
 from sortmedia.photo import Photo
 from sortmedia.video import Video
-from sortmedia.util import is_video, is_photo, get_mimetype
+from sortmedia.util import is_video, is_photo, get_mimetype, HEAD_SIZE
+from sortmedia.hashing import DEFAULT_ALGORITHM, DEDUPE_MODES, new_hasher
+from sortmedia.cache import MetadataCache, DEFAULT_NAME, DEFAULT_MAX_ENTRIES
+from sortmedia.index import ContentIndex
+from sortmedia.walk import scan, MEDIA_EXTENSIONS
+from sortmedia.hashing import PARTIAL_SIZE
+from sortmedia.names import NameIndex
+from sortmedia.archive import Store, store_root
+from sortmedia.bundle import Spool, SPOOL_DIR, is_bundle, count, heads
+from sortmedia.transfer import COPY_STRATEGIES, SYNC_BATCH, Mover, \
+    copy_file
+from sortmedia.plan import Plan, Operation, MOVE, COPY, MOVE_TREE, \
+    COPY_TREE, DUPLICATE, pack_date
+from sortmedia import journal as journaling
+from sortmedia.watch import Watcher, DEBOUNCE
+from sortmedia.stats import Stats, Progress
+from sortmedia.devices import READ_ORDERS, group_by_device, is_rotational, \
+    disk_order, merge
+from sortmedia.probe import ProbePool, DEFAULT_PROBES, PROBE_TIMEOUT
+from sortmedia.similar import SimilarityIndex, perceptual_hash, METHODS, \
+    DEFAULT_DISTANCE
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 
 class SortMedia:
     """ Handles processing the specified source path. """
 
-    def __init__(self, dry=False, copy=False, noprocess=[], excludes=[]):
+    def __init__(self, dry=False, copy=False, noprocess=[], excludes=[],
+                 algorithm=DEFAULT_ALGORITHM, cache=None,
+                 cache_size=DEFAULT_MAX_ENTRIES, index=False,
+                 index_file=None, dedupe='full', jobs=1,
+                 filter_extensions=False, copy_strategy='copy',
+                 journal=None, resume=False, hooks=None, progress=False,
+                 plan_file=None, read_order='auto', similar=None,
+                 similar_distance=DEFAULT_DISTANCE, probes=DEFAULT_PROBES,
+                 probe_timeout=PROBE_TIMEOUT, archive=False,
+                 sync=SYNC_BATCH, follow_symlinks=False):
         """ Initialize a new media sorter.
         
             @param  dry         Print out files that would be processed without
@@ -22,13 +52,129 @@ class SortMedia:
             @param  copy        Copy instead of move files.
             @param  noprocess   List of directories to skip processing, but
                                 still move.
-            @param  excludes    List of directories to not process. """
+            @param  excludes    List of directories to not process.
+            @param  algorithm   The digest algorithm used to detect duplicates.
+                                One of `hashing.available_algorithms()`.
+            @param  cache       Path to a persistent metadata cache. `True`
+                                stores the cache in the destination directory
+                                and `None` or `False` disables caching.
+            @param  cache_size  Maximum number of files kept in the cache.
+            @param  index       Index the contents of the destination so that
+                                a file already stored under any name or date
+                                is treated as a duplicate.
+            @param  index_file  Path to persist the destination index between
+                                runs. Implies `index`.
+            @param  dedupe      `full` hashes every file up front. `tiered`
+                                compares files by size, then by a partial
+                                fingerprint and only hashes files which are
+                                still possible duplicates.
+            @param  jobs        Number of worker threads hashing files and
+                                worker processes parsing metadata, per source
+                                device. Files are still moved one at a time,
+                                in order.
+            @param  filter_extensions   Skip files without a known photo or
+                                        video extension instead of sniffing
+                                        their contents.
+            @param  copy_strategy   How files are copied in copy mode: `copy`,
+                                    `reflink`, `link` (hard link) or `kernel`
+                                    (`copy_file_range`). Unsupported
+                                    strategies fall back to a plain copy.
+            @param  journal     Path to a journal of every move and copy.
+                                `True` stores it in the destination
+                                directory.
+            @param  resume      Recover from an interrupted run using the
+                                journal and skip files it already handled.
+                                Implies `journal`.
+            @param  hooks       Callables `hook(event, data)` receiving the
+                                events of `stats.Stats`, for exporting
+                                metrics.
+            @param  progress    Show progress with an ETA while sorting.
+            @param  plan_file   Write the plan of the run to this path, as
+                                JSON or, for a `.csv` path, CSV. In a dry run
+                                the complete plan is computed, including
+                                digests and duplicate checks.
+            @param  read_order  The order files on one device are read in,
+                                one of `READ_ORDERS`. `disk` sorts them by
+                                the position of their data, `auto` does so
+                                on spinning disks only.
+            @param  similar     Look for near-duplicate photos (re-encoded
+                                or resized copies) with this perceptual
+                                hash, one of `similar.METHODS`. They are
+                                reported, not removed.
+            @param  similar_distance    The number of differing hash bits up
+                                        to which two photos are similar.
+            @param  probes      The number of `ffprobe` processes run at once
+                                for videos whose date cannot be read
+                                natively. `0` runs them one at a time.
+            @param  probe_timeout   Seconds after which a hung `ffprobe` is
+                                    killed.
+            @param  archive     Store each unique file once, under its
+                                digest, in the destination's content store
+                                and build the date tree from hard links into
+                                it. See `archive.Store`.
+            @param  sync        The number of files moved across
+                                filesystems per `fsync` batch. Their sources
+                                are removed once the batch is synced. `0`
+                                does not sync.
+            @param  follow_symlinks Descend into symlinked directories of
+                                    the sources, which may lead outside
+                                    them. """
+        if copy_strategy not in COPY_STRATEGIES:
+            raise ValueError(f"Unknown copy strategy `{copy_strategy}`.")
+
+        if dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Unknown dedupe mode `{dedupe}`.")
+
+        if read_order not in READ_ORDERS:
+            raise ValueError(f"Unknown read order `{read_order}`.")
+
+        if similar is not None and similar not in METHODS:
+            raise ValueError(f"Unknown perceptual hash `{similar}`.")
+
+        # Fail early on an unknown or uninstalled algorithm rather than on
+        # the first file.
+        new_hasher(algorithm)
+
         logger.info(f"Dry Run: {'Yes' if dry else 'No'}")
-        logger.info(f"Mode: {'Copy' if copy else 'Move'}")
+        logger.info(f"Mode: {f'Copy ({copy_strategy})' if copy else 'Move'}")
+        logger.info(f"Hash: {algorithm}")
+        if archive:
+            logger.info("Layout: content store with hard linked dates")
         self.copy = copy
         self.dry_run = dry
         self.noprocess = noprocess
         self.excludes = excludes
+        self.algorithm = algorithm
+        self.cache = cache
+        self.cache_size = cache_size
+        self.index = index or bool(index_file)
+        self.index_file = index_file
+        self.tiered = dedupe == 'tiered'
+        self.jobs = max(1, jobs or 1)
+        self.filter_extensions = filter_extensions
+        self.copy_strategy = copy_strategy
+        self.journal = journal or (True if resume else None)
+        self.resume = resume
+        self.hooks = list(hooks or [])
+        self.progress = progress
+        self.stats = Stats(self.hooks)
+        self.plan_file = plan_file
+        self.read_order = read_order
+        self.similar = similar
+        self.similar_distance = similar_distance
+        self.similar_groups = []
+        self.probes = max(0, probes or 0)
+        self.probe_timeout = probe_timeout
+        self.archive = archive
+        self.sync = sync
+        self.follow_symlinks = follow_symlinks
+
+        # Where members of zip and tar sources are written, see `bundle`.
+        self.spool = None
+
+        # A dry run without a plan file only lists the files it would sort,
+        # without hashing or parsing them.
+        self.listing = dry and not plan_file
 
     def is_exclude_dir(self, path):
         """ Test if the filepath is located in one of the specified exclude 
@@ -54,70 +200,891 @@ class SortMedia:
         if not self.noprocess:
             return
 
-        for p in self.noprocess:
-            dst_path = os.path.join(dst, p)
+        plan = Plan(dst, self.algorithm)
+        self.plan_trees(plan, dst)
+        self.apply(plan)
+
+    def plan_trees(self, plan, dst):
+        """ Add the moves or copies of the "no process" directories into
+            `dst` to `plan`. """
+        action = COPY_TREE if self.copy else MOVE_TREE
+
+        for p in self.noprocess or []:
+            plan.add(Operation(action, p, os.path.join(dst, p)))
+
+    def open_cache(self, dst):
+        """ Returns the `MetadataCache` to use when processing into `dst`, or
+            `None` if caching is disabled. """
+        if not self.cache:
+            return None
+
+        path = self.cache
+        if path is True:
+            path = os.path.join(dst, DEFAULT_NAME)
+
+        logger.info(f"Cache: {path}")
+        return MetadataCache(path, max_entries=self.cache_size)
+
+    def open_index(self, dst, cache):
+        """ Returns a populated `ContentIndex` of `dst`, or `None` if content
+            indexing is disabled. """
+        if not self.index or self.listing:
+            return None
+
+        index = ContentIndex(dst,
+                             algorithm=self.algorithm,
+                             path=self.index_file,
+                             cache=cache,
+                             tiered=self.tiered)
+        index.build()
+        return index
+
+    def open_journal(self, dst):
+        """ Returns the `Journal` to record operations into `dst`, or `None`
+            if journaling is disabled. When resuming, interrupted operations
+            are recovered first. """
+        if not self.journal or self.dry_run:
+            return None
+
+        path = self.journal
+        if path is True:
+            path = os.path.join(dst, journaling.DEFAULT_NAME)
+
+        logger.info(f"Journal: {path}")
+        journal = journaling.Journal(path, self.algorithm)
+
+        if self.resume:
+            recovered = journal.recover()
+            logger.info(f"Resuming: {len(journal.finished)} files done, " +
+                        f"{recovered} recovered")
+
+        return journal
+
+    def open_store(self, dst):
+        """ Returns the content `Store` of `dst` in archive mode, or `None`.
+            """
+        if not self.archive:
+            return None
+        return Store(store_root(dst))
+
+    def open_spool(self, src, dst):
+        """ Returns the `Spool` zip and tar sources among `src` are read
+            into, or `None` if there are none. It is in `dst`, so members
+            are renamed into place. Dry runs only list members, see
+            `list_bundle`, and need no spool. """
+        if self.listing or not any(is_bundle(root) for root in sources(src)):
+            return None
+
+        root = os.path.join(dst, SPOOL_DIR)
+        logger.info(f"Spool: {root}")
+        return Spool(root, self.algorithm)
+
+    def new_stats(self, src):
+        """ Start a new `Stats` for a run over `src`. With progress enabled
+            the files of `src` are counted first, for the ETA. """
+        stats = Stats(self.hooks)
+
+        if self.progress:
+            stats.add_hook(Progress(stats))
+            stats.total = 0
+
+            for root in sources(src):
+                n = count(root) if is_bundle(root) else \
+                    sum(1 for _ in self.walk(root))
+
+                # Tar members cannot be counted without reading them.
+                if n is None:
+                    stats.total = None
+                    break
+                stats.total = stats.total + n
+
+        return stats
+
+    def walk(self, src, journal=None):
+        """ Yields a `(filepath, excluded)` tuple for every file under `src`.
+            Exclude directories are yielded once, with `excluded` set to
+            `True`, and neither they nor "no process" directories are
+            descended into.
+
+            Files a resumed `journal` has already handled are skipped. """
+        extensions = MEDIA_EXTENSIONS if self.filter_extensions else None
+
+        entries = scan(src,
+                       excludes=self.excludes,
+                       prune=self.noprocess,
+                       extensions=extensions,
+                       follow_symlinks=self.follow_symlinks)
+
+        for filepath, excluded in entries:
+            if not excluded and journal is not None and \
+                    journal.is_finished(filepath):
+                continue
+            yield filepath, excluded
+
+    def entries(self, root, journal=None, ordered=False):
+        """ Returns the timed `(filepath, excluded)` entries of the source
+            `root`: the walked files of a directory, in disk order if
+            `ordered`, or the members of a zip or tar bundle as they are
+            spooled. """
+        if is_bundle(root):
+            return self.extract(root)
+
+        entries = self.walk(root, journal)
+        if ordered:
+            entries = disk_order(entries)
+
+        return self.stats.timed('walk', entries)
+
+    def extract(self, bundle):
+        """ Yields `(filepath, False)` for every member of the zip or tar
+            `bundle`, once it is written to the spool. Members are read from
+            the bundle as a stream and hashed while they are written. """
+        extensions = MEDIA_EXTENSIONS if self.filter_extensions else None
+        members = self.spool.extract(bundle, extensions)
+        logger.info(f"Reading `{bundle}`")
+
+        while True:
+            start = time.perf_counter()
+            spooled, size = next(members, (None, 0))
+
+            if spooled is None:
+                return
+
+            self.stats.record('extract', time.perf_counter() - start, size,
+                              spooled)
+            yield spooled, False
+
+    def list_bundle(self, bundle):
+        """ List the photos and videos of the zip or tar `bundle` for a dry
+            run. Only the name and the first bytes of each member are read,
+            for its MIME type, and nothing is written. """
+        extensions = MEDIA_EXTENSIONS if self.filter_extensions else None
+        stats = self.stats
+        logger.info(f"Reading `{bundle}`")
+
+        for relative, size, head in heads(bundle, HEAD_SIZE, extensions):
+            filepath = os.path.join(bundle, relative)
+            mime = get_mimetype(relative, head=head)
+
+            if mime and is_video(mime):
+                stats.count('videos')
+            elif mime and is_photo(mime):
+                stats.count('photos')
+            else:
+                stats.count('ignored')
+                continue
+
+            logger.info(filepath)
+            stats.file_done(filepath, mime, size, 'dry')
+
+    def make_media(self, filepath, cache=None):
+        """ Returns a `Photo` or `Video` for `filepath`, or `None` if the file
+            is neither. In `full` dedupe mode the file is hashed here, unless
+            this is a dry run which only lists files.
+
+            The file is opened once: its header is used for MIME detection,
+            then handed to the media object for metadata parsing and as the
+            start of the digest. """
+        fp = None
+        head = None
+        digest = None
+        start = time.perf_counter()
 
-            if self.copy:
-                shutil.copytree(p, dst_path) 
+        if self.spool is not None and self.spool.owns(filepath):
+            # Spooled members were hashed as they were written, and are
+            # gone after the run, so they are not cached.
+            digest = self.spool.digest(filepath)
+            cache = None
+
+        mime = cache.get_mime(filepath) if cache else None
+
+        if not mime:
+            fp = open(filepath, 'rb')
+            head = fp.read(HEAD_SIZE)
+            mime = get_mimetype(filepath, cache, head)
+
+        self.stats.record('mime', time.perf_counter() - start,
+                          len(head or b''), filepath, mime)
+
+        if mime and is_video(mime):
+            cls = Video
+        elif mime and is_photo(mime):
+            cls = Photo
+        else:
+            if fp:
+                fp.close()
+            return None
+
+        obj = cls(filepath, mime, algorithm=self.algorithm, cache=cache,
+                  tiered=self.tiered, fp=fp, head=head, digest=digest)
+
+        if not self.tiered and not self.listing:
+            with self.stats.timer('hash', obj.size, filepath, mime):
+                obj.hash
+
+        if self.similar and cls is Photo and not self.listing:
+            with self.stats.timer('perceptual', 0, filepath, mime):
+                obj.perceptual = perceptual_hash(filepath, self.similar)
+
+        return obj
+
+    def read_metadata(self, obj, prober=None):
+        """ Parse the creation date of `obj` now, so the time is counted
+            towards metadata parsing rather than the move.
+
+            @param  obj     The `Photo` or `Video`, or `None`.
+            @param  prober  An optional `ProbePool`. A video whose date can
+                            only be read by `ffprobe` is then submitted to
+                            it instead of waiting.
+
+            @returns    A future for the date of a submitted video, see
+                        `probe_created`, or `None`. """
+        if obj is None or self.listing or obj.date_known():
+            return None
+
+        if prober is not None and isinstance(obj, Video):
+            start = time.perf_counter()
+            native = obj.native_created()
+            self.stats.record('metadata', time.perf_counter() - start, 0,
+                              obj.path, obj.mime)
+            return None if native else self.probe_created(obj, prober)
+
+        start = time.perf_counter()
+        obj.created()
+        stage = 'ffprobe' if obj.probed else 'metadata'
+        self.stats.record(stage, time.perf_counter() - start, 0, obj.path,
+                          obj.mime)
+
+    def probe_created(self, obj, prober):
+        """ Submit the video `obj` to the `ProbePool` `prober`. Returns a
+            future of its creation date, the seconds taken and `True`, as
+            `read_created` returns them. """
+        result = Future()
+
+        def done(future):
+            try:
+                tags, seconds = future.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+
+            created = obj.parse_date(tags) if tags else None
+            result.set_result((created, seconds, True))
+
+        prober.submit(obj.path).add_done_callback(done)
+        return result
+
+    def device_stream(self, dev, roots, cache=None, journal=None,
+                      procs=None, prober=None):
+        """ Returns the prepared files under `roots`, which are all on the
+            device `dev`, as yielded by `prepare`. Spinning disks are read
+            in disk order, see `read_order`. """
+        ordered = self.read_order == 'disk' or \
+            (self.read_order == 'auto' and is_rotational(dev))
+
+        logger.info(f"Device {os.major(dev)}:{os.minor(dev)}: " +
+                    f"{', '.join(roots)}{' (disk order)' if ordered else ''}")
+
+        entries = (entry for root in roots
+                   for entry in self.entries(root, journal, ordered))
+
+        return self.prepare(entries, cache, procs, prober)
+
+    def gather(self, src, cache=None, journal=None):
+        """ Yields the `(filepath, excluded, obj)` tuples of `prepare` for
+            every file under the source directories `src`. The sources are
+            grouped by device and each device is read by its own thread, so
+            disks are read at the same time without competing for the same
+            heads. Files of one device keep their order.
+
+            The devices share one process pool, with `jobs` processes per
+            device, and one `ProbePool`. Both are started before any device
+            is read: a worker forked while a probe is being spawned inherits
+            the pipe that signals its start, and the probe never returns. """
+        groups = group_by_device(sources(src))
+        prober = ProbePool(self.probes, self.probe_timeout) \
+            if self.probes else None
+        procs = None
+
+        try:
+            if self.jobs > 1 and groups:
+                # Loading `multiprocessing` is only worth it for parallel
+                # runs.
+                from concurrent.futures import ProcessPoolExecutor
+
+                procs = ProcessPoolExecutor(self.jobs * len(groups))
+                if prober is not None:
+                    procs.submit(os.getpid).result()
+
+            streams = [self.device_stream(dev, roots, cache, journal, procs,
+                                          prober)
+                       for dev, roots in groups.items()]
+
+            if len(streams) == 1:
+                yield from streams[0]
             else:
-                shutil.move(p, dst_path)
+                yield from merge(streams)
+        finally:
+            if procs is not None:
+                procs.shutdown()
+            if prober is not None:
+                prober.close()
+
+    def prepare(self, entries, cache, procs=None, prober=None):
+        """ Yields a `(filepath, excluded, obj)` tuple for each of the walked
+            `entries`, in order, where `obj` is the prepared `Photo` or
+            `Video` (or `None`).
+
+            With more than one job, MIME sniffing and hashing run in a thread
+            pool and metadata is parsed in the process pool `procs`. At most
+            a few files per job are in flight at any time. Videos which need
+            `ffprobe` are probed by the `ProbePool` `prober`, if given,
+            while the next files are prepared. See `gather`. """
+        if self.jobs <= 1:
+            return self._prepare_serial(entries, cache, prober)
+        return self._prepare_parallel(entries, cache, procs, prober)
+
+    def _prepare_serial(self, entries, cache, prober):
+        """ `prepare` in this thread. Only videos waiting for `ffprobe`,
+            and the files behind them, are held back. """
+        window = self.probes * 4
+        pending = deque()
+
+        def finish(filepath, excluded, obj, created):
+            return self._finish_one(filepath, excluded, _done(obj, created),
+                                    close=False)
+
+        for filepath, excluded in entries:
+            obj = None if excluded else self.make_media(filepath, cache)
+            created = self.read_metadata(obj, prober)
+            pending.append((filepath, excluded, obj, created))
+
+            while pending and (len(pending) >= window or
+                               pending[0][3] is None or pending[0][3].done()):
+                yield finish(*pending.popleft())
+
+        while pending:
+            yield finish(*pending.popleft())
+
+    def _prepare_parallel(self, entries, cache, procs, prober):
+        """ `prepare` with MIME sniffing and hashing in a thread pool and
+            metadata parsing in the process pool `procs`. """
+        from concurrent.futures import ThreadPoolExecutor
+
+        window = self.jobs * 4
+        pending = deque()
+
+        with ThreadPoolExecutor(self.jobs) as threads:
+            for filepath, excluded in entries:
+                future = None
+                if not excluded:
+                    future = threads.submit(self._prepare_one, filepath,
+                                            cache, procs, prober)
+                pending.append((filepath, excluded, future))
+
+                while len(pending) >= window:
+                    yield self._finish_one(*pending.popleft())
+
+            while pending:
+                yield self._finish_one(*pending.popleft())
+
+    def _prepare_one(self, filepath, cache, procs, prober=None):
+        """ Runs in the thread pool. Returns the media object and a future
+            for its creation date, if it still has to be parsed. """
+        obj = self.make_media(filepath, cache)
+
+        if obj is None or obj.date_known() or self.listing:
+            return obj, None
+
+        if prober is not None and isinstance(obj, Video):
+            return obj, self.read_metadata(obj, prober)
+
+        future = procs.submit(read_created, type(obj), filepath, obj.mime,
+                              obj.head)
+        return obj, future
+
+    def _finish_one(self, filepath, excluded, future, close=True):
+        """ Wait for the preparation of a file submitted by `prepare`. """
+        if future is None:
+            return filepath, excluded, None
+
+        obj, created = future.result()
+
+        if created is not None:
+            created, seconds, probed = created.result()
+            obj.set_created(created)
+            obj.probed = probed
+            stage = 'ffprobe' if probed else 'metadata'
+            self.stats.record(stage, seconds, 0, filepath, obj.mime)
+
+        # Everything needed up front has been read. Release the handle and
+        # header while the file waits to be committed.
+        if obj is not None and close:
+            obj.close()
+
+        return filepath, excluded, obj
+
+    def plan_one(self, obj, dst, index=None, names=None, store=None):
+        """ Returns the `Operation` sorting the prepared media file `obj`
+            into `dst`.
+
+            @param  obj         The `Photo` or `Video`.
+            @param  dst         The destination directory.
+            @param  index       An optional `ContentIndex` of `dst`. The
+                                target is added to it, so later files with
+                                the same content are planned as duplicates.
+            @param  names       A `NameIndex` of `dst` holding the targets
+                                planned so far. The new target is added.
+            @param  store       The content `Store` of an archive. A file
+                                whose content it holds is a duplicate, and
+                                the content of the new target is reserved
+                                in it. """
+        with self.stats.timer('dedupe', 0, obj.path, obj.mime):
+            if store is not None and store.find(obj.hash):
+                target = None
+            else:
+                target = obj.target_path(dst, index, names)
+
+        created = pack_date(obj.created())
+
+        if target is None:
+            return Operation(DUPLICATE, obj.path, None, obj.size, obj.mime,
+                             obj._hash, created)
+
+        if store is not None:
+            store.reserve(obj.hash)
+
+        if index is not None:
+            # The file is not written yet, so the index cannot read it.
+            partial = None
+            if self.tiered and obj.size > 2 * PARTIAL_SIZE:
+                partial = obj.partial_hash()
+            index.add(target, obj.size, obj.hash, partial)
+
+        # A spooled member is moved into place, even when copying: the
+        # bundle is what is kept.
+        spooled = self.spool is not None and self.spool.owns(obj.path)
+        action = COPY if self.copy and not spooled else MOVE
+
+        return Operation(action, obj.path, target, obj.size, obj.mime,
+                         obj._hash, created)
+
+    def plan(self, src, dst, cache=None, index=None, journal=None):
+        """ Returns the `Plan` sorting `src`, a directory or a list of
+            directories, into `dst`. Nothing is written: files are prepared
+            (in parallel with `jobs`, and per device) and each target is
+            reserved in turn, so the names given to clashing files (`_1`,
+            `_2`, ...) follow the order the files are read in.
+
+            In a dry run without a plan file the files are only listed, and
+            the plan is empty. """
+        stats = self.stats
+        store = self.open_store(dst)
+        plan = Plan(dst, self.algorithm, self.copy_strategy,
+                    store=store.root if store else None)
+        names = NameIndex(self.algorithm, index, cache)
+        similar = SimilarityIndex(self.similar_distance) \
+            if self.similar else None
+
+        self.plan_trees(plan, dst)
+
+        if self.listing:
+            for root in sources(src):
+                if is_bundle(root):
+                    self.list_bundle(root)
+            src = [root for root in sources(src) if not is_bundle(root)]
+
+        for filepath, excluded, obj in self.gather(src, cache, journal):
+            if excluded:
+                stats.count('excluded')
+                stats.file_done(filepath, outcome='excluded')
+                logger.info(f"{filepath} -- NO PROCESS")
+                continue
+
+            if obj is None:
+                stats.count('ignored')
+                self.unspool(filepath)
+                continue
+
+            stats.count('videos' if isinstance(obj, Video) else 'photos')
+
+            if self.listing:
+                logger.info(filepath)
+                stats.file_done(filepath, obj.mime, obj.size, 'dry')
+                continue
+
+            with obj:
+                op = self.plan_one(obj, dst, index, names, store)
+            plan.add(op)
+
+            if op.action == DUPLICATE:
+                stats.count('duplicates')
+            elif similar is not None and obj.perceptual is not None:
+                self.add_similar(similar, op, obj.perceptual)
+
+            if self.dry_run:
+                detail = f' -> {op.target}' if op.target else ' -- DUPLICATE'
+                logger.info(f"{filepath}{detail}")
+                stats.file_done(filepath, op.mime, op.size, 'dry')
+            else:
+                op.seconds = stats.file_planned(filepath, op.mime, op.size)
+
+        if similar is not None:
+            self.similar_groups = similar.groups()
+
+        return plan
+
+    def unspool(self, filepath):
+        """ Remove `filepath` if it is a spooled bundle member, once it is
+            not going to be written anywhere. """
+        if self.spool is not None and self.spool.owns(filepath):
+            self.spool.discard(filepath)
+
+    def add_similar(self, similar, op, value):
+        """ Add the photo of `op`, with the perceptual hash `value`, to the
+            `SimilarityIndex` `similar` and report the photos it resembles.
+            Photos are named by their target, where they will be found. """
+        matches = similar.add(op.target, value)
+
+        if matches:
+            self.stats.count('similar')
+            logger.info(f"{op.src} -- SIMILAR TO {', '.join(matches)}")
+
+    def apply(self, plan, journal=None):
+        """ Carry out `plan`. "No process" directories are handled first.
+            Each target directory is then created once and the files going
+            into it are moved or copied together. A file which changed since
+            it was planned, or whose target has appeared meanwhile, is
+            skipped rather than overwritten.
+
+            @param  plan        The `Plan` to apply.
+            @param  journal     An optional open `Journal`. Each move and
+                                copy is recorded before and after it. """
+        stats = self.stats
+        store = Store(plan.store) if plan.store else None
+
+        for op in plan.trees():
+            if op.action == COPY_TREE:
+                shutil.copytree(op.src, op.target)
+            else:
+                shutil.move(op.src, op.target)
+
+        for op in plan:
+            if op.action != DUPLICATE:
+                continue
+
+            if journal is not None:
+                journal.record(journaling.DUPLICATE,
+                               COPY if self.copy else MOVE, op.src, op.size,
+                               op.digest)
+
+            logger.info(f"{op.src} -- DUPLICATE")
+            stats.file_done(op.src, op.mime, op.size, 'duplicate',
+                            op.seconds)
+
+        with Mover(self.algorithm, self.sync) as mover:
+            for directory, ops in plan.by_directory().items():
+                os.makedirs(directory, exist_ok=True)
+
+                for op in ops:
+                    self.apply_one(op, plan.copy_strategy, journal, store,
+                                   mover)
+
+    def apply_one(self, op, strategy='copy', journal=None, store=None,
+                  mover=None):
+        """ Move or copy the file of `op`, whose target directory exists.
+            With a content `Store` the file is moved or copied into the
+            store, unless it already holds it, and the target is a hard
+            link to it.
+
+            @param  mover   The `transfer.Mover` moving files. A file moved
+                            across filesystems is checked against the
+                            digest of `op`, and its source is removed, and
+                            the move journaled as done, once its batch is
+                            synced.
+
+            @returns    `True` if the file was written. """
+        stats = self.stats
+
+        if mover is None:
+            with Mover(self.algorithm, self.sync) as mover:
+                return self.apply_one(op, strategy, journal, store, mover)
+
+        try:
+            changed = os.path.getsize(op.src) != op.size
+        except FileNotFoundError:
+            changed = True
+
+        if changed:
+            logger.warning(f"{op.src} -- CHANGED SINCE PLANNED, SKIPPED")
+            return False
+
+        if os.path.lexists(op.target):
+            logger.error(f"{op.src} -- TARGET `{op.target}` EXISTS, SKIPPED")
+            return False
+
+        stored = store.path(op.digest) if store is not None else None
+
+        if journal is not None:
+            journal.record(journaling.PLANNED, op.action, op.src, op.size,
+                           op.digest, op.target, stored)
+
+        try:
+            with stats.timer('transfer', op.size, op.src, op.mime):
+                if store is not None:
+                    store.put(op.src, op.digest, op.action == MOVE,
+                              strategy, mover)
+                    store.link(stored, op.target)
+                elif op.action == MOVE:
+                    mover.move(op.src, op.target, op.digest)
+                else:
+                    copy_file(op.src, op.target, strategy)
+        except RuntimeError as e:
+            logger.error(f"{op.src} -- {e} SKIPPED")
+            return False
+
+        if journal is not None:
+            mover.after(lambda: journal.record(journaling.DONE, op.action,
+                                               op.src, op.size, op.digest,
+                                               op.target, stored))
+
+        logger.info(op.src)
+        stats.file_done(op.src, op.mime, op.size, 'sorted', op.seconds)
+        return True
+
+    def process_file(self, filepath, dst, cache=None, index=None,
+                     journal=None):
+        """ Sort a single file into `dst`, with the same checks as a full
+            run. Used by watch mode as files arrive.
+
+            @param  filepath    The file to sort.
+            @param  dst         The destination to move files to.
+            @param  cache       An optional open `MetadataCache`.
+            @param  index       An optional `ContentIndex` of `dst`.
+            @param  journal     An optional open `Journal`.
+
+            @returns    The sorted `Photo` or `Video` and whether it was a
+                        duplicate, or `(None, False)` if the file is not
+                        media. """
+        try:
+            obj = self.make_media(filepath, cache)
+        except (RuntimeError, FileNotFoundError):
+            # Gone again before it could be sorted.
+            return None, False
+
+        if obj is None:
+            return None, False
+
+        self.read_metadata(obj)
+        self.stats.count('videos' if isinstance(obj, Video) else 'photos')
+
+        store = self.open_store(dst)
+
+        with obj:
+            op = self.plan_one(obj, dst, index, store=store)
+
+        duplicate = op.action == DUPLICATE
+        if duplicate:
+            self.stats.count('duplicates')
+
+        if self.dry_run:
+            logger.info(filepath)
+        else:
+            self.apply(Plan(dst, self.algorithm, self.copy_strategy, [op],
+                            store.root if store else None), journal)
+
+        return obj, duplicate
+
+    def watch(self, src, dst, debounce=DEBOUNCE):
+        """ Sort the files already in `src`, then keep watching it and sort
+            new files as soon as they are completely written. The cache,
+            index and journal stay open between files. Runs until
+            interrupted. A file which fails to be sorted is logged and
+            left in place.
+
+            @param  src         The source directory to watch, or a list of
+                                them.
+            @param  dst         The destination to move files to.
+            @param  debounce    Seconds a new file must be left unchanged
+                                before it is sorted. """
+        for root in sources(src):
+            if not os.path.isdir(root):
+                logger.error(f"The specified source director `{root}` doest " +
+                             "not exist.")
+                return
+
+        self.stats = self.new_stats(src)
+        extensions = MEDIA_EXTENSIONS if self.filter_extensions else None
+        watcher = Watcher(sources(src),
+                          excludes=self.excludes,
+                          prune=list(self.noprocess or []) + [dst],
+                          extensions=extensions,
+                          debounce=debounce)
+
+        cache = self.open_cache(dst)
+        index = None
+        journal = None
+
+        try:
+            index = self.open_index(dst, cache)
+            journal = self.open_journal(dst)
+            self.run(src, dst, cache, index, journal)
+
+            logger.info(f"Watching `{'`, `'.join(sources(src))}`")
+
+            for filepath in watcher:
+                # A file which cannot be sorted, such as one with a
+                # malformed date or which cannot be read, is left in place.
+                try:
+                    self.process_file(filepath, dst, cache, index, journal)
+                except Exception:
+                    logger.exception(f"{filepath} -- FAILED")
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            self.stats.finish()
+            watcher.close()
+            if journal is not None:
+                journal.close()
+            if index is not None and not self.dry_run:
+                index.save()
+            if cache:
+                cache.close()
+
+    def run(self, src, dst, cache=None, index=None, journal=None):
+        """ Plan the sorting of `src` into `dst`, save the plan if asked to,
+            apply it unless this is a dry run and log a summary. """
+        plan = self.plan(src, dst, cache, index, journal)
+
+        if self.plan_file:
+            plan.save(self.plan_file)
+            logger.info(f"Plan: {self.plan_file} ({len(plan)} operations)")
+
+        if not self.dry_run:
+            self.apply(plan, journal)
+
+        self.log_summary()
+
+    def log_summary(self):
+        stats = self.stats
+        counters = stats.counters
+
+        logger.info(f"Processed {stats.done()} files")
+        logger.info(f"\tTotal videos...: {counters['videos']}")
+        logger.info(f"\tTotal photos...: {counters['photos']}")
+        logger.info(f"\tDuplicates.....: {counters['duplicates']}")
+        logger.info(f"\tExcluded.......: {counters['excluded']}")
+
+        if self.similar:
+            logger.info(f"\tSimilar........: {counters.get('similar', 0)} " +
+                        f"in {len(self.similar_groups)} groups")
+        stats.log()
 
     def process_files(self, src, dst):
         """ Kick off processing.
         
-            @param  src     The source directory to process.
+            @param  src     The source directory to process, or a list of
+                            them. Sources on different devices are read at
+                            the same time. A zip or tar file is read as a
+                            source without being extracted, and is left in
+                            place.
             @param  dst     The destination to move files to. """
-        if not os.path.isdir(src):
-            logger.error(f"The specified source director `{src}` doest not " +
-                         "exist.")
-            return
+        for root in sources(src):
+            if not os.path.isdir(root) and not is_bundle(root):
+                logger.error(f"The specified source director `{root}` doest " +
+                             "not exist.")
+                return
 
-        total_photos = 0
-        total_videos = 0
-        total_duplicates = 0
-        skipped = 0
+            # Members only exist in the spool during the run, so a plan
+            # could not be applied to them later.
+            if self.plan_file and is_bundle(root):
+                logger.error(f"A plan cannot be written for `{root}`; " +
+                             "extract it first or run without --plan.")
+                return
 
-        self.handle_no_process_dirs(dst) 
+        self.stats = self.new_stats(src)
+        cache = self.open_cache(dst)
+        index = None
+        journal = None
 
-        for f in Path(src).rglob("*"):
-            if not os.path.isfile(f):
-                continue
+        try:
+            index = self.open_index(dst, cache)
+            journal = self.open_journal(dst)
+            self.spool = self.open_spool(src, dst)
+            self.run(src, dst, cache, index, journal)
+        finally:
+            self.stats.finish()
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+            if journal is not None:
+                journal.close()
+            if index is not None and not self.dry_run:
+                index.save()
+            if cache:
+                cache.close()
 
-            filepath = f.as_posix()
+    def process_plan(self, path, dst=None):
+        """ Apply a plan saved by an earlier dry run, without walking,
+            hashing or parsing anything again.
 
-            if self.is_exclude_dir(filepath):
-                skipped = skipped + 1
-                logger.info(f"{filepath} -- NO PROCESS")
-                continue
+            @param  path    The plan file.
+            @param  dst     The destination directory, overriding the one
+                            recorded in the plan. """
+        plan = Plan.load(path, dst)
+        self.copy = any(op.action in (COPY, COPY_TREE) for op in plan)
 
-            mime = get_mimetype(filepath)
-            obj = None
+        if plan.algorithm:
+            self.algorithm = plan.algorithm
 
-            if is_video(mime):
-                obj = Video(filepath, mime)
-                total_videos = total_videos + 1
-            elif is_photo(mime):
-                obj = Photo(filepath, mime)
-                total_photos = total_photos + 1
+        self.stats = Stats(self.hooks)
+        for op in plan:
+            if op.action in (MOVE, COPY, DUPLICATE):
+                video = op.mime and is_video(op.mime)
+                self.stats.count('videos' if video else 'photos')
+            if op.action == DUPLICATE:
+                self.stats.count('duplicates')
 
-            if obj:
-                if self.dry_run:
-                    logger.info(filepath)
-                else:
-                    took_action = False
-                    if not self.copy:
-                        took_action = obj.move(dst)
-                    else:
-                        took_action = obj.copy(dst)
-
-                    if not took_action:
-                        total_duplicates = total_duplicates + 1
-
-                    detail = ' -- DUPLICATE' if not took_action else ''
-                    logger.info(f"{filepath}{detail}")
-
-        logger.info(f"Processed {total_photos+total_videos+skipped} files")
-        logger.info(f"\tTotal videos...: {total_videos}")
-        logger.info(f"\tTotal photos...: {total_photos}")
-        logger.info(f"\tDuplicates.....: {total_duplicates}")
-        logger.info(f"\tExcluded.......: {skipped}")
+        logger.info(f"Applying {path} to `{plan.dst}`")
+        journal = self.open_journal(plan.dst)
+
+        try:
+            self.apply(plan, journal)
+        finally:
+            self.stats.finish()
+            if journal is not None:
+                journal.close()
+
+        self.log_summary()
+
+
+def _done(obj, created=None):
+    """ Returns a future of `(obj, created)`, already resolved, in the
+        shape `_finish_one` expects. """
+    future = Future()
+    future.set_result((obj, created))
+    return future
+
+
+def sources(src):
+    """ Returns the source directory `src`, or the list of them, as a
+        list. """
+    if isinstance(src, str):
+        return [src]
+    return list(src)
+
+
+def read_created(cls, path, mime, head=None):
+    """ Returns the creation `datetime` of the media file at `path`, the
+        seconds it took and whether an external tool was needed. Runs in the
+        metadata process pool, so the file is not cached here.
+
+        @param  cls     `Photo` or `Video`.
+        @param  path    Path to the media file.
+        @param  mime    The MIME type of the file.
+        @param  head    The first bytes of the file, if already read. """
+    start = time.perf_counter()
+
+    with cls(path, mime, head=head) as obj:
+        created = obj.created()
+        return created, time.perf_counter() - start, obj.probed
@@ -0,0 +1,293 @@
+import sys
+import json
+import time
+import heapq
+import logging
+import threading
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The stages of sorting a file, in order. `ffprobe` is the part of `metadata`
+# spent in the external prober, for videos the native parser cannot read.
+# `perceptual` is the optional near-duplicate detection. `extract` is the
+# writing of zip and tar members to the spool.
+STAGES = ['walk', 'extract', 'mime', 'hash', 'metadata', 'ffprobe',
+          'perceptual', 'dedupe', 'transfer']
+
+# Number of slowest files kept.
+SLOWEST = 10
+
+# Seconds between progress updates.
+PROGRESS_INTERVAL = 1.0
+
+
+class Stats:
+    """ Collects timings and byte counts per stage, per MIME type and per
+        file during a run. Safe to update from the hashing threads.
+
+        Hooks are called with `(event, data)` for every event:
+
+        - `stage`: a stage finished for one file. `data` holds `stage`,
+          `seconds`, `bytes`, `path` and `mime`.
+        - `planned`: a file was planned, to be written once the plan is
+          applied. `data` holds `path`, `mime`, `bytes` and `seconds`.
+        - `file`: a file was handled. `data` holds `path`, `mime`, `bytes`,
+          `seconds` (the sum of its stages) and `outcome`, one of `sorted`,
+          `duplicate`, `excluded` or `dry`.
+        - `finish`: the run is over. `data` is `as_dict()`. """
+
+    def __init__(self, hooks=None, slowest=SLOWEST):
+        """ @param  hooks   Callables `hook(event, data)`.
+            @param  slowest Number of slowest files to keep. """
+        self.hooks = list(hooks or [])
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.finished = None
+        self.total = None
+        self.stages = {name: {'seconds': 0.0, 'files': 0, 'bytes': 0}
+                       for name in STAGES}
+        self.mimes = {}
+        self.counters = {'photos': 0, 'videos': 0, 'duplicates': 0,
+                         'excluded': 0, 'ignored': 0}
+        self.slowest_size = slowest
+        self.slowest = []
+        self.pending = {}
+
+    def add_hook(self, hook):
+        """ Register `hook(event, data)` to be called on every event. """
+        self.hooks.append(hook)
+
+    def _emit(self, event, data):
+        for hook in self.hooks:
+            try:
+                hook(event, data)
+            except Exception:
+                logger.exception(f"Stats hook {hook!r} failed")
+
+    def record(self, stage, seconds, size=0, path=None, mime=None):
+        """ Add `seconds` and `size` bytes to `stage`, and to the totals of
+            the file `path` and its MIME type if given. """
+        with self.lock:
+            totals = self.stages[stage]
+            totals['seconds'] = totals['seconds'] + seconds
+            totals['files'] = totals['files'] + 1
+            totals['bytes'] = totals['bytes'] + size
+
+            if path is not None:
+                self.pending[path] = self.pending.get(path, 0.0) + seconds
+
+            if mime is not None:
+                by_stage = self.mimes.setdefault(mime, {'files': 0,
+                                                        'bytes': 0,
+                                                        'stages': {}})
+                by_stage['stages'][stage] = \
+                    by_stage['stages'].get(stage, 0.0) + seconds
+
+        if self.hooks:
+            self._emit('stage', {'stage': stage, 'seconds': seconds,
+                                 'bytes': size, 'path': path, 'mime': mime})
+
+    @contextmanager
+    def timer(self, stage, size=0, path=None, mime=None):
+        """ Time the enclosed block as `stage`. See `record`. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, size, path, mime)
+
+    def timed(self, stage, iterable):
+        """ Yields from `iterable`, timing each step as `stage`. Used for the
+            lazy directory walk. """
+        it = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.record(stage, time.perf_counter() - start)
+                return
+            self.record(stage, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self, path):
+        """ Returns the seconds recorded so far for `path` and forgets
+            them. A file planned now and written later carries them itself,
+            so they are not held per path for the whole run. """
+        with self.lock:
+            return self.pending.pop(path, 0.0)
+
+    def file_planned(self, path, mime=None, size=0):
+        """ Note that `path` was planned. Returns the seconds recorded for
+            it so far, see `take`. """
+        seconds = self.take(path)
+
+        if self.hooks:
+            self._emit('planned', {'path': path, 'mime': mime, 'bytes': size,
+                                   'seconds': seconds})
+
+        return seconds
+
+    def file_done(self, path, mime=None, size=0, outcome='sorted',
+                  seconds=0.0):
+        """ Close the books on `path`: it counts towards its MIME type and
+            is ranked against the slowest files. `seconds` is added to the
+            time recorded for it, see `take`. """
+        with self.lock:
+            seconds = seconds + self.pending.pop(path, 0.0)
+
+            if mime is not None:
+                by_mime = self.mimes.setdefault(mime, {'files': 0,
+                                                       'bytes': 0,
+                                                       'stages': {}})
+                by_mime['files'] = by_mime['files'] + 1
+                by_mime['bytes'] = by_mime['bytes'] + size
+
+            entry = (seconds, path)
+            if len(self.slowest) < self.slowest_size:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+        if self.hooks:
+            self._emit('file', {'path': path, 'mime': mime, 'bytes': size,
+                                'seconds': seconds, 'outcome': outcome})
+
+    def done(self):
+        """ The number of files handled so far. """
+        return self.counters['photos'] + self.counters['videos'] + \
+            self.counters['excluded']
+
+    def finish(self):
+        """ Mark the run as over and call the `finish` hooks. """
+        self.finished = time.monotonic()
+        if self.hooks:
+            self._emit('finish', self.as_dict())
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        """ Returns every statistic as a dictionary of plain values. """
+        with self.lock:
+            return {
+                'elapsed': self.elapsed(),
+                'counters': dict(self.counters),
+                'stages': {k: dict(v) for k, v in self.stages.items()},
+                'mimes': {k: {'files': v['files'], 'bytes': v['bytes'],
+                              'stages': dict(v['stages'])}
+                          for k, v in self.mimes.items()},
+                'slowest': [{'path': p, 'seconds': s}
+                            for s, p in sorted(self.slowest, reverse=True)],
+            }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def log(self):
+        """ Log the time spent in each stage and the slowest files. """
+        elapsed = self.elapsed()
+
+        for name, totals in self.stages.items():
+            if not totals['files']:
+                continue
+
+            mb = totals['bytes'] / (1024 * 1024)
+            rate = f", {mb / totals['seconds']:.1f} MB/s" \
+                if mb and totals['seconds'] else ''
+            logger.info(f"\t{name:.<15}: {totals['seconds']:.2f}s{rate}")
+
+        logger.info(f"\t{'Elapsed':.<15}: {elapsed:.2f}s")
+
+        for seconds, path in sorted(self.slowest, reverse=True)[:3]:
+            if seconds:
+                logger.info(f"\tSlow: {path} ({seconds:.2f}s)")
+
+
+class Progress:
+    """ A `Stats` hook showing the number of files handled, the throughput
+        and, once the total is known, an ETA. Redraws a single line on a
+        terminal and logs a line at intervals otherwise.
+
+        While files are planned they are counted against the files found.
+        Once the plan is applied, the files written are counted against
+        the files planned. """
+
+    def __init__(self, stats, stream=None, interval=PROGRESS_INTERVAL):
+        """ @param  stats       The `Stats` of the run. Its `total` is read
+                                for the ETA when set.
+            @param  stream      Where to draw, standard error by default.
+            @param  interval    Minimum seconds between updates. """
+        self.stats = stats
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.last = 0.0
+        self.bytes = 0
+        self.planned = 0
+        self.applied = 0
+        self.applying = None
+
+    def line(self):
+        if self.applied:
+            done = self.applied
+            # Files sorted while watching were never planned.
+            total = max(self.planned, self.applied)
+            elapsed = time.monotonic() - self.applying
+            prefix = 'applied '
+        else:
+            done = self.stats.done() + self.stats.counters['ignored']
+            total = self.stats.total
+            elapsed = self.stats.elapsed()
+            prefix = ''
+
+        rate = done / elapsed if elapsed else 0.0
+        mb = self.bytes / (1024 * 1024)
+        text = f"{prefix}{done}"
+
+        if total:
+            text = f"{prefix}{done}/{total} ({100 * done / total:.0f}%)"
+
+        text = f"{text} files, {rate:.1f} files/s, " + \
+            f"{mb / elapsed if elapsed else 0:.1f} MB/s"
+
+        if total and rate:
+            eta = max(0, total - done) / rate
+            text = f"{text}, ETA {int(eta // 60)}m{int(eta % 60):02d}s"
+
+        return text
+
+    def __call__(self, event, data):
+        now = time.monotonic()
+
+        if event == 'planned':
+            self.planned = self.planned + 1
+            self.bytes = self.bytes + data['bytes']
+        elif event == 'file':
+            if data['outcome'] in ('sorted', 'duplicate'):
+                # The first file written starts the apply phase.
+                if not self.applied:
+                    self.applying = now
+                    self.bytes = 0
+                self.applied = self.applied + 1
+            self.bytes = self.bytes + data['bytes']
+        elif event != 'finish':
+            return
+
+        if event != 'finish' and now - self.last < self.interval:
+            return
+        self.last = now
+
+        if self.tty:
+            end = '\n' if event == 'finish' else ''
+            self.stream.write(f"\r\x1b[K{self.line()}{end}")
+            self.stream.flush()
+        elif event != 'finish':
+            logger.info(self.line())
@@ -0,0 +1,318 @@
+import os
+import errno
+import shutil
+import logging
+
+from sortmedia.hashing import DEFAULT_ALGORITHM, new_hasher, hash_file
+
+logger = logging.getLogger(__name__)
+
+COPY_STRATEGIES = ['copy', 'reflink', 'link', 'kernel']
+
+# `ioctl` request sharing the extents of one file with another (Linux,
+# supported by btrfs, XFS and others).
+FICLONE = 0x40049409
+
+# Number of bytes handed to `copy_file_range`/`sendfile` per call.
+KERNEL_CHUNK = 64 * 1024 * 1024
+
+# Size of the buffer a file moved across filesystems is copied through. It is
+# an anonymous memory map, so it is page aligned.
+MOVE_BUFFER = 8 * 1024 * 1024
+
+# Files moved across filesystems between two `fsync` batches. Their sources
+# are only removed once they are synced.
+SYNC_BATCH = 32
+
+# What each strategy falls back to when the filesystem cannot do it.
+_FALLBACK = {
+    'reflink': 'kernel',
+    'link': 'kernel',
+    'kernel': 'copy',
+}
+
+
+def reflink(src, dst):
+    """ Create `dst` as a copy-on-write clone of `src`. No data is copied. """
+    import fcntl
+
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            except OSError:
+                d.close()
+                os.remove(dst)
+                raise
+
+
+def hardlink(src, dst):
+    """ Create `dst` as a hard link to `src`. """
+    os.link(src, dst)
+
+
+def kernel_copy(src, dst):
+    """ Copy `src` to `dst` inside the kernel with `copy_file_range`, or
+        `sendfile` where that is unavailable, without passing the data
+        through user space. """
+    copy_range = getattr(os, 'copy_file_range', None)
+
+    if copy_range is None and not hasattr(os, 'sendfile'):
+        raise OSError("No in-kernel copy available.")
+
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            try:
+                remaining = os.fstat(s.fileno()).st_size
+                offset = 0
+
+                while remaining > 0:
+                    if copy_range:
+                        n = copy_range(s.fileno(), d.fileno(),
+                                       min(remaining, KERNEL_CHUNK))
+                    else:
+                        n = os.sendfile(d.fileno(), s.fileno(), offset,
+                                        min(remaining, KERNEL_CHUNK))
+                    # The source shrank, or the filesystem cannot copy
+                    # the rest: leave no truncated target behind.
+                    if n == 0:
+                        raise OSError(f"`{src}` was copied short.")
+                    offset = offset + n
+                    remaining = remaining - n
+            except OSError:
+                d.close()
+                os.remove(dst)
+                raise
+
+
+_STRATEGIES = {
+    'copy': shutil.copyfile,
+    'reflink': reflink,
+    'link': hardlink,
+    'kernel': kernel_copy,
+}
+
+
+def copy_file(src, dst, strategy='copy'):
+    """ Copy `src` to `dst`. If the filesystem does not support `strategy`,
+        for example a reflink across devices or a hard link on FAT, the next
+        cheapest strategy is tried, ending with a plain copy.
+
+        @param  src         The file to copy.
+        @param  dst         The path to create.
+        @param  strategy    One of `COPY_STRATEGIES`.
+
+        @returns    The strategy which was used. """
+    if strategy not in _STRATEGIES:
+        raise ValueError(f"Unknown copy strategy `{strategy}`.")
+
+    while True:
+        try:
+            _STRATEGIES[strategy](src, dst)
+            return strategy
+        except OSError as e:
+            fallback = _FALLBACK.get(strategy)
+
+            if fallback is None:
+                raise
+
+            logger.debug(f"{strategy} failed for `{src}` ({e}), " +
+                         f"trying {fallback}")
+            strategy = fallback
+
+
+def copy_hashed(src, dst, algorithm=DEFAULT_ALGORITHM, digest=None,
+                buffer_size=MOVE_BUFFER):
+    """ Copy `src` to the new file `dst` in a single pass, hashing the data
+        as it is written, so nothing is read twice.
+
+        @param  src         The file to copy.
+        @param  dst         The path to create. It must not exist.
+        @param  algorithm   The digest algorithm of `digest`.
+        @param  digest      The expected digest of `src`. If the data
+                            written does not match, `dst` is removed and a
+                            `RuntimeError` is raised. Without it, only the
+                            size is checked.
+        @param  buffer_size The size of the copy buffer.
+
+        @returns    The descriptor of `dst`, still open so it can be synced,
+                    and the digest of the data written. """
+    import mmap
+
+    hasher = new_hasher(algorithm)
+    buf = mmap.mmap(-1, buffer_size)
+    view = memoryview(buf)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    try:
+        with open(src, 'rb', buffering=0) as s:
+            size = os.fstat(s.fileno()).st_size
+            written = 0
+
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(s.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
+
+            if size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    pass
+
+            while True:
+                n = s.readinto(view)
+                if not n:
+                    break
+
+                with view[:n] as chunk:
+                    hasher.update(chunk)
+                    offset = 0
+                    while offset < n:
+                        offset = offset + os.write(fd, chunk[offset:])
+                written = written + n
+
+        written_digest = hasher.digest()
+
+        if written != size or \
+                (digest is not None and written_digest != digest):
+            raise RuntimeError(f"`{src}` changed while it was copied to " +
+                               f"`{dst}`.")
+    except BaseException:
+        os.close(fd)
+        os.remove(dst)
+        raise
+    finally:
+        view.release()
+        buf.close()
+
+    return fd, written_digest
+
+
+class Mover:
+    """ Moves files, by renaming them where source and target are on the
+        same filesystem. Across filesystems a file is copied in one pass
+        through a large buffer with its digest computed on the way, and the
+        source is only removed once that digest matches and the copy is on
+        disk. Copies are synced in batches, as an `fsync` per file would
+        cost more than the copy of small files. """
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM, sync=SYNC_BATCH,
+                 buffer_size=MOVE_BUFFER):
+        """ @param  algorithm   The digest algorithm of the digests given to
+                                `move`.
+            @param  sync        The number of files copied across
+                                filesystems per `fsync` batch. `0` does not
+                                sync, and removes each source as soon as its
+                                copy is verified.
+            @param  buffer_size The size of the copy buffer. """
+        self.algorithm = algorithm
+        self.sync = max(0, sync or 0)
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def move(self, src, dst, digest=None):
+        """ Move `src` to `dst`. A copied file's source is removed at the
+            end of its batch, see `after`.
+
+            @param  src     The file to move.
+            @param  dst     The path to move it to.
+            @param  digest  The digest of `src`, checked against the copy
+                            when moving across filesystems. Without it,
+                            `src` is read a second time and hashed before
+                            it is removed.
+
+            @returns    `True` if the file was renamed, `False` if it was
+                        copied. """
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        else:
+            return True
+
+        fd, written = copy_hashed(src, dst, self.algorithm, digest,
+                                  self.buffer_size)
+
+        # Only the size was checked while copying.
+        if digest is None and hash_file(src, self.algorithm) != written:
+            os.close(fd)
+            os.remove(dst)
+            raise RuntimeError(f"`{src}` changed while it was copied to " +
+                               f"`{dst}`.")
+
+        shutil.copystat(src, dst)
+
+        if not self.sync:
+            os.close(fd)
+            fd = None
+
+        self.pending.append((src, dst, fd))
+
+        if len(self.pending) >= max(1, self.sync):
+            self.flush()
+
+        return False
+
+    def flush(self):
+        """ Sync the pending copies and their directories, then remove their
+            sources. """
+        pending, self.pending = self.pending, []
+        directories = set()
+
+        for _, dst, fd in pending:
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                directories.add(os.path.dirname(dst) or '.')
+
+        # The new directory entries have to reach the disk as well.
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+        for src, _, _ in pending:
+            os.remove(src)
+
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def after(self, callback):
+        """ Call `callback` once the sources of every file moved so far are
+            removed: now, or when the pending batch is flushed. """
+        if self.pending:
+            self.callbacks.append(callback)
+        else:
+            callback()
+
+    def close(self):
+        """ Finish the pending batch. """
+        self.flush()
+
+
+def move_file(src, dst, digest=None, algorithm=DEFAULT_ALGORITHM):
+    """ Move `src` to `dst` with a `Mover`, syncing a copy across
+        filesystems before the source is removed.
+
+        @returns    `True` if the file was renamed, `False` if it was
+                    copied. """
+    with Mover(algorithm, sync=1) as mover:
+        return mover.move(src, dst, digest)
@@ -1,26 +1,104 @@
-import magic
-import filetype
+import os
+import threading
+
 from enum import Enum
 
+# Number of bytes read from the start of each file. The same buffer is used
+# for MIME detection, for metadata parsing and as the start of the digest.
+HEAD_SIZE = 64 * 1024
+
+# libmagic handles are expensive to open and may not be shared between
+# threads, so one is kept per thread.
+_magic = threading.local()
+
 class Safety(Enum):
     SAFE = 1
     UNSAFE = 2
     IDENTICAL = 3
 
 
-def get_mimetype(path):
+class HeadReader:
+    """ A read only, seekable file object for a file whose first bytes are
+        already in memory. Reads within `head` never touch the disk, and the
+        underlying file is only opened when reading past it. """
+
+    def __init__(self, head, size, opener):
+        """ @param  head    The first bytes of the file.
+            @param  size    The size of the file in bytes.
+            @param  opener  A callable returning an open binary file object
+                            for the whole file. """
+        self.head = head
+        self.size = size
+        self.opener = opener
+        self.pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset = self.pos + offset
+        elif whence == os.SEEK_END:
+            offset = self.size + offset
+
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else self.pos + n
+
+        if end <= len(self.head) or len(self.head) >= self.size:
+            data = self.head[self.pos:end]
+        else:
+            fp = self.opener()
+            fp.seek(self.pos)
+            data = fp.read(end - self.pos)
+
+        self.pos = self.pos + len(data)
+        return data
+
+    def fileno(self):
+        return self.opener().fileno()
+
+
+def _magic_instance():
+    if not hasattr(_magic, 'instance'):
+        # libmagic is only loaded for files `filetype` does not recognise.
+        import magic
+        _magic.instance = magic.Magic()
+    return _magic.instance
+
+
+def get_mimetype(path, cache=None, head=None):
     """ Get the mimetype of the given file pointer.
         @param  path    Path to a file to get the MIME for.
+        @param  cache   An optional `MetadataCache` to read the MIME type from
+                        and store it in.
+        @param  head    The first bytes of the file, if already read. The file
+                        is not opened again when given.
         @return     A string representing the mimetype or `None` if no MIME
                     coul be discerned. """
-    guess = filetype.guess(path)
+    if cache:
+        mime = cache.get_mime(path)
+        if mime:
+            return mime
+
+    import filetype
+
+    guess = filetype.guess(path if head is None else head)
 
     if guess:
-        return guess.mime
+        mime = guess.mime
+    elif head is not None:
+        # If we were unable to guess the MIME, attempt to use filemagic.
+        mime = _magic_instance().id_buffer(head)
+    else:
+        mime = _magic_instance().id_filename(path)
+
+    if cache and mime:
+        cache.set_mime(path, mime)
 
-    # If we were unable to guess the MIME, attempt to use filemagic.
-    with magic.Magic() as m:
-        return m.id_filename(path)
+    return mime
 
 def is_video(mime):
     """ Returns `True` if the specified file pointer represents a video.
@@ -1,39 +1,46 @@
-import json
-
 from datetime import datetime
 from sortmedia.file import File
-from subprocess import check_output
+from sortmedia.bmff import read_video_dates
+from sortmedia.probe import probe
 
 
 class Video(File):
-    def creation_date(self):
-        """ Returns the creation date based on the file's EXIF data. """
-        super().creation_date()
-
-        created_str = self.exif.get('creation_time')
+    def parse_date(self, exif):
+        """ Returns the creation date found in the video's metadata. """
+        created_str = exif.get('creation_time')
 
         if not created_str:
             return None
 
-        parsed = datetime.strptime(created_str, "%Y-%m-%dT%H:%M:%S.000000Z")
-        return {
-            'year': str(parsed.year),
-            'month': str(parsed.strftime("%B")),
-            'day': str(parsed.day)
-        }
+        return datetime.strptime(created_str, "%Y-%m-%dT%H:%M:%S.000000Z")
 
-    def get_exif(self):
-        """ Returns the EXIF data for a photo. Includes support for HEIC file
-            format. """
-        cmd = ['ffprobe', '-v', 'quiet', self.fp.name, '-print_format', 'json',
-               '-show_entries',
-               'stream=index,codec_type:stream_tags=creation_time:' +
-               'format_tags=creation_time']
-        out = check_output(cmd)
-        j = json.loads(out)
-        streams = j.get("streams", {})
-
-        if len(streams) == 0:
-            return None
+    def native_exif(self):
+        """ Returns the metadata tags read natively from the `moov` box of an
+            MP4 or MOV file, or `None` if the box parser cannot read it. """
+        return read_video_dates(self.reader())
+
+    def native_created(self):
+        """ Reads the creation date without running `ffprobe`.
 
-        return streams[0].get("tags", None)
+            @returns    `True` if the date is now known, `False` if the file
+                        has to be probed. """
+        if self.date_known():
+            return True
+
+        tags = self.native_exif()
+        if tags is None:
+            return False
+
+        self.set_created(self.parse_date(tags) if tags else None)
+        return True
+
+    def get_exif(self):
+        """ Returns the metadata tags of a video. MP4 and MOV files are read
+            natively from their `moov` box. Other formats, and files the box
+            parser cannot read, are passed to `ffprobe`. """
+        tags = self.native_exif()
+        if tags is not None:
+            return tags
+
+        self.probed = True
+        return probe(self.path)
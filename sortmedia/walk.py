@@ -0,0 +1,87 @@
+import os
+
+# File extensions of the photo and video formats sortmedia handles. Used to
+# skip other files before their contents are sniffed.
+MEDIA_EXTENSIONS = {
+    # Photos
+    '.jpg', '.jpeg', '.jpe', '.png', '.gif', '.bmp', '.tif', '.tiff',
+    '.webp', '.heic', '.heif', '.dng', '.cr2', '.cr3', '.nef', '.arw',
+    '.orf', '.rw2', '.raf', '.psd', '.jxr', '.ico',
+    # Videos
+    '.mp4', '.m4v', '.mov', '.qt', '.avi', '.mkv', '.webm', '.wmv', '.flv',
+    '.mpg', '.mpeg', '.mts', '.m2ts', '.3gp', '.3g2',
+}
+
+
+def _normalize(paths):
+    return {os.path.normpath(os.path.abspath(p)) for p in paths or []}
+
+
+def scan(root, excludes=None, prune=None, extensions=None,
+         follow_symlinks=False):
+    """ Walks `root` with `os.scandir`, yielding entries as they are found so
+        memory stays flat however large the tree is. File types come from
+        the directory listing, so no extra `stat` is made per entry.
+
+        Yields `(path, excluded)` tuples. `excluded` is `False` for a regular
+        file and `True` for a directory listed in `excludes`, which is not
+        descended into.
+
+        Symlinked directories are skipped, unless `follow_symlinks` is set.
+        They are then followed unless they point back into the tree or to a
+        directory which was already walked.
+
+        @param  root        The directory to walk.
+        @param  excludes    Directories which are reported and skipped.
+        @param  prune       Directories which are skipped silently.
+        @param  extensions  Optional set of lower case extensions, including
+                            the dot. Other files are not yielded.
+        @param  follow_symlinks Descend into symlinked directories, which
+                                may lead outside `root`. """
+    excludes = _normalize(excludes)
+    prune = _normalize(prune)
+    real_root = os.path.realpath(root)
+    followed = set()
+    stack = [os.path.normpath(root)]
+
+    while stack:
+        directory = stack.pop()
+        subdirs = []
+
+        try:
+            it = os.scandir(directory)
+        except (PermissionError, FileNotFoundError):
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    full = os.path.normpath(os.path.abspath(entry.path))
+
+                    if full in excludes:
+                        yield entry.path, True
+                        continue
+
+                    if full in prune:
+                        continue
+
+                    if entry.is_symlink():
+                        target = os.path.realpath(entry.path)
+                        inside = target == real_root or \
+                            target.startswith(real_root + os.sep)
+
+                        if inside or target in followed:
+                            continue
+                        followed.add(target)
+
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    if extensions is not None:
+                        ext = os.path.splitext(entry.name)[1].lower()
+                        if ext not in extensions:
+                            continue
+
+                    yield entry.path, False
+
+        # Descend in listing order.
+        stack.extend(reversed(subdirs))
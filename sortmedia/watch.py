@@ -0,0 +1,262 @@
+import os
+import time
+import errno
+import select
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds a file must go without events, and without changing size, before
+# it is considered completely written.
+DEBOUNCE = 2.0
+
+# inotify event flags, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT = struct.Struct('iIII')
+BUFFER_SIZE = 64 * 1024
+
+
+class Inotify:
+    """ A minimal `ctypes` binding to the Linux inotify API. """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.ctypes = ctypes
+        path = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(path, use_errno=True)
+
+        if not hasattr(libc, 'inotify_init1'):
+            raise RuntimeError("Watch mode requires Linux inotify.")
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise RuntimeError(f"inotify_init1 failed: {os.strerror(e)}")
+
+    def add_watch(self, path, mask):
+        """ Returns the watch descriptor of `path`, or `None` if it cannot
+            be watched (it vanished, or the watch limit was reached). """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+
+        if wd < 0:
+            e = self.ctypes.get_errno()
+            if e == errno.ENOSPC:
+                logger.error(f"Cannot watch `{path}`: the inotify watch " +
+                             "limit (fs.inotify.max_user_watches) is reached")
+            return None
+
+        return wd
+
+    def read(self, timeout=None):
+        """ Waits up to `timeout` seconds for events and returns a list of
+            `(wd, mask, name)` tuples. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset = offset + EVENT.size
+            name = data[offset:offset + length].rstrip(b'\x00')
+            offset = offset + length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher:
+    """ Watches a directory tree and reports files once they are completely
+        written. Only the directories are watched, so the cost while idle is
+        a blocked `select` on one descriptor.
+
+        A file is ready once it has been closed after writing, or moved into
+        the tree, and then has had no events for `debounce` seconds with its
+        size unchanged. Creating or writing to a file only restarts the
+        debounce of a file already pending. """
+
+    def __init__(self, root, excludes=None, prune=None, extensions=None,
+                 debounce=DEBOUNCE):
+        """ Start watching `root`.
+
+            @param  root        The directory to watch, recursively, or a
+                                list of them.
+            @param  excludes    Directories which are not watched.
+            @param  prune       More directories which are not watched, such
+                                as the destination when it lies inside
+                                `root`.
+            @param  extensions  Optional set of lower case extensions,
+                                including the dot. Other files are ignored.
+            @param  debounce    Quiet period in seconds before a file is
+                                reported. """
+        self.roots = [root] if isinstance(root, str) else list(root)
+        self.excludes = list(excludes or []) + list(prune or [])
+        self.extensions = extensions
+        self.debounce = debounce
+        self.inotify = Inotify()
+        self.dirs = {}
+        self.pending = {}
+
+        for directory in self.roots:
+            self.add_tree(directory, enqueue=False)
+
+    def _skipped(self, path):
+        full = os.path.normpath(os.path.abspath(path))
+
+        for parent in self.excludes:
+            parent = os.path.normpath(os.path.abspath(parent))
+            if full == parent or full.startswith(parent + os.sep):
+                return True
+
+        return False
+
+    def _wanted(self, path):
+        if self.extensions is None:
+            return True
+        return os.path.splitext(path)[1].lower() in self.extensions
+
+    def add_tree(self, directory, enqueue=True):
+        """ Watch `directory` and every directory below it. With `enqueue`,
+            files already in the tree are queued, as they may have been
+            written before the watch was in place. """
+        if self._skipped(directory):
+            return
+
+        for parent, subdirs, files in os.walk(directory):
+            wd = self.inotify.add_watch(parent, WATCH_MASK)
+            if wd is not None:
+                self.dirs[wd] = parent
+
+            subdirs[:] = [d for d in subdirs
+                          if not self._skipped(os.path.join(parent, d))]
+
+            if enqueue:
+                for name in files:
+                    self.touch(os.path.join(parent, name))
+
+    def touch(self, path):
+        """ Mark `path` as written now, restarting its debounce. """
+        if not self._wanted(path):
+            return
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        self.pending[path] = (time.monotonic() + self.debounce, size)
+
+    def handle(self, wd, mask, name):
+        """ Update the pending files for one inotify event. """
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflowed, rescanning")
+            for directory in self.roots:
+                self.add_tree(directory)
+            return
+
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+
+        directory = self.dirs.get(wd)
+        if directory is None or not name:
+            return
+
+        path = os.path.join(directory, name)
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            return
+
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.touch(path)
+        elif mask & (IN_CREATE | IN_MODIFY) and path in self.pending:
+            # A file still open for writing is never ready, however long
+            # its writer stalls.
+            self.touch(path)
+
+    def ready(self):
+        """ Returns the pending files whose debounce has passed, removing
+            them from the queue. A file which changed size meanwhile is
+            queued again. """
+        now = time.monotonic()
+        done = []
+
+        for path, (deadline, size) in list(self.pending.items()):
+            if deadline > now:
+                continue
+
+            try:
+                current = os.path.getsize(path)
+            except OSError:
+                del self.pending[path]
+                continue
+
+            if current != size:
+                self.touch(path)
+                continue
+
+            del self.pending[path]
+            done.append(path)
+
+        return sorted(done)
+
+    def poll(self, timeout=None):
+        """ Wait up to `timeout` seconds, or until the next pending file is
+            due, and return the files which are ready. """
+        if self.pending:
+            due = min(d for d, _ in self.pending.values())
+            wait = max(0, due - time.monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        for event in self.inotify.read(timeout):
+            self.handle(*event)
+
+        return self.ready()
+
+    def __iter__(self):
+        """ Yields files as they become ready, forever. """
+        while True:
+            for path in self.poll():
+                yield path
+
+    def close(self):
+        self.inotify.close()
@@ -1,16 +1,43 @@
 import os
 import sys
+import errno
 import shutil
 import piexif
 import unittest
 import random
 import string
+import hashlib
+import json
+import time
+import threading
 
 from PIL import Image
 from subprocess import check_output
+from unittest import mock
 from unittest.mock import MagicMock
 
 from sortmedia import util
+from sortmedia import hashing
+from sortmedia import exif as fastexif
+from sortmedia import bmff
+from sortmedia.walk import scan
+from sortmedia import transfer
+from sortmedia.cache import MetadataCache
+from sortmedia.index import ContentIndex
+from sortmedia.journal import Journal
+from sortmedia.watch import Watcher
+from sortmedia.stats import Stats, Progress
+from sortmedia import plan as plan_mod
+from sortmedia.plan import Plan, Operation
+from sortmedia.names import NameIndex
+from sortmedia.archive import Store, store_root
+from sortmedia import bundle
+from sortmedia import devices
+from sortmedia import similar
+from sortmedia.probe import ProbePool, probe
+from benchmarks import corpus
+from benchmarks.run import run_stage
+from benchmarks import startup
 from sortmedia.util import Safety
 from sortmedia.photo import Photo
 from sortmedia.video import Video 
@@ -96,6 +123,16 @@ class TestFile(unittest.TestCase):
         target = photo.target_path('foobar')
         self.assertEqual(target, 'foobar/2099/September/29/foobar.jpg')
 
+    def test_only_date_kept(self):
+        img = create_file(50, 50, 'red')
+        photo = Photo(img, 'image/jpeg')
+        photo.created()
+        self.assertFalse(hasattr(photo, 'exif'))
+
+        exif = {'DateTimeOriginal': '2001:02:03 04:05:06', 'Make': 'x'}
+        photo = Photo(img, 'image/jpeg', exif)
+        self.assertEqual(photo.created().year, 2001)
+
     def test_ignore_duplicate_at_target(self):
         img_a = create_file(50, 50, 'blue', name='ham')
         photo = Photo(img_a, 'image/jpeg')
@@ -157,6 +194,109 @@ class TestFile(unittest.TestCase):
                                        '29/ham.jpg'))
 
 
+class TestLazyFile(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def test_nothing_read_on_init(self):
+        img = create_file(50, 50, 'blue')
+        photo = Photo(img, 'image/jpeg')
+        self.assertIsNone(photo._fp)
+        self.assertIsNone(photo._hash)
+
+    def test_hash_memoized(self):
+        img = create_file(50, 50, 'blue')
+        photo = Photo(img, 'image/jpeg')
+        photo.get_hash = MagicMock(return_value=b'digest')
+        self.assertEqual(photo.hash, b'digest')
+        self.assertEqual(photo.hash, b'digest')
+        photo.get_hash.assert_called_once()
+
+    def test_context_manager(self):
+        img = create_file(50, 50, 'blue')
+        with Photo(img, 'image/jpeg') as photo:
+            self.assertEqual(photo.creation_date()['year'], '2099')
+            fp = photo._fp
+            self.assertFalse(fp.closed)
+        self.assertTrue(fp.closed)
+        self.assertIsNone(photo._fp)
+
+        # The handle is reopened if needed again.
+        self.assertEqual(len(photo.hash), 32)
+
+    def test_missing_file(self):
+        with self.assertRaises(RuntimeError):
+            Photo('test_files/missing.jpg', 'image/jpeg')
+
+    def test_dry_run_does_not_hash(self):
+        create_file(50, 50, 'blue', name='spam')
+        ms = SortMedia(dry=True)
+        with mock.patch.object(Photo, 'get_hash') as get_hash:
+            ms.process_files('test_files/', 'test_move/')
+
+        get_hash.assert_not_called()
+        self.assertEqual(ms.stats.counters['photos'], 1)
+        self.assertFalse(os.path.exists('test_move'))
+
+
+class TestSinglePass(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def test_one_open_per_file(self):
+        img = create_file(50, 50, 'blue', name='ham')
+        ms = SortMedia()
+
+        with mock.patch('builtins.open', wraps=open) as opened:
+            obj = ms.make_media(img)
+            self.assertEqual(obj.creation_date()['year'], '2099')
+            paths = [c[0][0] for c in opened.call_args_list]
+
+        self.assertEqual(paths.count(img), 1)
+        with open(img, 'rb') as f:
+            self.assertEqual(obj.hash, hashlib.sha256(f.read()).digest())
+
+    def test_large_file_digest(self):
+        path = 'test_files/big.jpg'
+        with open(path, 'wb') as f:
+            f.write(b'\xff\xd8\xff' + os.urandom(util.HEAD_SIZE * 3))
+
+        obj = SortMedia().make_media(path)
+        with open(path, 'rb') as f:
+            self.assertEqual(obj.hash, hashlib.sha256(f.read()).digest())
+
+    def test_head_reader(self):
+        data = bytes(range(256)) * 4
+        with open('test_files/blob', 'wb') as f:
+            f.write(data)
+
+        opener = MagicMock(side_effect=lambda: open('test_files/blob', 'rb'))
+        reader = util.HeadReader(data[:100], len(data), opener)
+        self.assertEqual(reader.read(10), data[:10])
+        reader.seek(90)
+        self.assertEqual(reader.read(10), data[90:100])
+        opener.assert_not_called()
+
+        self.assertEqual(reader.read(20), data[100:120])
+        self.assertEqual(reader.seek(-4, os.SEEK_END), len(data) - 4)
+        self.assertEqual(reader.read(), data[-4:])
+
+    def test_mimetype_from_head(self):
+        img = create_file(50, 50, 'blue', name='ham')
+        with open(img, 'rb') as f:
+            head = f.read(util.HEAD_SIZE)
+        self.assertEqual(util.get_mimetype('missing', head=head),
+                         'image/jpeg')
+
+
 class TestPhoto(unittest.TestCase):
     def test_heic(self):
         photo = Photo('tests/files/lime.heic', 'image/heic')
@@ -164,6 +304,121 @@ class TestPhoto(unittest.TestCase):
         self.assertEqual(target, 'foo/2017/October/19/lime.heic')
 
 
+class TestExif(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def read(self, path, mime):
+        with open(path, 'rb') as f:
+            return fastexif.read_dates(f, mime)
+
+    def test_jpeg(self):
+        img = create_file(50, 50, 'blue')
+        self.assertEqual(self.read(img, 'image/jpeg'),
+                         {'DateTimeOriginal': '2099:09:29 10:10:10'})
+
+    def test_jpeg_without_exif(self):
+        Image.new('RGB', (10, 10)).save('test_files/a.jpg', 'jpeg')
+        self.assertEqual(self.read('test_files/a.jpg', 'image/jpeg'), {})
+
+    def test_png(self):
+        img = Image.new('RGB', (10, 10))
+        img.save('test_files/a.png', 'png', exif=faux_exif())
+        self.assertEqual(self.read('test_files/a.png', 'image/png'),
+                         {'DateTimeOriginal': '2099:09:29 10:10:10'})
+
+    def test_tiff(self):
+        img = Image.new('RGB', (10, 10))
+        exif = img.getexif()
+        exif[0x0132] = '2001:02:03 04:05:06'
+        img.save('test_files/a.tiff', 'tiff', exif=exif)
+        self.assertEqual(self.read('test_files/a.tiff', 'image/tiff'),
+                         {'DateTime': '2001:02:03 04:05:06'})
+
+    def test_corrupt_falls_back(self):
+        with open('test_files/a.jpg', 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe1\x00')
+        self.assertIsNone(self.read('test_files/a.jpg', 'image/jpeg'))
+        self.assertIsNone(self.read('test_files/a.jpg', 'image/gif'))
+
+    def test_matches_pil(self):
+        img = create_file(50, 50, 'blue', name='ham')
+        photo = Photo(img, 'image/jpeg')
+        fast = photo.get_exif()
+
+        with Image.open(img) as pil:
+            slow = {k: v for k, v in pil._getexif().items()
+                    if k in fastexif.DATE_TAGS}
+        self.assertEqual(fast, {fastexif.DATE_TAGS[k]: v
+                                for k, v in slow.items()})
+
+
+def box(kind, payload=b''):
+    return (8 + len(payload)).to_bytes(4, 'big') + kind + payload
+
+
+class TestBmff(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def write(self, data):
+        with open('test_files/a.mov', 'wb') as f:
+            f.write(data)
+        return open('test_files/a.mov', 'rb')
+
+    def test_mp4(self):
+        with open('tests/files/video.mp4', 'rb') as f:
+            self.assertEqual(bmff.read_video_dates(f),
+                             {'creation_time': '2015-12-25T18:34:56.000000Z'})
+
+    def test_quicktime_creationdate(self):
+        mvhd = box(b'mvhd', bytes(100))
+        key = box(b'mdta', bmff.QUICKTIME_CREATIONDATE)
+        keys = box(b'keys', bytes(4) + (1).to_bytes(4, 'big') + key)
+        data = box(b'data', bytes(8) + b'2019-07-04T23:30:00-0700')
+        ilst = box(b'ilst', box((1).to_bytes(4, 'big'), data))
+        meta = box(b'meta', box(b'hdlr', bytes(25)) + keys + ilst)
+        moov = box(b'moov', mvhd + meta)
+
+        with self.write(box(b'ftyp', b'qt  ') + box(b'mdat') + moov) as f:
+            self.assertEqual(bmff.read_video_dates(f),
+                             {'creation_time': '2019-07-05T06:30:00.000000Z'})
+
+    def test_no_creation_time(self):
+        moov = box(b'moov', box(b'mvhd', bytes(100)))
+        with self.write(box(b'ftyp', b'isom') + moov) as f:
+            self.assertEqual(bmff.read_video_dates(f), {})
+
+    def test_not_bmff(self):
+        with self.write(b'RIFF\x00\x00\x00\x00AVI LIST') as f:
+            self.assertIsNone(bmff.read_video_dates(f))
+            self.assertIsNone(bmff.read_heic_exif(f))
+
+    def test_truncated(self):
+        with self.write(box(b'ftyp', b'isom') + b'\x00\x00\x10\x00moov') as f:
+            self.assertIsNone(bmff.read_video_dates(f))
+
+    def test_heic(self):
+        with open('tests/files/lime.heic', 'rb') as f:
+            dates = bmff.read_heic_exif(f)
+        self.assertEqual(dates['DateTimeOriginal'], '2017:10:19 15:19:37')
+
+    def test_heic_without_pyheif(self):
+        photo = Photo('tests/files/lime.heic', 'image/heic')
+        with mock.patch('pyheif.read_heif') as read_heif:
+            self.assertEqual(photo.target_path('foo'),
+                             'foo/2017/October/19/lime.heic')
+            read_heif.assert_not_called()
+
+
 class TestVideo(unittest.TestCase):
     def test_creation_date(self):
         video = Video('tests/files/video.mp4', 'video/mp4')
@@ -193,6 +448,1471 @@ class TestUtil(unittest.TestCase):
         self.assertFalse(util.is_photo('video/mp4'))
 
 
+class TestHashing(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def test_hash_file_chunked(self):
+        data = os.urandom(hashing.CHUNK_SIZE * 2 + 17)
+        with open('test_files/blob', 'wb') as f:
+            f.write(data)
+
+        self.assertEqual(hashlib.sha256(data).digest(),
+                         hashing.hash_file('test_files/blob'))
+        self.assertEqual(hashlib.blake2b(data).digest(),
+                         hashing.hash_file('test_files/blob', 'blake2b'))
+
+    def test_hash_file_mmap(self):
+        data = os.urandom(hashing.MMAP_THRESHOLD + 5)
+        with open('test_files/blob', 'wb') as f:
+            f.write(data)
+
+        self.assertEqual(hashlib.sha256(data).digest(),
+                         hashing.hash_file('test_files/blob'))
+
+    def test_empty_file(self):
+        open('test_files/empty', 'wb').close()
+        self.assertEqual(hashlib.sha256(b'').digest(),
+                         hashing.hash_file('test_files/empty'))
+
+    def test_algorithm_recorded(self):
+        img = create_file(50, 50, 'blue')
+        photo = Photo(img, 'image/jpeg', algorithm='blake2b')
+        self.assertEqual(photo.algorithm, 'blake2b')
+        with open(img, 'rb') as f:
+            self.assertEqual(photo.hash, hashlib.blake2b(f.read()).digest())
+
+    def test_unknown_algorithm(self):
+        self.assertNotIn('md4', hashing.available_algorithms())
+        with self.assertRaises(ValueError):
+            SortMedia(algorithm='md4')
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def test_round_trip(self):
+        img = create_file(50, 50, 'blue', name='ham')
+        cache = MetadataCache('test_files/cache/cache.db')
+        photo = Photo(img, 'image/jpeg', cache=cache)
+        digest = photo.hash
+        self.assertEqual(photo.creation_date()['year'], '2099')
+        self.assertEqual(util.get_mimetype(img, cache), 'image/jpeg')
+        cache.close()
+
+        cache = MetadataCache('test_files/cache/cache.db')
+        self.assertEqual(cache.get_mime(img), 'image/jpeg')
+        self.assertEqual(cache.get_digest(img, 'sha256'), digest)
+        self.assertIsNone(cache.get_digest(img, 'blake2b'))
+
+        # A cached file is neither hashed nor parsed again.
+        photo = Photo(img, 'image/jpeg', cache=cache)
+        photo.get_exif = MagicMock()
+        self.assertEqual(photo.creation_date()['month'], 'September')
+        photo.get_exif.assert_not_called()
+        cache.close()
+
+    def test_invalidate_on_change(self):
+        img = create_file(50, 50, 'blue', name='ham')
+        cache = MetadataCache('test_files/cache.db')
+        cache.set_mime(img, 'image/jpeg')
+        cache.flush()
+
+        with open(img, 'ab') as f:
+            f.write(b'more')
+
+        self.assertIsNone(cache.get_mime(img))
+        cache.close()
+
+    def test_replaced_file(self):
+        img = create_file(50, 50, 'blue', name='IMG_0001')
+        cache = MetadataCache('test_files/cache.db')
+        cache.set_digest(img, 'sha256', b'old')
+
+        # Another file appears at the same path, without a flush between.
+        other = create_file(50, 50, 'red', name='other')
+        os.replace(other, img)
+
+        self.assertIsNone(cache.get_digest(img, 'sha256'))
+        cache.close()
+
+    def test_eviction(self):
+        cache = MetadataCache('test_files/cache.db', max_entries=2)
+        for i in range(4):
+            path = create_file(10, 10, 'red', name=f'img{i}')
+            cache.set_mime(path, 'image/jpeg')
+        cache.close()
+
+        cache = MetadataCache('test_files/cache.db')
+        count = cache.db.execute('SELECT COUNT(*) FROM entries').fetchone()
+        self.assertEqual(count[0], 2)
+        cache.close()
+
+    def test_process_files_with_cache(self):
+        create_file(50, 50, 'blue', name='spam')
+        ms = SortMedia(copy=True, cache=True)
+        ms.process_files('test_files/', 'test_files/out/')
+        self.assertTrue(os.path.exists('test_files/out/.sortmedia-cache.db'))
+        self.assertTrue(os.path.exists('test_files/out/2099/September/29/' +
+                                       'spam.jpg'))
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_duplicate_under_other_name(self):
+        img_a = create_file(50, 50, 'blue', name='ham')
+        os.makedirs('test_move/elsewhere')
+        shutil.copyfile(img_a, 'test_move/elsewhere/renamed.jpg')
+
+        index = ContentIndex('test_move')
+        index.build()
+
+        photo = Photo(img_a, 'image/jpeg')
+        self.assertEqual(index.lookup(photo.hash),
+                         os.path.normpath('test_move/elsewhere/renamed.jpg'))
+        self.assertIsNone(photo.target_path('test_move', index))
+        self.assertFalse(photo.copy('test_move', index))
+
+    def test_write_check_uses_index(self):
+        img_a = create_file(50, 50, 'blue', name='ham')
+        photo = Photo(img_a, 'image/jpeg')
+        index = ContentIndex('test_files')
+        index.add(img_a, photo.size, photo.hash)
+
+        photo.hashes_match = MagicMock()
+        self.assertEqual(Safety.IDENTICAL, photo.write_check(img_a, index))
+        photo.hashes_match.assert_not_called()
+
+    def test_updated_and_persisted(self):
+        img_a = create_file(50, 50, 'blue', name='ham')
+        create_file(50, 50, 'red', name='eggs')
+
+        index = ContentIndex('test_move', path='test_files/index.json')
+        index.build()
+        photo = Photo(img_a, 'image/jpeg')
+        self.assertTrue(photo.copy('test_move', index))
+        index.save()
+
+        index = ContentIndex('test_move', path='test_files/index.json')
+        index.load()
+        self.assertEqual(index.lookup(photo.hash),
+                         os.path.normpath('test_move/2099/September/29/' +
+                                          'ham.jpg'))
+
+        # Files which have been deleted are dropped on the next build.
+        os.remove('test_move/2099/September/29/ham.jpg')
+        index.build()
+        self.assertIsNone(index.lookup(photo.hash))
+        self.assertEqual(len(index), 0)
+
+    def test_changed_since_saved(self):
+        create_file(50, 50, 'blue', name='ham')
+        ms = SortMedia(copy=True, index_file='test_files/index.json')
+        ms.process_files('test_files/', 'test_move')
+
+        # The archived file is overwritten with other content of the same
+        # size.
+        stored = 'test_move/2099/September/29/ham.jpg'
+        size = os.path.getsize(stored)
+        with open(stored, 'wb') as f:
+            f.write(os.urandom(size))
+
+        ms = SortMedia(copy=True, index_file='test_files/index.json')
+        ms.process_files('test_files/', 'test_move')
+
+        self.assertEqual(ms.stats.counters['duplicates'], 0)
+        self.assertTrue(os.path.exists(
+            'test_move/2099/September/29/ham_1.jpg'))
+
+    def test_process_files_with_index(self):
+        create_file(50, 50, 'blue', name='spam')
+        os.makedirs('test_move')
+        create_file(50, 50, 'blue', name='../test_move/old')
+
+        ms = SortMedia(index=True)
+        ms.process_files('test_files/', 'test_move/')
+        self.assertFalse(os.path.exists('test_move/2099/September/29/' +
+                                        'spam.jpg'))
+
+
+class TestTieredDedupe(unittest.TestCase):
+    def setUp(self):
+        if not os.path.exists('test_files'):
+            os.mkdir('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_not_hashed_up_front(self):
+        img = create_file(50, 50, 'blue')
+        photo = Photo(img, 'image/jpeg', tiered=True)
+        self.assertIsNone(photo._hash)
+
+        with open(img, 'rb') as f:
+            self.assertEqual(photo.hash, hashlib.sha256(f.read()).digest())
+
+    def test_size_mismatch_not_hashed(self):
+        img_a = create_file(50, 50, 'blue')
+        img_c = create_file(200, 200, 'red')
+        photo = Photo(img_a, 'image/jpeg', tiered=True)
+
+        self.assertFalse(photo.hashes_match(img_c))
+        self.assertIsNone(photo._hash)
+
+    def test_partial_mismatch_not_hashed(self):
+        size = hashing.PARTIAL_SIZE * 3
+        with open('test_files/a', 'wb') as f:
+            f.write(b'a' * size)
+        with open('test_files/b', 'wb') as f:
+            f.write(b'a' * (size - 1) + b'b')
+
+        photo = Photo('test_files/a', 'image/jpeg', tiered=True)
+        self.assertFalse(photo.hashes_match('test_files/b'))
+        self.assertIsNone(photo._hash)
+        self.assertTrue(photo.hashes_match('test_files/a'))
+
+    def test_index_by_size(self):
+        img_a = create_file(50, 50, 'blue', name='ham')
+        img_b = create_file(50, 50, 'red', name='eggs')
+        os.makedirs('test_move')
+        shutil.copyfile(img_a, 'test_move/renamed.jpg')
+
+        index = ContentIndex('test_move', tiered=True)
+        index.build()
+        self.assertIsNone(index.digest_of('test_move/renamed.jpg'))
+
+        self.assertIsNone(index.find(Photo(img_b, 'image/jpeg', tiered=True)))
+        self.assertEqual(index.find(Photo(img_a, 'image/jpeg', tiered=True)),
+                         os.path.normpath('test_move/renamed.jpg'))
+
+    def test_same_results(self):
+        # Two identical photos and one photo with a different name clash.
+        create_file(50, 50, 'blue', name='spam')
+        os.makedirs('test_files/sub')
+        create_file(50, 50, 'blue', name='sub/spam')
+        create_file(50, 50, 'red', name='sub/eggs')
+        create_file(50, 50, 'green', name='eggs')
+
+        for dedupe in ('full', 'tiered'):
+            ms = SortMedia(copy=True, dedupe=dedupe)
+            ms.process_files('test_files/', 'test_move/')
+            names = sorted(os.listdir('test_move/2099/September/29'))
+            self.assertEqual(names, ['eggs.jpg', 'eggs_1.jpg', 'spam.jpg'])
+            shutil.rmtree('test_move')
+
+
+class TestWalk(unittest.TestCase):
+    def setUp(self):
+        for d in ('test_files/a/skip/deep', 'test_files/b'):
+            os.makedirs(d)
+        for name in ('one.jpg', 'a/two.MOV', 'a/notes.txt',
+                     'a/skip/three.jpg', 'a/skip/deep/four.jpg', 'b/five.png'):
+            open(os.path.join('test_files', name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def test_all_files(self):
+        found = sorted(p for p, excluded in scan('test_files'))
+        self.assertEqual(len(found), 6)
+        self.assertIn(os.path.join('test_files', 'a', 'skip', 'deep',
+                                   'four.jpg'), found)
+
+    def test_excluded_subtree_pruned(self):
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            found = list(scan('test_files', excludes=['test_files/a/skip']))
+
+        self.assertIn((os.path.join('test_files', 'a', 'skip'), True), found)
+        self.assertEqual(len([p for p, excluded in found if not excluded]), 4)
+        scanned = [c[0][0] for c in scandir.call_args_list]
+        self.assertNotIn(os.path.join('test_files', 'a', 'skip'), scanned)
+
+    def test_prune(self):
+        found = [p for p, _ in scan('test_files/', prune=['test_files/b/'])]
+        self.assertEqual(len(found), 5)
+        self.assertNotIn(os.path.join('test_files', 'b', 'five.png'), found)
+
+    def test_extensions(self):
+        found = sorted(os.path.basename(p) for p, _ in
+                       scan('test_files', extensions={'.jpg', '.mov'}))
+        self.assertEqual(found, ['four.jpg', 'one.jpg', 'three.jpg',
+                                 'two.MOV'])
+
+    def test_symlink_loop(self):
+        os.symlink(os.path.abspath('test_files/a'), 'test_files/a/loop')
+        found = list(scan('test_files', follow_symlinks=True))
+        self.assertEqual(len(found), 6)
+
+    def test_symlink_skipped(self):
+        os.makedirs('test_outside')
+        self.addCleanup(shutil.rmtree, 'test_outside')
+        open('test_outside/six.jpg', 'w').close()
+        os.symlink(os.path.abspath('test_outside'), 'test_files/b/outside')
+
+        self.assertEqual(len(list(scan('test_files'))), 6)
+        self.assertEqual(len(list(scan('test_files',
+                                       follow_symlinks=True))), 7)
+
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files')
+        self.data = os.urandom(100000)
+        with open('test_files/src', 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_link(self):
+        used = transfer.copy_file('test_files/src', 'test_files/dst', 'link')
+        self.assertEqual(used, 'link')
+        self.assertTrue(os.path.samefile('test_files/src', 'test_files/dst'))
+
+    def test_kernel(self):
+        transfer.copy_file('test_files/src', 'test_files/dst', 'kernel')
+        self.assertEqual(self.read('test_files/dst'), self.data)
+
+    def test_kernel_short_copy(self):
+        with mock.patch('sortmedia.transfer.os.copy_file_range',
+                        return_value=0, create=True):
+            used = transfer.copy_file('test_files/src', 'test_files/dst',
+                                      'kernel')
+        self.assertEqual(used, 'copy')
+        self.assertEqual(self.read('test_files/dst'), self.data)
+
+    def test_reflink_or_fallback(self):
+        used = transfer.copy_file('test_files/src', 'test_files/dst',
+                                  'reflink')
+        self.assertIn(used, ('reflink', 'kernel', 'copy'))
+        self.assertEqual(self.read('test_files/dst'), self.data)
+
+    def test_fallback(self):
+        with mock.patch.dict(transfer._STRATEGIES,
+                             {'link': MagicMock(side_effect=OSError(18, '')),
+                              'kernel': MagicMock(side_effect=OSError())}):
+            used = transfer.copy_file('test_files/src', 'test_files/dst',
+                                      'link')
+        self.assertEqual(used, 'copy')
+        self.assertEqual(self.read('test_files/dst'), self.data)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            transfer.copy_file('test_files/src', 'test_files/dst', 'teleport')
+        with self.assertRaises(ValueError):
+            SortMedia(copy_strategy='teleport')
+
+    def test_process_files_link(self):
+        img = create_file(50, 50, 'blue', name='spam')
+        ms = SortMedia(copy=True, copy_strategy='link')
+        ms.process_files('test_files/', 'test_files/out/')
+        self.assertTrue(os.path.samefile(
+            img, 'test_files/out/2099/September/29/spam.jpg'))
+
+
+def cross_device(*args):
+    raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+
+class TestMover(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files')
+        self.rename = mock.patch('sortmedia.transfer.os.rename',
+                                 side_effect=cross_device)
+        self.rename.start()
+
+    def tearDown(self):
+        self.rename.stop()
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def write(self, name, data):
+        path = f'test_files/{name}'
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_batches(self):
+        data = [os.urandom(3 * 1024 * 1024 + 1), b'', b'spam']
+        srcs = [self.write(f'src{i}', d) for i, d in enumerate(data)]
+        done = []
+
+        with mock.patch('sortmedia.transfer.os.fsync',
+                        wraps=os.fsync) as fsync:
+            with transfer.Mover(sync=2, buffer_size=1024 * 1024) as mover:
+                self.assertFalse(mover.move(srcs[0], 'test_files/dst0',
+                                            hashlib.sha256(data[0]).digest()))
+                mover.after(lambda: done.append(0))
+
+                # Not synced yet, so the source is kept.
+                self.assertTrue(os.path.exists(srcs[0]))
+                self.assertEqual(done, [])
+
+                mover.move(srcs[1], 'test_files/dst1')
+                self.assertFalse(os.path.exists(srcs[0]))
+                self.assertEqual(done, [0])
+                self.assertGreaterEqual(fsync.call_count, 2)
+
+                mover.move(srcs[2], 'test_files/dst2')
+
+        self.assertFalse(os.path.exists(srcs[2]))
+        for i, d in enumerate(data):
+            with open(f'test_files/dst{i}', 'rb') as f:
+                self.assertEqual(f.read(), d)
+
+    def test_no_sync(self):
+        src = self.write('src', b'spam')
+
+        with mock.patch('sortmedia.transfer.os.fsync') as fsync:
+            with transfer.Mover(sync=0) as mover:
+                mover.move(src, 'test_files/dst')
+                self.assertFalse(os.path.exists(src))
+
+        fsync.assert_not_called()
+
+    def test_mismatch(self):
+        src = self.write('src', b'spam')
+
+        with transfer.Mover() as mover:
+            with self.assertRaises(RuntimeError):
+                mover.move(src, 'test_files/dst',
+                           hashlib.sha256(b'eggs').digest())
+
+        self.assertTrue(os.path.exists(src))
+        self.assertFalse(os.path.exists('test_files/dst'))
+
+    def test_changed_without_digest(self):
+        src = self.write('src', b'spam')
+
+        # The source is rewritten, keeping its size, once it was copied.
+        with mock.patch('sortmedia.transfer.hash_file',
+                        return_value=hashlib.sha256(b'eggs').digest()):
+            with transfer.Mover() as mover:
+                with self.assertRaises(RuntimeError):
+                    mover.move(src, 'test_files/dst')
+
+        self.assertTrue(os.path.exists(src))
+        self.assertFalse(os.path.exists('test_files/dst'))
+
+    def test_sort(self):
+        spam = create_file(50, 50, 'blue', name='spam')
+        eggs = create_file(50, 50, 'red', name='eggs')
+
+        ms = SortMedia(journal=True, sync=8)
+        plan = ms.plan('test_files', 'test_move')
+
+        # Same size, different content: caught by the digest.
+        with open(eggs, 'r+b') as f:
+            f.seek(-3, os.SEEK_END)
+            f.write(b'xxx')
+
+        journal = ms.open_journal('test_move')
+        ms.apply(plan, journal)
+        journal.close()
+
+        day = 'test_move/2099/September/29'
+        self.assertEqual(os.listdir(day), ['spam.jpg'])
+        self.assertFalse(os.path.exists(spam))
+        self.assertTrue(os.path.exists(eggs))
+
+        journal = Journal('test_move/.sortmedia-journal.jsonl', 'sha256')
+        entries = journal.load()
+        journal.close()
+
+        self.assertEqual(entries[os.path.abspath(spam)]['status'], 'done')
+        self.assertEqual(entries[os.path.abspath(eggs)]['status'],
+                         'planned')
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def entries(self):
+        journal = Journal('test_move/.sortmedia-journal.jsonl', 'sha256')
+        entries = journal.load()
+        journal.close()
+        return entries
+
+    def test_records(self):
+        img = create_file(50, 50, 'blue', name='spam')
+        ms = SortMedia(copy=True, journal=True)
+        ms.process_files('test_files/', 'test_move/')
+
+        entry = self.entries()[os.path.abspath(img)]
+        self.assertEqual(entry['status'], 'done')
+        self.assertEqual(entry['target'], os.path.abspath(
+            'test_move/2099/September/29/spam.jpg'))
+
+    def test_resume_skips_finished(self):
+        create_file(50, 50, 'blue', name='spam')
+        SortMedia(copy=True, journal=True).process_files('test_files/',
+                                                         'test_move/')
+        create_file(50, 50, 'red', name='eggs')
+
+        ms = SortMedia(copy=True, resume=True)
+        with mock.patch.object(ms, 'make_media',
+                               wraps=ms.make_media) as make_media:
+            ms.process_files('test_files/', 'test_move/')
+
+        processed = [c[0][0] for c in make_media.call_args_list]
+        self.assertEqual(processed, ['test_files/eggs.jpg'])
+        self.assertFalse(os.path.exists(
+            'test_move/2099/September/29/spam_1.jpg'))
+
+    def test_recover_partial_move(self):
+        img = create_file(50, 50, 'blue', name='spam')
+        target = 'test_move/2099/September/29/spam.jpg'
+        os.makedirs(os.path.dirname(target))
+
+        with open(img, 'rb') as f:
+            data = f.read()
+        with open(target, 'wb') as f:
+            f.write(data[:100])
+
+        journal = Journal('test_move/.sortmedia-journal.jsonl', 'sha256')
+        with Photo(img, 'image/jpeg') as photo:
+            journal.record('planned', 'move', img, photo.size, photo._hash,
+                           target)
+        journal.close()
+
+        SortMedia(resume=True).process_files('test_files/', 'test_move/')
+
+        self.assertFalse(os.path.exists(img))
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(os.path.exists(
+            'test_move/2099/September/29/spam_1.jpg'))
+
+    def test_recover_complete_move(self):
+        img = create_file(50, 50, 'blue', name='spam')
+        target = 'test_move/2099/September/29/spam.jpg'
+        os.makedirs(os.path.dirname(target))
+        shutil.copyfile(img, target)
+
+        journal = Journal('test_move/.sortmedia-journal.jsonl', 'sha256')
+        with Photo(img, 'image/jpeg') as photo:
+            photo.hash
+            journal.record('planned', 'move', img, photo.size, photo._hash,
+                           target)
+
+        self.assertEqual(journal.recover(), 1)
+        journal.close()
+
+        self.assertFalse(os.path.exists(img))
+        self.assertEqual(self.entries()[os.path.abspath(img)]['status'],
+                         'done')
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/a')
+        os.makedirs('test_files/b')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def digest(self, path):
+        with Photo(path, 'image/jpeg') as photo:
+            return photo.hash
+
+    def test_store_layout(self):
+        img = create_file(50, 50, 'blue', name='a/spam')
+        shutil.copyfile(img, 'test_files/b/eggs.jpg')
+        digest = self.digest(img).hex()
+
+        ms = SortMedia(copy=True, archive=True)
+        ms.process_files('test_files/', 'test_move')
+
+        stored = os.path.join(store_root('test_move'), digest[:2],
+                              digest[2:4], digest)
+        day = 'test_move/2099/September/29'
+        views = os.listdir(day)
+
+        # Whichever copy was read first is linked, the other is a duplicate.
+        self.assertEqual(len(views), 1)
+        self.assertTrue(os.path.samefile(stored, f'{day}/{views[0]}'))
+        self.assertEqual(os.stat(stored).st_nlink, 2)
+        self.assertEqual(ms.stats.counters['duplicates'], 1)
+
+        # Content already archived is found without reading the tree.
+        ms = SortMedia(copy=True, archive=True)
+        with mock.patch('sortmedia.names.hash_file') as hash_file:
+            ms.process_files('test_files/', 'test_move')
+
+        hash_file.assert_not_called()
+        self.assertEqual(ms.stats.counters['duplicates'], 2)
+
+    def test_extensions_share_object(self):
+        img = create_file(50, 50, 'blue', name='a/spam')
+        shutil.copyfile(img, 'test_files/b/eggs.jpeg')
+        digest = self.digest(img)
+
+        ms = SortMedia(copy=True, archive=True)
+        ms.process_files('test_files/', 'test_move')
+
+        stored = Store(store_root('test_move')).path(digest)
+        self.assertEqual(os.listdir(os.path.dirname(stored)),
+                         [os.path.basename(stored)])
+        self.assertEqual(ms.stats.counters['duplicates'], 1)
+
+    def test_name_clash(self):
+        create_file(50, 50, 'blue', name='a/spam')
+        create_file(50, 50, 'red', name='b/spam')
+
+        SortMedia(archive=True).process_files('test_files/', 'test_move')
+
+        day = 'test_move/2099/September/29'
+        self.assertEqual(sorted(os.listdir(day)), ['spam.jpg', 'spam_1.jpg'])
+        self.assertEqual(sorted(os.listdir('test_files/a') +
+                                os.listdir('test_files/b')), [])
+        self.assertFalse(os.path.samefile(f'{day}/spam.jpg',
+                                          f'{day}/spam_1.jpg'))
+
+    def test_unlinked_object(self):
+        img = create_file(50, 50, 'blue', name='a/spam')
+        digest = self.digest(img)
+
+        # Stored by a run interrupted before the date tree was linked.
+        store = Store(store_root('test_move'))
+        stored = store.put(img, digest)
+        self.assertEqual(stored, store.path(digest))
+        self.assertFalse(store.find(digest))
+
+        SortMedia(archive=True).process_files('test_files/', 'test_move')
+
+        self.assertFalse(os.path.exists(img))
+        self.assertTrue(os.path.samefile(
+            stored, 'test_move/2099/September/29/spam.jpg'))
+        self.assertTrue(store.find(digest))
+
+    def test_resume_links(self):
+        img = create_file(50, 50, 'blue', name='a/spam')
+        target = 'test_move/2099/September/29/spam.jpg'
+
+        with Photo(img, 'image/jpeg') as photo:
+            digest, size = photo.hash, photo.size
+
+        store = Store(store_root('test_move'))
+        journal = Journal('test_move/.sortmedia-journal.jsonl', 'sha256')
+        journal.record('planned', 'move', img, size, digest, target,
+                       store.path(digest))
+        store.put(img, digest, move=True)
+
+        self.assertEqual(journal.recover(), 1)
+        journal.close()
+
+        self.assertTrue(os.path.samefile(store.path(digest),
+                                         target))
+
+    def test_plan(self):
+        img = create_file(50, 50, 'blue', name='a/spam')
+        digest = self.digest(img)
+
+        SortMedia(dry=True, archive=True, plan_file='test_files/p.json') \
+            .process_files('test_files/a', 'test_move')
+        self.assertFalse(os.path.exists('test_move'))
+
+        SortMedia().process_plan('test_files/p.json')
+
+        self.assertTrue(os.path.samefile(
+            Store(store_root('test_move')).path(digest),
+            'test_move/2099/September/29/spam.jpg'))
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/src')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def make_zip(self, path, files):
+        import zipfile
+
+        with zipfile.ZipFile(path, 'w') as z:
+            for name, src in files:
+                z.write(src, name)
+
+    def make_tar(self, path, files):
+        import tarfile
+
+        with tarfile.open(path, 'w:gz') as t:
+            for name, src in files:
+                t.add(src, name)
+
+    def test_safe_name(self):
+        self.assertEqual(bundle.safe_name('a/./b.jpg'),
+                         os.path.join('a', 'b.jpg'))
+        self.assertEqual(bundle.safe_name('/a/b.jpg'),
+                         os.path.join('a', 'b.jpg'))
+        self.assertIsNone(bundle.safe_name('a/../../b.jpg'))
+        self.assertIsNone(bundle.safe_name('./'))
+
+    def test_zip(self):
+        spam = create_file(50, 50, 'blue', name='src/spam')
+        eggs = create_file(50, 50, 'red', name='src/eggs')
+        with open('test_files/src/notes.txt', 'w') as f:
+            f.write('not media')
+
+        self.make_zip('test_files/takeout.zip', [
+            ('Takeout/Photos/spam.jpg', spam),
+            ('Takeout/Photos/2/eggs.jpg', eggs),
+            ('Takeout/notes.txt', 'test_files/src/notes.txt'),
+            ('../escape.jpg', spam),
+        ])
+
+        ms = SortMedia(copy=True)
+        with mock.patch('sortmedia.file.hash_fp') as hash_fp, \
+                mock.patch('sortmedia.file.hash_bytes') as hash_bytes:
+            ms.process_files('test_files/takeout.zip', 'test_move')
+
+        # Members are hashed as they are written to the spool.
+        hash_fp.assert_not_called()
+        hash_bytes.assert_not_called()
+
+        day = 'test_move/2099/September/29'
+        self.assertEqual(sorted(os.listdir(day)), ['eggs.jpg', 'spam.jpg'])
+        with open(f'{day}/spam.jpg', 'rb') as a, open(spam, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+        self.assertTrue(os.path.exists('test_files/takeout.zip'))
+        self.assertFalse(os.path.exists('test_move/escape.jpg'))
+        self.assertFalse(os.path.exists(f'test_move/{bundle.SPOOL_DIR}'))
+        self.assertEqual(ms.stats.stages['extract']['files'], 3)
+        self.assertEqual(ms.stats.counters['photos'], 2)
+
+    def test_tar_duplicates(self):
+        spam = create_file(50, 50, 'blue', name='src/spam')
+        self.make_tar('test_files/export.tar.gz',
+                      [('a/spam.jpg', spam), ('b/spam.jpg', spam)])
+
+        ms = SortMedia(jobs=2)
+        ms.process_files(['test_files/src', 'test_files/export.tar.gz'],
+                         'test_move')
+
+        self.assertEqual(os.listdir('test_move/2099/September/29'),
+                         ['spam.jpg'])
+        self.assertEqual(ms.stats.counters['duplicates'], 2)
+        self.assertEqual(os.listdir('test_move'), ['2099'])
+
+    def test_dry_run(self):
+        spam = create_file(50, 50, 'blue', name='src/spam')
+        self.make_zip('test_files/takeout.zip', [('spam.jpg', spam)])
+
+        ms = SortMedia(dry=True, progress=True)
+        with mock.patch('sortmedia.bundle.Spool.extract') as extract:
+            ms.process_files('test_files/takeout.zip', 'test_move')
+
+        # Members are listed from their headers, without being spooled.
+        extract.assert_not_called()
+        self.assertFalse(os.path.exists('test_move'))
+        self.assertEqual(ms.stats.total, 1)
+        self.assertEqual(ms.stats.counters['photos'], 1)
+
+    def test_plan_refused(self):
+        spam = create_file(50, 50, 'blue', name='src/spam')
+        self.make_zip('test_files/takeout.zip', [('spam.jpg', spam)])
+
+        ms = SortMedia(dry=True, plan_file='test_files/p.json')
+        ms.process_files('test_files/takeout.zip', 'test_move')
+
+        self.assertFalse(os.path.exists('test_files/p.json'))
+        self.assertFalse(os.path.exists('test_move'))
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/out')
+        self.watcher = Watcher('test_files', prune=['test_files/out'],
+                               debounce=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree('test_files')
+
+    def wait(self, timeout=2):
+        found = []
+        end = time.monotonic() + timeout
+        while time.monotonic() < end and not found:
+            found = self.watcher.poll(0.05)
+        return found
+
+    def test_new_file(self):
+        img = create_file(50, 50, 'blue', name='spam')
+        self.assertEqual(self.wait(), [img])
+        self.assertEqual(self.watcher.poll(0.2), [])
+
+    def test_new_directory(self):
+        os.makedirs('test_files/a/b')
+        self.watcher.poll(0.05)
+        img = create_file(50, 50, 'blue', name='a/b/spam')
+        self.assertEqual(self.wait(), [img])
+
+    def test_debounce(self):
+        with open('test_files/spam.jpg', 'wb') as f:
+            f.write(b'\xff\xd8\xff')
+            f.flush()
+            self.assertEqual(self.watcher.poll(0.3), [])
+            f.write(b'\x00' * 100)
+        self.assertEqual(self.wait(), ['test_files/spam.jpg'])
+
+    def test_open_file_not_ready(self):
+        with open('test_files/spam.jpg', 'wb') as f:
+            f.write(b'\xff\xd8\xff')
+            f.flush()
+            # A stalled writer: created, but never closed.
+            self.assertEqual(self.wait(0.5), [])
+        self.assertEqual(self.wait(), ['test_files/spam.jpg'])
+
+    def test_pruned(self):
+        create_file(50, 50, 'blue', name='out/spam')
+        self.assertEqual(self.wait(0.5), [])
+
+    def test_sorts_new_files(self):
+        ms = SortMedia()
+        img = create_file(50, 50, 'blue', name='spam')
+        self.assertEqual(self.wait(), [img])
+        obj, duplicate = ms.process_file(img, 'test_files/out')
+
+        self.assertIsInstance(obj, Photo)
+        self.assertFalse(duplicate)
+        self.assertTrue(os.path.exists(
+            'test_files/out/2099/September/29/spam.jpg'))
+
+    def test_failure_keeps_watching(self):
+        ms = SortMedia()
+        files = iter(['test_files/bad.jpg', 'test_files/good.jpg'])
+
+        def watched(*args, **kwargs):
+            watcher = mock.MagicMock()
+            watcher.__iter__.return_value = files
+            return watcher
+
+        def process_file(filepath, *args):
+            if filepath.endswith('bad.jpg'):
+                raise ValueError('year 0 is out of range')
+
+        with mock.patch('sortmedia.sort.Watcher', side_effect=watched), \
+                mock.patch.object(ms, 'process_file',
+                                  side_effect=process_file) as processed, \
+                self.assertLogs('sortmedia.sort', 'ERROR') as logs:
+            ms.watch('test_files', 'test_files/out')
+
+        self.assertEqual(processed.call_count, 2)
+        self.assertIn('bad.jpg -- FAILED', logs.output[0])
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_slowest(self):
+        stats = Stats(slowest=2)
+        for i, seconds in enumerate([0.3, 0.1, 0.5, 0.2]):
+            stats.record('hash', seconds, 100, f'f{i}', 'image/jpeg')
+            stats.file_done(f'f{i}', 'image/jpeg', 100)
+
+        result = stats.as_dict()
+        self.assertEqual([s['path'] for s in result['slowest']],
+                         ['f2', 'f0'])
+        self.assertEqual(result['stages']['hash']['bytes'], 400)
+        self.assertEqual(result['mimes']['image/jpeg']['files'], 4)
+        self.assertAlmostEqual(
+            result['mimes']['image/jpeg']['stages']['hash'], 1.1)
+
+    def test_hooks(self):
+        create_file(50, 50, 'blue', name='spam')
+        create_file(50, 50, 'red', name='eggs', withExif=False)
+        events = []
+
+        ms = SortMedia(copy=True,
+                       hooks=[lambda e, d: events.append((e, d))])
+        ms.process_files('test_files/', 'test_move/')
+
+        files = sorted((d['path'], d['outcome']) for e, d in events
+                       if e == 'file')
+        self.assertEqual(files, [('test_files/eggs.jpg', 'sorted'),
+                                 ('test_files/spam.jpg', 'sorted')])
+        self.assertEqual(events[-1][0], 'finish')
+
+        stats = json.loads(ms.stats.to_json())
+        self.assertEqual(stats['counters']['photos'], 2)
+        for stage in ('walk', 'mime', 'hash', 'metadata', 'transfer'):
+            self.assertGreater(stats['stages'][stage]['files'], 0)
+        self.assertEqual(stats['mimes']['image/jpeg']['files'], 2)
+
+    def test_parallel(self):
+        create_file(50, 50, 'blue', name='spam')
+        ms = SortMedia(copy=True, jobs=2)
+        ms.process_files('test_files/', 'test_move/')
+        self.assertEqual(ms.stats.stages['metadata']['files'], 1)
+
+    def test_progress(self):
+        stats = Stats()
+        stats.total = 4
+        stats.started = stats.started - 2
+        stats.count('photos', 2)
+        progress = Progress(stats, stream=MagicMock())
+        self.assertTrue(progress.line().startswith(
+            '2/4 (50%) files, 1.0 files/s'))
+        self.assertIn('ETA 0m02s', progress.line())
+
+    def test_progress_phases(self):
+        stats = Stats()
+        progress = Progress(stats, stream=MagicMock(), interval=0)
+        stats.add_hook(progress)
+        stats.total = 4
+
+        # Planning is counted as it happens, not once files are written.
+        for i in range(4):
+            stats.count('photos')
+            stats.file_planned(f'photo{i}.jpg', 'image/jpeg', 10)
+        self.assertTrue(progress.line().startswith('4/4 (100%)'))
+
+        stats.file_done('photo0.jpg', 'image/jpeg', 10)
+        self.assertTrue(progress.line().startswith('applied 1/4 (25%)'))
+        self.assertIn('ETA', progress.line())
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/a')
+        os.makedirs('test_files/b')
+        create_file(50, 50, 'blue', name='a/spam')
+        create_file(50, 50, 'red', name='b/spam')
+        create_file(50, 50, 'blue', name='b/eggs', withExif=False)
+        shutil.copyfile('test_files/a/spam.jpg', 'test_files/spam.jpg')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def plan(self, path='test_files/plan.json', **kwargs):
+        ms = SortMedia(dry=True, plan_file=path, **kwargs)
+        ms.process_files('test_files/', 'test_move/')
+        self.assertFalse(os.path.exists('test_move'))
+        return Plan.load(path)
+
+    def test_dry_plan(self):
+        plan = self.plan()
+        ops = {(op.src, op.action, op.target) for op in plan}
+        day = 'test_move/2099/September/29'
+
+        self.assertEqual(ops, {
+            ('test_files/spam.jpg', 'move', f'{day}/spam.jpg'),
+            ('test_files/a/spam.jpg', 'duplicate', None),
+            ('test_files/b/spam.jpg', 'move', f'{day}/spam_1.jpg'),
+            ('test_files/b/eggs.jpg', 'move', 'test_move/unknown/eggs.jpg'),
+        })
+        for op in plan:
+            self.assertEqual(len(op.digest), 32)
+
+    def test_apply(self):
+        self.plan()
+        ms = SortMedia()
+        with mock.patch('os.makedirs', wraps=os.makedirs) as makedirs:
+            ms.process_plan('test_files/plan.json')
+
+        # Each directory is created once, however many files go there.
+        made = [os.path.normpath(c[0][0]) for c in makedirs.call_args_list]
+        self.assertEqual(len(made), len(set(made)))
+        self.assertIn('test_move/2099/September/29', made)
+        self.assertTrue(os.path.exists('test_move/2099/September/29/' +
+                                       'spam_1.jpg'))
+        self.assertTrue(os.path.exists('test_files/a/spam.jpg'))
+        self.assertFalse(os.path.exists('test_files/b/spam.jpg'))
+        self.assertEqual(ms.stats.counters['duplicates'], 1)
+
+    def test_csv(self):
+        plan = self.plan('test_files/plan.csv', copy=True,
+                         copy_strategy='link', archive=True)
+        self.assertEqual(plan.algorithm, 'sha256')
+        self.assertEqual(plan.dst, 'test_move/')
+        self.assertEqual(plan.copy_strategy, 'link')
+        self.assertEqual(plan.store, store_root('test_move/'))
+        self.assertEqual(len(plan), 4)
+
+        SortMedia(journal=True).process_plan('test_files/plan.csv')
+        self.assertTrue(os.path.exists('test_files/b/spam.jpg'))
+        self.assertTrue(os.path.samefile(
+            'test_files/b/eggs.jpg', 'test_move/unknown/eggs.jpg'))
+        self.assertTrue(os.path.exists('test_move/.sortmedia-journal.jsonl'))
+
+    def test_csv_without_dst(self):
+        with open('test_files/plan.csv', 'w') as f:
+            f.write('action,src,target,size,mime,date,digest,algorithm\n' +
+                    'move,test_files/spam.jpg,test_move/2099/spam.jpg,' +
+                    '1,image/jpeg,,,sha256\n')
+
+        with self.assertRaises(RuntimeError):
+            Plan.load('test_files/plan.csv')
+        self.assertEqual(Plan.load('test_files/plan.csv', 'test_move').dst,
+                         'test_move')
+
+    def test_apply_skips_changes(self):
+        self.plan()
+        with open('test_files/b/eggs.jpg', 'ab') as f:
+            f.write(b'more')
+        os.makedirs('test_move/2099/September/29')
+        with open('test_move/2099/September/29/spam.jpg', 'wb') as f:
+            f.write(b'other')
+
+        SortMedia().process_plan('test_files/plan.json')
+
+        self.assertTrue(os.path.exists('test_files/b/eggs.jpg'))
+        self.assertTrue(os.path.exists('test_files/spam.jpg'))
+        with open('test_move/2099/September/29/spam.jpg', 'rb') as f:
+            self.assertEqual(f.read(), b'other')
+
+    def test_operation(self):
+        op = Operation('copy', 'a', 'b', 3, 'image/png', b'\x01')
+        self.assertEqual(Operation.from_dict(op.to_dict()).digest, b'\x01')
+        with self.assertRaises(ValueError):
+            Operation('teleport', 'a')
+
+    def test_compact_operation(self):
+        a = Operation('move', 'src/x/a.jpg', 'dst/2099/a.jpg', 3,
+                      'image/jpeg', None, 20990929)
+        b = Operation('move', 'src/x/b.jpg', 'dst/2099/b_1.jpg', 3,
+                      'image/jpeg')
+
+        self.assertFalse(hasattr(a, '__dict__'))
+        self.assertIs(a._src_dir, b._src_dir)
+        self.assertEqual(a._mime, b._mime)
+        self.assertEqual(b.target, os.path.join('dst/2099', 'b_1.jpg'))
+        self.assertEqual(plan_mod.unpack_date(a.date).isoformat(),
+                         '2099-09-29')
+
+        c = Operation.from_dict(a.to_dict())
+        self.assertEqual((c.src, c.target, c.mime, c.date),
+                         (a.src, a.target, a.mime, a.date))
+
+    def test_plan_dates(self):
+        plan = self.plan()
+        dates = {op.src: op.date for op in plan}
+        self.assertEqual(dates['test_files/spam.jpg'], 20990929)
+        self.assertIsNone(dates['test_files/b/eggs.jpg'])
+
+
+class TestNameIndex(unittest.TestCase):
+    day = 'test_move/2099/September/29'
+
+    def setUp(self):
+        os.makedirs('test_files')
+        os.makedirs(self.day)
+        for i, color in enumerate(['red', 'green', 'yellow']):
+            name = 'spam' if i == 0 else f'spam_{i}'
+            img = create_file(50, 50, color, name=name)
+            shutil.move(img, f'{self.day}/{name}.jpg')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        shutil.rmtree('test_move')
+
+    def photo(self, color, size=50):
+        return Photo(create_file(size, size, color, name='spam'),
+                     'image/jpeg')
+
+    def test_free_suffix(self):
+        names = NameIndex()
+        with mock.patch('sortmedia.names.hash_file',
+                        wraps=hashing.hash_file) as hashed:
+            first = self.photo('blue').target_path('test_move', names=names)
+            second = self.photo('white').target_path('test_move',
+                                                     names=names)
+
+        self.assertEqual(first, f'{self.day}/spam_3.jpg')
+        self.assertEqual(second, f'{self.day}/spam_4.jpg')
+
+        # Every file in the chain is read once, however many files clash.
+        paths = [c[0][0] for c in hashed.call_args_list]
+        self.assertEqual(len(paths), len(set(paths)))
+
+    def test_identical(self):
+        shutil.copyfile(f'{self.day}/spam_1.jpg', 'test_files/spam.jpg')
+        photo = Photo('test_files/spam.jpg', 'image/jpeg')
+        self.assertIsNone(photo.target_path('test_move', names=NameIndex()))
+
+    def test_size_mismatch_not_read(self):
+        with mock.patch('sortmedia.names.hash_file') as hashed:
+            photo = self.photo('blue', size=200)
+            target = photo.target_path('test_move', names=NameIndex())
+
+        hashed.assert_not_called()
+        self.assertEqual(target, f'{self.day}/spam_3.jpg')
+
+    def test_tiered_partial_first(self):
+        size = 3 * hashing.PARTIAL_SIZE
+        with open(f'{self.day}/eggs.jpg', 'wb') as f:
+            f.write(os.urandom(size))
+        with open('test_files/eggs.jpg', 'wb') as f:
+            f.write(os.urandom(size))
+
+        photo = Photo('test_files/eggs.jpg', 'image/jpeg', tiered=True)
+        with mock.patch('sortmedia.names.hash_file') as hashed, \
+                mock.patch('sortmedia.file.hash_fp') as hash_fp:
+            target = NameIndex().allocate(photo, self.day, 'eggs', '.jpg')
+
+        # Same size, but the fingerprints differ: neither file is hashed.
+        hashed.assert_not_called()
+        hash_fp.assert_not_called()
+        self.assertEqual(target, f'{self.day}/eggs_1.jpg')
+
+    def test_same_as_probing(self):
+        os.remove(f'{self.day}/spam.jpg')
+        names = NameIndex()
+
+        for color in ('blue', 'white'):
+            photo = self.photo(color)
+            expected = photo.target_path('test_move')
+            self.assertEqual(photo.target_path('test_move', names=names),
+                             expected)
+            shutil.copyfile(photo.path, expected)
+
+
+class TestDevices(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/card1')
+        os.makedirs('test_files/card2')
+        create_file(50, 50, 'blue', name='card1/spam')
+        create_file(50, 50, 'red', name='card2/spam')
+        create_file(50, 50, 'red', name='card2/eggs')
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_group_by_device(self):
+        groups = devices.group_by_device(['test_files/card1',
+                                          'test_files/card2'])
+        self.assertEqual(list(groups.values()),
+                         [['test_files/card1', 'test_files/card2']])
+
+    def test_disk_order(self):
+        entries = [('test_files/card2/spam.jpg', False),
+                   ('test_files/skip', True),
+                   ('test_files/card1/spam.jpg', False)]
+        ordered = list(devices.disk_order(entries))
+
+        self.assertEqual(ordered[0], ('test_files/skip', True))
+        self.assertEqual(sorted(ordered), sorted(entries))
+
+    def test_merge(self):
+        merged = list(devices.merge([range(100), range(100, 150)], size=4))
+        self.assertEqual(sorted(merged), list(range(150)))
+        self.assertEqual([i for i in merged if i < 100], list(range(100)))
+
+        def broken():
+            yield 1
+            raise OSError('card removed')
+
+        with self.assertRaises(OSError):
+            list(devices.merge([broken(), range(1000)], size=2))
+
+    def test_multiple_sources(self):
+        ms = SortMedia()
+        ms.process_files(['test_files/card1', 'test_files/card2'],
+                         'test_move')
+
+        day = 'test_move/2099/September/29'
+        self.assertEqual(sorted(os.listdir(day)),
+                         ['eggs.jpg', 'spam.jpg', 'spam_1.jpg'])
+        self.assertEqual(ms.stats.counters['photos'], 3)
+
+    def test_sources_per_device(self):
+        # Pretend each card is a separate device, read by its own thread.
+        def by_path(paths):
+            return {i: [p] for i, p in enumerate(paths)}
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        ms = SortMedia(jobs=2, read_order='disk')
+        with mock.patch('sortmedia.sort.group_by_device', by_path), \
+                mock.patch('sortmedia.sort.merge',
+                           wraps=devices.merge) as merge, \
+                mock.patch('sortmedia.sort.ProbePool',
+                           wraps=ProbePool) as probes, \
+                mock.patch('concurrent.futures.ProcessPoolExecutor',
+                           wraps=ProcessPoolExecutor) as procs:
+            ms.process_files(['test_files/card1', 'test_files/card2'],
+                             'test_move')
+
+        self.assertEqual(len(merge.call_args[0][0]), 2)
+        # Both devices share the process and probe pools.
+        procs.assert_called_once_with(4)
+        probes.assert_called_once()
+        self.assertEqual(len(os.listdir('test_move/2099/September/29')), 3)
+        self.assertFalse(os.path.exists('test_files/card2/eggs.jpg'))
+
+
+def pattern(seed, size=(640, 480)):
+    """ Returns a smooth random RGB image, unlike any other seed's. """
+    rng = random.Random(seed)
+    small = Image.new('RGB', (16, 12))
+    small.putdata([tuple(rng.randrange(256) for _ in range(3))
+                   for _ in range(16 * 12)])
+    return small.resize(size, Image.BILINEAR)
+
+
+class TestSimilar(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files')
+        pattern(1).save('test_files/a.jpg', quality=95)
+        pattern(1).resize((320, 240)).save('test_files/a_small.jpg',
+                                           quality=40)
+        pattern(2).save('test_files/b.jpg', quality=95)
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_hashes(self):
+        for method in similar.METHODS:
+            a, a_small, b = [similar.perceptual_hash(f'test_files/{n}.jpg',
+                                                     method)
+                             for n in ('a', 'a_small', 'b')]
+
+            self.assertLessEqual(similar.hamming(a, a_small),
+                                 similar.DEFAULT_DISTANCE)
+            self.assertGreater(similar.hamming(a, b), 16)
+
+    def test_undecodable(self):
+        with open('test_files/c.jpg', 'wb') as f:
+            f.write(b'not an image')
+        self.assertIsNone(similar.perceptual_hash('test_files/c.jpg'))
+
+    def test_multi_index(self):
+        index = similar.MultiIndex(distance=6)
+        rng = random.Random(3)
+        values = [rng.getrandbits(64) for _ in range(500)]
+        for i, v in enumerate(values):
+            index.add(v, i)
+
+        # Flip 6 bits spread across the substrings.
+        near = values[7] ^ (1 | 1 << 17 | 1 << 18 | 1 << 33 | 1 << 50 |
+                            1 << 63)
+        found = index.search(near)
+
+        self.assertIn((6, 7), found)
+        expected = {i for i, v in enumerate(values)
+                    if similar.hamming(v, near) <= 6}
+        self.assertEqual({i for _, i in found}, expected)
+
+    def test_groups(self):
+        index = similar.SimilarityIndex(distance=2)
+        self.assertEqual(index.add('a', 0b0000), [])
+        self.assertEqual(index.add('b', 0b1111 << 20), [])
+        self.assertEqual(index.add('c', 0b0011), ['a'])
+        index.add('d', 0b1111)
+        self.assertEqual(index.groups(), [['a', 'c', 'd']])
+
+    def test_sort_reports_similar(self):
+        ms = SortMedia(similar='phash')
+        ms.process_files('test_files', 'test_move')
+
+        self.assertEqual(len(ms.similar_groups), 1)
+        self.assertEqual(sorted(os.path.basename(p)
+                                for p in ms.similar_groups[0]),
+                         ['a.jpg', 'a_small.jpg'])
+        # Near-duplicates are only reported.
+        self.assertEqual(len(os.listdir('test_move/unknown')), 3)
+        self.assertGreater(ms.stats.stages['perceptual']['files'], 0)
+
+
+FAKE_FFPROBE = """#!{python}
+import sys, json, time
+path = sys.argv[3]
+if 'hang' in path:
+    time.sleep(30)
+if 'slow' in path:
+    time.sleep(0.5)
+tags = {{'creation_time': '2001-02-03T04:05:06.000000Z'}}
+print(json.dumps({{'streams': [{{'index': 0, 'tags': tags}}]}}))
+"""
+
+
+def create_avi(name):
+    """ Write a file detected as AVI, which only `ffprobe` can date. """
+    path = f'test_files/{name}.avi'
+    with open(path, 'wb') as f:
+        f.write(b'RIFF\x00\x00\x00\x00AVI LIST' + os.urandom(200))
+    return path
+
+
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        os.makedirs('test_files/bin')
+        ffprobe = 'test_files/bin/ffprobe'
+        with open(ffprobe, 'w') as f:
+            f.write(FAKE_FFPROBE.format(python=sys.executable))
+        os.chmod(ffprobe, 0o755)
+
+        path = os.path.abspath('test_files/bin') + os.pathsep + \
+            os.environ.get('PATH', '')
+        self.env = mock.patch.dict(os.environ, {'PATH': path})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_probe(self):
+        path = create_avi('clip')
+        self.assertEqual(probe(path)['creation_time'][:4], '2001')
+
+        video = Video(path, 'video/x-msvideo')
+        self.assertEqual(video.created().year, 2001)
+        self.assertTrue(video.probed)
+
+    def test_pool_runs_in_parallel(self):
+        paths = [create_avi(f'slow{i}') for i in range(4)]
+
+        start = time.monotonic()
+        with ProbePool(workers=4) as pool:
+            futures = [pool.submit(path) for path in paths]
+            results = [future.result() for future in futures]
+
+        self.assertLess(time.monotonic() - start, 1.8)
+        for tags, seconds in results:
+            self.assertEqual(tags['creation_time'][:4], '2001')
+
+    def test_pool_from_thread(self):
+        # Device threads submit probes, which an `asyncio` loop outside the
+        # main thread cannot wait on before Python 3.8.
+        path = create_avi('clip')
+        results = []
+
+        with ProbePool(workers=2) as pool:
+            thread = threading.Thread(
+                target=lambda: results.append(pool.submit(path).result()))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(results[0][0]['creation_time'][:4], '2001')
+
+    def test_timeout_kills(self):
+        path = create_avi('hang')
+
+        start = time.monotonic()
+        with ProbePool(timeout=0.3) as pool:
+            tags, _ = pool.submit(path).result()
+        self.assertIsNone(tags)
+        self.assertIsNone(probe(path, timeout=0.3))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_sort_with_pool(self):
+        for jobs in (1, 2):
+            os.makedirs(f'test_files/src{jobs}')
+            create_avi(f'src{jobs}/slow')
+            create_avi(f'src{jobs}/clip')
+            create_file(50, 50, 'red', name=f'src{jobs}/spam')
+
+            ms = SortMedia(jobs=jobs, probes=2)
+            ms.process_files(f'test_files/src{jobs}', 'test_move')
+
+            self.assertEqual(ms.stats.stages['ffprobe']['files'], 2)
+            self.assertEqual(ms.stats.counters['videos'], 2)
+
+        self.assertEqual(len(os.listdir('test_move/2001/February/3')), 4)
+        self.assertTrue(os.path.exists('test_move/2099/September/29/' +
+                                       'spam.jpg'))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.manifest = corpus.generate('test_files', 30, seed=1, width=64,
+                                        height=48, video_size=1000, dirs=3)
+
+    def tearDown(self):
+        shutil.rmtree('test_files')
+        if os.path.exists('test_move'):
+            shutil.rmtree('test_move')
+
+    def test_manifest(self):
+        self.assertEqual(self.manifest['files'], 30)
+        self.assertEqual(sum(self.manifest['kinds'].values()), 30)
+
+        sizes = sum(os.path.getsize(os.path.join(d, f))
+                    for d, _, files in os.walk('test_files') for f in files
+                    if f != corpus.MANIFEST)
+        self.assertEqual(sizes, self.manifest['bytes'])
+
+    def test_media_is_sorted(self):
+        ms = SortMedia(copy=True, index=True)
+        ms.process_files('test_files', 'test_move')
+        kinds = self.manifest['kinds']
+
+        found = [os.path.join(d, f) for d, _, files in os.walk('test_move')
+                 for f in files]
+        unknown = [f for f in found if f.startswith('test_move/unknown/')]
+
+        self.assertEqual(len(found), 30 - kinds['duplicate'])
+        self.assertGreaterEqual(len(unknown), kinds['bare'])
+
+        # HEIC and video dates are read from the generated boxes.
+        for f in unknown:
+            self.assertTrue(f.endswith('.jpg'))
+
+    def test_run_stage(self):
+        result = run_stage('hash', 'test_files', 'test_files',
+                           {'algorithm': 'sha256'})
+        self.assertEqual(result['files'], 31)
+        self.assertGreater(result['mb_per_s'], 0)
+        self.assertGreater(result['peak_rss'], 0)
+
+    def test_startup_is_lazy(self):
+        # Codecs, libmagic and the process pool load on first use only.
+        self.assertEqual(startup.loaded_modules('sortmedia.sort'), [])
+        self.assertEqual(startup.loaded_modules('sortmedia.cli'), [])
+
+        times = startup.import_times('sortmedia.sort')
+        self.assertGreater(times['total_us'], 0)
+
+
 class TestSortMedia(unittest.TestCase):
     def setUp(self):
         if not os.path.exists('test_files'):
@@ -228,6 +1948,37 @@ class TestSortMedia(unittest.TestCase):
         self.assertTrue(os.path.exists('test_move/2099/September/29/spam.jpg'))
         self.assertTrue(os.path.exists('test_move/2099/September/29/eggs.jpg'))
 
+    def test_process_files_parallel(self):
+        create_file(50, 50, 'blue', name='spam')
+        os.makedirs('test_files/a')
+        os.makedirs('test_files/b')
+        create_file(50, 50, 'red', name='a/spam')
+        create_file(50, 50, 'green', name='b/spam')
+        create_file(50, 50, 'blue', name='b/eggs')
+        create_file(50, 50, 'blue', name='b/ham', withExif=False)
+
+        serial = SortMedia(copy=True)
+        serial.process_files('test_files/', 'test_move/serial/')
+        parallel = SortMedia(copy=True, jobs=4)
+        parallel.process_files('test_files/', 'test_move/parallel/')
+
+        for root in ('test_move/serial', 'test_move/parallel'):
+            found = sorted(os.path.relpath(os.path.join(d, f), root)
+                           for d, _, files in os.walk(root) for f in files)
+            self.assertEqual(found, ['2099/September/29/eggs.jpg',
+                                     '2099/September/29/spam.jpg',
+                                     '2099/September/29/spam_1.jpg',
+                                     '2099/September/29/spam_2.jpg',
+                                     'unknown/ham.jpg'])
+
+        # The same source file gets the same name in both runs.
+        for name in ('spam.jpg', 'spam_1.jpg', 'spam_2.jpg'):
+            a = Photo(f'test_move/serial/2099/September/29/{name}',
+                      'image/jpeg')
+            b = Photo(f'test_move/parallel/2099/September/29/{name}',
+                      'image/jpeg')
+            self.assertEqual(a.hash, b.hash)
+
     def test_symlink(self):
         pass
 